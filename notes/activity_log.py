@@ -0,0 +1,366 @@
+'''
+Streaming ingestion of 500px-style activity logs
+
+The API servers append one line per action:
+
+    2015–02–10 10:24:31.32444 23432423 photo_like 423223 123.132.623.123 /get?…
+
+that is date, time, user_id, action, photo_id, ip and
+the request path, about 20GB of it a day, and the
+likes fact table is loaded from those files.
+
+Splitting that with line.split() allocates a handful
+of Python strings per line. Here the file is mmap'd
+and read in fixed-size chunks; each chunk is a NumPy
+uint8 view, newlines and spaces are located with one
+vectorized comparison each, and the fields are decoded
+straight from the bytes:
+
+    datetime   datetime64[us], date separators may be
+               '-' or the en dash the 500px post uses
+    user_id    int64
+    photo_id   int64
+    action     fixed-width bytes (S<n>, n = widest in batch)
+    ip         fixed-width bytes
+    path       uint8 data + int64 offsets, like an Arrow
+               string column
+
+Each chunk is written as one part per ds under
+<out>/<table>/ds=<ds>/, one .npy file per column as in
+stage_check_exchange (path adds path.offsets.npy). Memory stays at about one
+chunk per worker whatever the file size. Files are
+split at newline boundaries into one byte range per
+worker, and the workers parse in parallel.
+
+    python activity_log.py --lines 5000000 --workers 4
+
+generates a log and prints lines per second.
+'''
+import argparse
+import mmap
+import os
+import random
+import shutil
+import tempfile
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+
+NEWLINE, SPACE, CR, DOT = 10, 32, 13, 46
+_MONTH_DAYS = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+CHUNK_SIZE = 64 << 20
+FIELDS = 7
+
+
+def split_ranges(path, parts):
+    '''Cut a file into up to `parts` byte ranges that start and end on line boundaries.'''
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    cuts = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, parts):
+            f.seek(max(size * i // parts, cuts[-1]))
+            f.readline()
+            pos = min(f.tell(), size)
+            if pos > cuts[-1]:
+                cuts.append(pos)
+    if cuts[-1] != size:
+        cuts.append(size)
+    return list(zip(cuts[:-1], cuts[1:]))
+
+
+def _parse_fixed(a, starts, width):
+    '''Exactly `width` decimal digits at each start -> (int64 values, ok mask).'''
+    last = len(a) - 1
+    values = np.zeros(len(starts), dtype=np.int64)
+    ok = np.ones(len(starts), dtype=bool)
+    for k in range(width):
+        digit = a[np.clip(starts + k, 0, last)].astype(np.int64) - 48
+        ok &= (digit >= 0) & (digit <= 9)
+        values = values * 10 + digit
+    return values, ok
+
+
+def _parse_uint(a, starts, ends):
+    '''
+    Decimal digits a[starts:ends] per row -> (int64
+    values, ok mask). Digits are read right-aligned, so
+    positions before a short field just count as zeros.
+    '''
+    lengths = ends - starts
+    ok = (lengths > 0) & (lengths <= 18)
+    width = int(np.clip(lengths, 0, 18).max()) if len(lengths) else 0
+    values = np.zeros(len(starts), dtype=np.int64)
+    last = len(a) - 1
+    for k in range(width):
+        pos = ends - width + k
+        inside = pos >= starts
+        digit = a[np.clip(pos, 0, last)] - np.uint8(48)
+        ok &= ~inside | (digit <= 9)
+        values *= 10
+        values += digit * inside
+    return values, ok
+
+
+def _gather_fixed(a, starts, ends, cap=64):
+    '''Bytes a[starts:ends] per row as an S<n> array, n = widest row (at most cap).'''
+    ends = np.minimum(ends, starts + cap)
+    data, offsets = _gather_varlen(a, starts, ends)
+    lengths = ends - starts
+    width = max(1, int(lengths.max()) if len(lengths) else 1)
+    grid = np.zeros(len(starts) * width, dtype=np.uint8)
+    row_base = np.arange(len(starts), dtype=np.int64) * width - offsets[:-1]
+    grid[np.arange(len(data), dtype=np.int64) + np.repeat(row_base, lengths)] = data
+    return grid.view('S{0}'.format(width))
+
+
+def _gather_varlen(a, starts, ends):
+    '''Bytes a[starts:ends] per row as (data, offsets), without a Python object per row.'''
+    lengths = ends - starts
+    offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    idx = np.arange(offsets[-1], dtype=np.int64)
+    idx += np.repeat(starts - offsets[:-1], lengths)
+    return a[idx], offsets
+
+
+def _days_from_civil(y, m, d):
+    y = y - (m <= 2)
+    era = y // 400
+    yoe = y - era * 400
+    doy = (153 * np.where(m > 2, m - 3, m + 9) + 2) // 5 + d - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def parse_chunk(a):
+    '''
+    Parse a uint8 array holding whole lines. Returns
+    (columns, days, malformed) where columns maps the
+    output column names to arrays, days is the epoch day
+    of each row, and malformed counts the dropped lines.
+    '''
+    nl = np.flatnonzero(a == NEWLINE)
+    if len(a) and a[-1] != NEWLINE:
+        nl = np.append(nl, len(a))
+    starts = np.concatenate(([0], nl[:-1] + 1)).astype(np.int64)
+    ends = nl.astype(np.int64)
+    ends = np.where((ends > starts) & (a[np.maximum(ends - 1, 0)] == CR), ends - 1, ends)
+    keep = ends > starts
+    starts, ends = starts[keep], ends[keep]
+    lines = len(starts)
+
+    sp = np.flatnonzero(a == SPACE).astype(np.int64)
+    first = np.searchsorted(sp, starts)
+    pad = np.append(sp, [len(a) + 1] * (FIELDS - 1))
+    spaces = [pad[first + k] for k in range(FIELDS - 1)]
+    ok = spaces[-1] < ends
+
+    # date: YYYY<sep>MM<sep>DD, sep is 1 byte ('-') or 3 (UTF-8 en dash)
+    sep = (spaces[0] - starts - 8) // 2
+    year, ok_y = _parse_fixed(a, starts, 4)
+    month, ok_m = _parse_fixed(a, starts + 4 + sep, 2)
+    day, ok_d = _parse_fixed(a, spaces[0] - 2, 2)
+    # time: HH:MM:SS[.fraction]
+    t0 = spaces[0] + 1
+    hh, ok_hh = _parse_fixed(a, t0, 2)
+    mi, ok_mi = _parse_fixed(a, t0 + 3, 2)
+    ss, ok_ss = _parse_fixed(a, t0 + 6, 2)
+    # a fraction is a '.' and digits, of which the first 6 are kept
+    _, ok_frac = _parse_uint(a, t0 + 9, spaces[1])
+    ok_frac = (spaces[1] == t0 + 8) | ((a[np.clip(t0 + 8, 0, len(a) - 1)] == DOT) & ok_frac)
+    frac_end = np.minimum(spaces[1], t0 + 15)
+    frac, _ = _parse_uint(a, t0 + 9, frac_end)
+    frac_len = np.clip(frac_end - (t0 + 9), 0, 6)
+    micros = np.where(frac_end > t0 + 9, frac * 10 ** (6 - frac_len), 0)
+
+    user_id, ok_u = _parse_uint(a, spaces[1] + 1, spaces[2])
+    photo_id, ok_p = _parse_uint(a, spaces[3] + 1, spaces[4])
+    ok &= ok_y & ok_m & ok_d & ok_hh & ok_mi & ok_ss & ok_frac & ok_u & ok_p
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    month_days = _MONTH_DAYS[np.clip(month, 0, 12)] + ((month == 2) & leap)
+    ok &= (month >= 1) & (month <= 12) & (day >= 1) & (day <= month_days)
+
+    days = _days_from_civil(year, month, day)
+    ts = ((days * 86400 + hh * 3600 + mi * 60 + ss) * 1000000 + micros)
+    idx = np.flatnonzero(ok)
+    path, path_offsets = _gather_varlen(a, spaces[5][idx] + 1, ends[idx])
+    columns = {
+        'datetime': ts[idx].astype('datetime64[us]'),
+        'user_id': user_id[idx],
+        'photo_id': photo_id[idx],
+        'action': _gather_fixed(a, spaces[2][idx] + 1, spaces[3][idx]),
+        'ip': _gather_fixed(a, spaces[4][idx] + 1, spaces[5][idx]),
+        'path': path,
+        'path.offsets': path_offsets,
+        }
+    return columns, days[idx], lines - len(idx)
+
+
+def _split_by_ds(columns, days):
+    '''Yield (ds, columns) for every day present in a parsed chunk.'''
+    present = np.unique(days)
+    if len(present) == 1:
+        yield str(np.datetime64(int(present[0]), 'D')), columns
+        return
+    for d in present:
+        rows = np.flatnonzero(days == d)
+        part = {}
+        for name, values in columns.items():
+            if name == 'path.offsets':
+                continue
+            if name == 'path':
+                offsets = columns['path.offsets']
+                data, new_offsets = _gather_varlen(values, offsets[rows], offsets[rows + 1])
+                part['path'], part['path.offsets'] = data, new_offsets
+            else:
+                part[name] = values[rows]
+        yield str(np.datetime64(int(d), 'D')), part
+
+
+def write_part(path, columns):
+    os.makedirs(path)
+    for name, values in columns.items():
+        np.save(os.path.join(path, name + '.npy'), values)
+
+
+def ingest_range(path, start, end, out_dir, table='activity', tag='0', chunk_size=CHUNK_SIZE):
+    '''
+    Parse bytes [start, end) of a log file chunk by
+    chunk and write one part per ds per chunk. The range
+    must start and end on line boundaries (split_ranges).
+    Returns (lines_written, lines_malformed).
+    '''
+    written = malformed = 0
+    seq = 0
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pos = start
+            while pos < end:
+                stop = min(pos + chunk_size, end)
+                if stop < end:
+                    nl = mm.rfind(b'\n', pos, stop)
+                    stop = nl + 1 if nl >= pos else mm.find(b'\n', stop, end) + 1 or end
+                a = np.frombuffer(mm, dtype=np.uint8, count=stop - pos, offset=pos)
+                columns, days, bad = parse_chunk(a)
+                del a
+                malformed += bad
+                for ds, part in _split_by_ds(columns, days):
+                    write_part(os.path.join(
+                        out_dir, table, 'ds={0}'.format(ds),
+                        'part-{0}-{1:05d}'.format(tag, seq)), part)
+                    written += len(part['user_id'])
+                seq += 1
+                pos = stop
+        finally:
+            mm.close()
+    return written, malformed
+
+
+def _ingest_job(args):
+    return ingest_range(*args)
+
+
+def ingest_file(path, out_dir, table='activity', workers=None, chunk_size=CHUNK_SIZE):
+    '''Parse a whole log file with `workers` processes. Returns (written, malformed).'''
+    workers = workers or os.cpu_count() or 1
+    name = os.path.basename(path).replace('.', '_')
+    jobs = [(path, s, e, out_dir, table, '{0}-w{1:03d}'.format(name, i), chunk_size)
+            for i, (s, e) in enumerate(split_ranges(path, workers))]
+    if workers == 1 or len(jobs) <= 1:
+        results = [_ingest_job(job) for job in jobs]
+    else:
+        with Pool(workers) as pool:
+            results = pool.map(_ingest_job, jobs)
+    return sum(r[0] for r in results), sum(r[1] for r in results)
+
+
+def read_path(part_dir, i):
+    '''Decode the path of row i of a written part, for spot checks.'''
+    data = np.load(os.path.join(part_dir, 'path.npy'), mmap_mode='r')
+    offsets = np.load(os.path.join(part_dir, 'path.offsets.npy'), mmap_mode='r')
+    return bytes(data[offsets[i]:offsets[i + 1]]).decode('utf-8', 'replace')
+
+
+def write_synthetic_log(path, lines, days=3, seed=0):
+    rng = random.Random(seed)
+    actions = ['photo_like', 'photo_view', 'follow', 'upload', 'signup', 'vote']
+    with open(path, 'w') as f:
+        for i in range(lines):
+            day = 10 + i * days // lines
+            sep = '–' if rng.random() < 0.5 else '-'
+            f.write('2015{0}02{0}{1:02d} {2:02d}:{3:02d}:{4:02d}.{5:05d} {6} {7} {8} '
+                    '{9}.{10}.{11}.{12} /get?photo={8}&src={13}\n'.format(
+                        sep, day, rng.randrange(24), rng.randrange(60), rng.randrange(60),
+                        rng.randrange(100000), rng.randrange(1, 30000000), rng.choice(actions),
+                        rng.randrange(1, 500000), rng.randrange(256), rng.randrange(256),
+                        rng.randrange(256), rng.randrange(256), rng.randrange(1000)))
+
+
+def _split_lines(path, out_dir):
+    '''Today's way: line.split() and Python objects per field, written once at the end.'''
+    from datetime import datetime
+    cols = dict((name, []) for name in ('datetime', 'user_id', 'photo_id', 'action', 'ip', 'path'))
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            fields = line.rstrip('\r\n').split(' ', FIELDS - 1)
+            if len(fields) != FIELDS:
+                continue
+            date = fields[0].replace('\u2013', '-')
+            clock, _, frac = fields[1].partition('.')
+            cols['datetime'].append(datetime(
+                int(date[:4]), int(date[5:7]), int(date[8:10]), int(clock[:2]),
+                int(clock[3:5]), int(clock[6:8]), int((frac + '000000')[:6])))
+            cols['user_id'].append(int(fields[2]))
+            cols['action'].append(fields[3])
+            cols['photo_id'].append(int(fields[4]))
+            cols['ip'].append(fields[5])
+            cols['path'].append(fields[6])
+    os.makedirs(out_dir)
+    for name, values in cols.items():
+        np.save(os.path.join(out_dir, name + '.npy'), np.asarray(values))
+    return len(cols['user_id'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='activity log ingestion benchmark')
+    parser.add_argument('--log', help='an existing log file (default: generate one)')
+    parser.add_argument('--lines', type=int, default=2000000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--chunk-mb', type=int, default=CHUNK_SIZE >> 20)
+    args = parser.parse_args(argv)
+
+    tmp = tempfile.mkdtemp(prefix='activity-')
+    try:
+        log = args.log
+        if not log:
+            log = os.path.join(tmp, 'api.log')
+            write_synthetic_log(log, args.lines)
+        size = os.path.getsize(log)
+        print('{0}: {1:.1f} MB'.format(log, size / 1e6))
+
+        t = time.time()
+        n = _split_lines(log, os.path.join(tmp, 'out-split'))
+        elapsed = time.time() - t
+        print('line.split()         {0:>12,.0f} lines/s  ({1:.1f} MB/s)'.format(
+            n / elapsed, size / 1e6 / elapsed))
+
+        for workers in sorted(set([1, args.workers])):
+            out = os.path.join(tmp, 'out-{0}'.format(workers))
+            t = time.time()
+            written, malformed = ingest_file(log, out, workers=workers,
+                                             chunk_size=args.chunk_mb << 20)
+            elapsed = time.time() - t
+            print('mmap + numpy x{0:<3}   {1:>12,.0f} lines/s  ({2:.1f} MB/s, {3} malformed)'.format(
+                workers, (written + malformed) / elapsed, size / 1e6 / elapsed, malformed))
+        assert written == n, (written, n)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,542 @@
+'''
+Streaming anomaly detection
+
+The guide's data checks end with "an anomaly detection
+system that checks for unseen categories or outliers".
+Done naively, every run rereads weeks of history to
+know what normal looks like.
+
+AnomalyDetector keeps a fixed amount of state per
+table instead, updated once per ds:
+
+    - EWMA mean and variance of table-level metrics
+      (row count, column sums), one per weekday, so a
+      quiet Sunday is compared with past Sundays
+    - EWMA mean and variance per key of a keyed value,
+      e.g. m_bookings per dim_market, with the day's
+      common level divided out: rows whose value is far
+      off their key's baseline are flagged, keys never
+      seen before are reported as unseen
+    - EWMA share of every category of a column, e.g.
+      subscription_type of likes: categories whose share
+      moved, or that appear for the first time
+
+Keyed state is a set of sorted NumPy arrays (key, mean,
+variance, observations, last seen), capped at max_keys
+by dropping the keys seen longest ago, so scoring a
+partition is a searchsorted and a few vector operations:
+O(rows of the partition), whatever the history length.
+Values are clipped to the flagging band before they
+update the state, so one anomaly does not become the
+new normal.
+
+AnomalyCheck plugs a detector into StageCheckExchange
+and AnomalyTask runs it as a DAG task on a published
+partition.
+
+    python anomaly.py --days 120 --markets 2000
+
+scores synthetic partitions with injected anomalies,
+reports recall, precision and the false alarms per
+partition, and compares it with rereading four weeks of
+history. --threshold trades recall for false alarms.
+'''
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+from backfill import DS_FORMAT, ds_add, ds_range
+from stage_check_exchange import CheckResult, ColumnScan, DataQualityError, write_partition
+
+
+def weekday(ds):
+    return datetime.strptime(ds, DS_FORMAT).weekday()
+
+
+class Anomaly(object):
+
+    __slots__ = ('kind', 'column', 'key', 'value', 'expected', 'score')
+
+    def __init__(self, kind, column, key=None, value=None, expected=None, score=None):
+        self.kind = kind
+        self.column = column
+        self.key = key
+        self.value = value
+        self.expected = expected
+        self.score = score
+
+    def to_json(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __repr__(self):
+        if self.kind == 'unseen':
+            return '<unseen {0}={1!r}>'.format(self.column, self.key)
+        return '<{0} {1}{2}: {3:.4g} vs {4:.4g} (z {5:+.1f})>'.format(
+            self.kind, self.column, '[{0!r}]'.format(self.key) if self.key is not None else '',
+            self.value, self.expected, self.score)
+
+
+class KeyedEwma(object):
+    '''
+    EWMA mean/variance per key, as sorted arrays.
+    score() is read-only; update() folds a partition in.
+    '''
+
+    def __init__(self, alpha=0.1, max_keys=100000):
+        self.alpha = alpha
+        self.max_keys = max_keys
+        self.keys = np.empty(0, dtype=object)
+        self.mean = np.empty(0)
+        self.var = np.empty(0)
+        self.n = np.empty(0, dtype=np.int64)
+        self.seen = np.empty(0, dtype=np.int64)
+
+    def lookup(self, keys):
+        '''Index of each key in the state, -1 where it is not there.'''
+        if not len(self.keys):
+            return np.full(len(keys), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[pos] == keys, pos, -1)
+
+    def observations(self, keys):
+        idx = self.lookup(keys)
+        return np.where(idx >= 0, self.n[np.maximum(idx, 0)] if len(self.keys) else 0, 0)
+
+    def _std(self, i):
+        # a floor on std: a key that has been constant is not infinitely surprising
+        return np.maximum(np.sqrt(self.var[i]), 0.05 * np.abs(self.mean[i]) + 1e-9)
+
+    def score(self, keys, values, level=1.0):
+        '''
+        (z, known, expected): z-score of each value against
+        its key's mean times level, 0 where the key is unknown.
+        '''
+        idx = self.lookup(keys)
+        known = idx >= 0
+        if not len(self.keys):
+            return np.zeros(len(keys)), known, np.zeros(len(keys))
+        i = np.where(known, idx, 0)
+        expected = self.mean[i] * level
+        z = np.where(known, (values - expected) / (self._std(i) * level), 0.0)
+        return z, known, expected
+
+    def update(self, keys, values, tick, clip=None):
+        # a NaN folded into a mean stays there for good: non-finite values are dropped
+        finite = np.isfinite(values)
+        if not finite.all():
+            keys, values = keys[finite], values[finite]
+        idx = self.lookup(keys)
+        known = idx >= 0
+        i = idx[known]
+        x = values[known]
+        if clip is not None and len(i):
+            band = clip * self._std(i)
+            x = np.clip(x, self.mean[i] - band, self.mean[i] + band)
+        a = np.where(self.n[i] < 1.0 / self.alpha, 1.0 / (self.n[i] + 1), self.alpha)
+        diff = x - self.mean[i]
+        self.mean[i] += a * diff
+        self.var[i] = (1 - a) * (self.var[i] + a * diff * diff)
+        self.n[i] += 1
+        self.seen[i] = tick
+        new = ~known
+        if new.any():
+            keys = np.concatenate([self.keys, keys[new].astype(object)])
+            order = np.argsort(keys, kind='stable')
+            self.keys = keys[order]
+            self.mean = np.concatenate([self.mean, values[new]])[order]
+            self.var = np.concatenate([self.var, np.zeros(int(new.sum()))])[order]
+            self.n = np.concatenate([self.n, np.ones(int(new.sum()), dtype=np.int64)])[order]
+            self.seen = np.concatenate([self.seen, np.full(int(new.sum()), tick)])[order]
+        if len(self.keys) > self.max_keys:
+            keep = np.sort(np.argsort(-self.seen, kind='stable')[:self.max_keys])
+            for name in ('keys', 'mean', 'var', 'n', 'seen'):
+                setattr(self, name, getattr(self, name)[keep])
+
+    def state(self, prefix):
+        # keys are saved as a str array so the state loads without pickle
+        arrays = dict((prefix + name, getattr(self, name)) for name in ('mean', 'var', 'n', 'seen'))
+        arrays[prefix + 'keys'] = self.keys.astype(str)
+        return arrays
+
+    def restore(self, prefix, arrays):
+        for name in ('mean', 'var', 'n', 'seen'):
+            setattr(self, name, arrays[prefix + name])
+        self.keys = arrays[prefix + 'keys'].astype(object)
+
+
+class AnomalyDetector(object):
+    '''
+    Rolling anomaly state of one table.
+
+        detector = AnomalyDetector(root, 'dim_total_bookings',
+                                   sums=['m_bookings'],
+                                   keyed=[('dim_market', 'm_bookings')])
+        anomalies, flagged_rows = detector.observe(ds, columns)
+
+    `sums` are numeric columns whose daily total is
+    tracked per weekday next to the row count, `keyed`
+    are (key column, value column) pairs and `categories`
+    are columns whose category shares are tracked. Every
+    score needs `warmup` observations before it can flag.
+    '''
+
+    def __init__(self, root, table, sums=(), keyed=(), categories=(), alpha=0.1,
+                 threshold=4.0, warmup=7, max_keys=100000):
+        self.root = root
+        self.table = table
+        self.sums = list(sums)
+        self.keyed = list(keyed)
+        self.categories = list(categories)
+        self.threshold = threshold
+        self.warmup = warmup
+        self.tick = 0
+        self.last_ds = None
+        self.seasonal = KeyedEwma(alpha)
+        self.by_key = dict((pair, KeyedEwma(alpha, max_keys)) for pair in self.keyed)
+        self.shares = dict((c, KeyedEwma(alpha, max_keys)) for c in self.categories)
+        if os.path.exists(self.state_path):
+            self._load()
+
+    @property
+    def state_path(self):
+        return os.path.join(self.root, '_anomaly', self.table + '.npz')
+
+    def _arrays(self):
+        arrays = dict(self.seasonal.state('seasonal.'))
+        for (k, v), state in self.by_key.items():
+            arrays.update(state.state('keyed.{0}.{1}.'.format(k, v)))
+        for c, state in self.shares.items():
+            arrays.update(state.state('share.{0}.'.format(c)))
+        arrays['meta'] = np.array([json.dumps({'tick': self.tick, 'last_ds': self.last_ds})])
+        return arrays
+
+    def save(self):
+        path = self.state_path
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        tmp = '{0}.{1}.tmp.npz'.format(path[:-4], os.getpid())
+        np.savez(tmp, **self._arrays())
+        os.replace(tmp, path)
+
+    def _load(self):
+        with np.load(self.state_path) as saved:
+            arrays = dict((name, saved[name]) for name in saved.files)
+        meta = json.loads(str(arrays['meta'][0]))
+        self.tick, self.last_ds = meta['tick'], meta['last_ds']
+        self.seasonal.restore('seasonal.', arrays)
+        for (k, v), state in self.by_key.items():
+            state.restore('keyed.{0}.{1}.'.format(k, v), arrays)
+        for c, state in self.shares.items():
+            state.restore('share.{0}.'.format(c), arrays)
+
+    def _table_metrics(self, ds, columns, rows):
+        day = weekday(ds)
+        names = ['rows'] + ['sum({0})'.format(c) for c in self.sums]
+        values = np.array([float(rows)] + [float(np.sum(columns[c])) for c in self.sums])
+        keys = np.array(['{0}@{1}'.format(n, day) for n in names], dtype=object)
+        return names, keys, values
+
+    def _keyed(self, state, columns, key_col, value_col):
+        '''
+        Keys, values and today's level: the median ratio
+        of value to baseline over the known keys. Weekday
+        swings and growth move every key together and are
+        the table metrics' business; dividing them out
+        leaves what is off for one key. When most keys
+        report 0 the median ratio is 0 and there is no
+        common level to divide out: the level is then 1.
+        '''
+        k = np.asarray(columns[key_col]).astype(str).astype(object)
+        v = np.asarray(columns[value_col], dtype=np.float64)
+        idx = state.lookup(k)
+        base = state.mean[idx[idx >= 0]] if len(state.keys) else np.empty(0)
+        ratio = v[idx >= 0][base > 0] / base[base > 0]
+        level = float(np.median(ratio)) if len(ratio) else 1.0
+        return k, v, level if np.isfinite(level) and level > 0 else 1.0
+
+    def _shares(self, state, values):
+        '''Share of each category; categories we know that are missing today have 0.'''
+        labels, counts = np.unique(np.asarray(values).astype(str), return_counts=True)
+        share = counts / float(max(counts.sum(), 1))
+        missing = np.setdiff1d(state.keys, labels) if len(state.keys) else np.empty(0)
+        return (np.concatenate([labels.astype(object), missing.astype(object)]),
+                np.concatenate([share, np.zeros(len(missing))]))
+
+    def score(self, ds, columns):
+        '''
+        Anomalies of one partition against the state,
+        without changing it: (anomalies, flagged row mask).
+        '''
+        rows = len(next(iter(columns.values()))) if columns else 0
+        anomalies = []
+        flagged = np.zeros(rows, dtype=bool)
+
+        names, keys, values = self._table_metrics(ds, columns, rows)
+        z, known, mean = self.seasonal.score(keys, values)
+        # a weekday slot needs a couple of observations before its variance means anything
+        ready = known & (self.seasonal.observations(keys) >= 2)
+        for name, zi, v, m, ok in zip(names, z, values, mean, ready):
+            if ok and self.tick >= self.warmup and abs(zi) > self.threshold:
+                anomalies.append(Anomaly('table', name, None, float(v), float(m), float(zi)))
+
+        for key_col, value_col in self.keyed:
+            state = self.by_key[(key_col, value_col)]
+            k, v, level = self._keyed(state, columns, key_col, value_col)
+            z, known, mean = state.score(k, v, level)
+            if self.tick < self.warmup:
+                continue
+            out = known & (np.abs(z) > self.threshold)
+            flagged |= out | ~known
+            for i in np.flatnonzero(out):
+                anomalies.append(Anomaly('outlier', value_col, k[i], float(v[i]),
+                                         float(mean[i]), float(z[i])))
+            for key in np.unique(k[~known]).tolist():
+                anomalies.append(Anomaly('unseen', key_col, key))
+
+        for column in self.categories:
+            state = self.shares[column]
+            labels, share = self._shares(state, columns[column])
+            z, known, mean = state.score(labels, share)
+            if self.tick < self.warmup:
+                continue
+            for i in np.flatnonzero(known & (np.abs(z) > self.threshold)):
+                anomalies.append(Anomaly('share', column, labels[i], float(share[i]),
+                                         float(mean[i]), float(z[i])))
+            for i in np.flatnonzero(~known):
+                anomalies.append(Anomaly('unseen', column, labels[i]))
+            unseen = set(labels[~known].tolist())
+            if unseen:
+                flagged |= np.isin(np.asarray(columns[column]).astype(str), list(unseen))
+        return anomalies, flagged
+
+    def update(self, ds, columns):
+        '''Fold the partition into the state; a ds at or before the last one is skipped.'''
+        if self.last_ds is not None and ds <= self.last_ds:
+            return False
+        rows = len(next(iter(columns.values()))) if columns else 0
+        clip = self.threshold if self.tick >= self.warmup else None
+        _, keys, values = self._table_metrics(ds, columns, rows)
+        self.seasonal.update(keys, values, self.tick, clip)
+        for key_col, value_col in self.keyed:
+            state = self.by_key[(key_col, value_col)]
+            k, v, level = self._keyed(state, columns, key_col, value_col)
+            state.update(k, v / level, self.tick, clip)
+        for column in self.categories:
+            state = self.shares[column]
+            labels, share = self._shares(state, columns[column])
+            state.update(labels, share, self.tick, clip)
+        self.tick += 1
+        self.last_ds = ds
+        return True
+
+    def observe(self, ds, columns, save=True):
+        '''score() then update(): what a daily run does.'''
+        anomalies, flagged = self.score(ds, columns)
+        if self.update(ds, columns) and save:
+            self.save()
+        return anomalies, flagged
+
+
+class AnomalyCheck(object):
+    '''
+    A StageCheckExchange check: fails when the staged
+    partition has more than max_anomalies anomalies. The
+    state is only updated once the partition has been
+    exchanged, via commit(), so a rejected partition does
+    not teach the detector anything.
+
+        check = AnomalyCheck(detector, ds)
+        StageCheckExchange(root, table, [check, ...]).run(ds, columns)
+        check.commit()
+    '''
+
+    def __init__(self, detector, ds, max_anomalies=0):
+        self.detector = detector
+        self.ds = ds
+        self.max_anomalies = max_anomalies
+        self.name = 'anomalies({0})<={1}'.format(detector.table, max_anomalies)
+        self.anomalies = []
+        self._columns = None
+
+    def __call__(self, scan):
+        names = sorted(f[:-4] for f in os.listdir(scan.path) if f.endswith('.npy'))
+        self._columns = dict((n, np.asarray(scan.column(n))) for n in names)
+        self.anomalies, _ = self.detector.score(self.ds, self._columns)
+        return CheckResult(self.name, len(self.anomalies) <= self.max_anomalies,
+                           ', '.join(repr(a) for a in self.anomalies[:5]))
+
+    def commit(self):
+        if self._columns is not None and self.detector.update(self.ds, self._columns):
+            self.detector.save()
+
+
+class AnomalyTask(object):
+    '''
+    Score a published ds partition as a DAG task, e.g.
+    downstream of task_2:
+
+        task = AnomalyTask(root, lambda: AnomalyDetector(root, 'dim_total_bookings', ...))
+        task('anomaly_dim_total_bookings', ds)
+
+    Writes <root>/_anomaly/<table>/ds=<ds>.json with the
+    anomalies and the flagged row numbers, and raises
+    DataQualityError when there are more than
+    max_anomalies.
+    '''
+
+    def __init__(self, root, make_detector, max_anomalies=None):
+        self.root = root
+        self.make_detector = make_detector
+        self.max_anomalies = max_anomalies
+
+    def __call__(self, task_id, ds):
+        detector = self.make_detector()
+        path = os.path.join(self.root, detector.table, 'ds={0}'.format(ds))
+        scan = ColumnScan(path)
+        names = sorted(f[:-4] for f in os.listdir(path) if f.endswith('.npy'))
+        anomalies, flagged = detector.observe(ds, dict((n, np.asarray(scan.column(n)))
+                                                       for n in names))
+        report = os.path.join(self.root, '_anomaly', detector.table, 'ds={0}.json'.format(ds))
+        if not os.path.isdir(os.path.dirname(report)):
+            os.makedirs(os.path.dirname(report))
+        with open(report + '.tmp', 'w') as f:
+            json.dump({'anomalies': [a.to_json() for a in anomalies],
+                       'flagged_rows': np.flatnonzero(flagged).tolist()}, f)
+        os.replace(report + '.tmp', report)
+        if self.max_anomalies is not None and len(anomalies) > self.max_anomalies:
+            results = [CheckResult('anomalies', False, repr(a)) for a in anomalies[:5]]
+            raise DataQualityError(detector.table, ds, results, path)
+        return anomalies
+
+
+def synthetic_partition(ds, day, markets, rng, base):
+    '''dim_total_bookings-shaped day: market, bookings with weekly seasonality and noise.'''
+    season = 1.0 + 0.3 * (weekday(ds) >= 5)
+    trend = 1.0 + 0.002 * day
+    values = base * season * trend * rng.lognormal(0, 0.05, markets)
+    names = np.array(['market_{0}'.format(i) for i in range(markets)])
+    subs = np.array(['free', 'awesome', 'pluses'])[rng.choice(3, markets, p=[0.6, 0.3, 0.1])]
+    return {'dim_market': names, 'm_bookings': np.round(values), 'subscription_type': subs}
+
+
+def inject(columns, kind, rng):
+    '''Change a partition in place; returns what a detector should report.'''
+    if kind == 'spike':
+        i = int(rng.integers(len(columns['m_bookings'])))
+        columns['m_bookings'][i] *= 6
+        return ('outlier', columns['dim_market'][i])
+    if kind == 'unseen':
+        name = 'market_new_{0}'.format(int(rng.integers(1 << 30)))
+        columns['dim_market'] = columns['dim_market'].astype(object)
+        columns['dim_market'][int(rng.integers(len(columns['dim_market'])))] = name
+        columns['dim_market'] = columns['dim_market'].astype(str)
+        return ('unseen', name)
+    if kind == 'drop':
+        keep = len(columns['m_bookings']) // 2
+        for name in list(columns):
+            columns[name] = columns[name][:keep]
+        return ('table', 'rows')
+    if kind == 'shift':
+        sub = columns['subscription_type']
+        sub[rng.random(len(sub)) < 0.5] = 'pluses'
+        return ('share', 'pluses')
+    raise ValueError(kind)
+
+
+def _reread_history(root, ds, days=28, threshold=4.0):
+    '''Today's way: reread four weeks of partitions for per-market mean and std.'''
+    history = []
+    for back in range(1, days + 1):
+        path = os.path.join(root, 'dim_total_bookings', 'ds={0}'.format(ds_add(ds, -back)))
+        if os.path.isdir(path):
+            history.append((np.load(os.path.join(path, 'dim_market.npy')),
+                            np.load(os.path.join(path, 'm_bookings.npy'))))
+    path = os.path.join(root, 'dim_total_bookings', 'ds={0}'.format(ds))
+    markets = np.load(os.path.join(path, 'dim_market.npy'))
+    values = np.load(os.path.join(path, 'm_bookings.npy'))
+    if not history:
+        return 0
+    all_markets = np.concatenate([h[0] for h in history])
+    all_values = np.concatenate([h[1] for h in history])
+    labels, inv = np.unique(all_markets, return_inverse=True)
+    n = np.bincount(inv)
+    mean = np.bincount(inv, weights=all_values) / n
+    var = np.bincount(inv, weights=all_values ** 2) / n - mean ** 2
+    pos = np.minimum(np.searchsorted(labels, markets), len(labels) - 1)
+    z = (values - mean[pos]) / np.sqrt(np.maximum(var[pos], 1e-9))
+    return int((np.abs(z) > threshold).sum())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='streaming anomaly detection')
+    parser.add_argument('--days', type=int, default=120)
+    parser.add_argument('--markets', type=int, default=2000)
+    parser.add_argument('--rate', type=float, default=0.1,
+                        help='fraction of days with an injected anomaly')
+    parser.add_argument('--threshold', type=float, default=5.0,
+                        help='z-score above which a value is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(args.seed)
+    tmp = tempfile.mkdtemp(prefix='anomaly-')
+    try:
+        ds_list = ds_range('2018-01-01', ds_add('2018-01-01', args.days - 1))
+        base = rng.lognormal(5, 1, args.markets)
+        injected = {}
+        for day, ds in enumerate(ds_list):
+            columns = synthetic_partition(ds, day, args.markets, rng, base)
+            if day >= 14 and rng.random() < args.rate:
+                kind = ['spike', 'unseen', 'drop', 'shift'][int(rng.integers(4))]
+                injected[ds] = inject(columns, kind, rng)
+            write_partition(os.path.join(tmp, 'dim_total_bookings', 'ds={0}'.format(ds)), columns)
+
+        make = lambda: AnomalyDetector(tmp, 'dim_total_bookings', sums=['m_bookings'],
+                                       keyed=[('dim_market', 'm_bookings')],
+                                       categories=['subscription_type'],
+                                       threshold=args.threshold)
+        task = AnomalyTask(tmp, make)
+        found, false, t = {}, 0, time.time()
+        for ds in ds_list:
+            anomalies = task('anomaly_dim_total_bookings', ds)
+            hits = set((a.kind, a.key if a.kind != 'table' else a.column) for a in anomalies)
+            if ds in injected and injected[ds] in hits:
+                found[ds] = injected[ds]
+                hits.discard(injected[ds])
+            false += len(hits)
+        streaming = (time.time() - t) / len(ds_list)
+
+        t = time.time()
+        for ds in ds_list:
+            _reread_history(tmp, ds)
+        reread = (time.time() - t) / len(ds_list)
+
+        state = os.path.getsize(make().state_path)
+        print('{0} days x {1} markets, {2} injected anomalies'.format(
+            args.days, args.markets, len(injected)))
+        for kind in ('outlier', 'unseen', 'table', 'share'):
+            total = sum(1 for v in injected.values() if v[0] == kind)
+            if total:
+                print('  {0:<8} caught {1}/{2}'.format(
+                    kind, sum(1 for v in found.values() if v[0] == kind), total))
+        reported = len(found) + false
+        print('  precision {0}/{1} ({2:.0%}) at threshold {3:g}: {4} false alarms, '
+              '{5:.2f} per partition, 1 per {6:.0f} rows scored'.format(
+                  len(found), reported, len(found) / float(max(reported, 1)), args.threshold,
+                  false, false / float(len(ds_list)),
+                  args.markets * len(ds_list) / float(max(false, 1))))
+        print('streaming state: {0:7.2f} ms per partition, state file {1:.0f} KB'.format(
+            1000 * streaming, state / 1024.0))
+        print('reread 28 days:  {0:7.2f} ms per partition (outliers only)'.format(1000 * reread))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
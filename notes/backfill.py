@@ -0,0 +1,379 @@
+'''
+Parallel backfill of ds partitions
+
+The guide says datestamp partitions let us "parallelize
+backfilling", but a backfill driven one ds at a time
+through the scheduler is strictly serial. This runner
+takes a ds range and works out which (task, ds)
+partitions can run at the same time:
+
+    - a task whose HQL reads its own table at
+      DATE_SUB('{{ ds }}', n) chains on itself: ds
+      can only run once ds - n is done. The incremental
+      dim_total_bookings load is the example here.
+
+    - a task that reads another task's table at
+      DATE_SUB('{{ ds }}', n) waits for that task's
+      ds - n partition, even when the two are not
+      wired together in `deps`.
+
+    - a task that only reads upstream partitions of
+      the same ds is independent across days; every
+      ds can run at once.
+
+    - tasks wired together in `deps` still run in
+      dependency order inside a single ds.
+
+Past reads are found with a regex over the .hql files,
+which only knows the FROM <table> WHERE ds =
+DATE_SUB('{{ ds }}', n) form; a past read hidden in a
+JOIN or a subquery has to be declared with
+--depends-on-past or --reads-past.
+
+Ready partitions are handed to a bounded process pool.
+Every finished partition is appended to a checkpoint
+file, so a killed backfill started again with the same
+checkpoint only runs what is missing.
+
+    python backfill.py 2018-02-09 2019-02-08 \\
+        --workers 8 \\
+        --checkpoint anatomy_of_a_dag.ckpt \\
+        --command 'hive -hiveconf ds={ds} -f hql/{task}.hql'
+'''
+import argparse
+import heapq
+import os
+import re
+import shlex
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime, timedelta
+
+from dag_spec import DagSpec
+
+DS_FORMAT = '%Y-%m-%d'
+
+
+def ds_add(ds, days):
+    return (datetime.strptime(ds, DS_FORMAT) + timedelta(days=days)).strftime(DS_FORMAT)
+
+
+def ds_range(start, end):
+    '''Every ds from start to end, both included.'''
+    first = datetime.strptime(start, DS_FORMAT)
+    last = datetime.strptime(end, DS_FORMAT)
+    if last < first:
+        raise ValueError('end {0} is before start {1}'.format(end, start))
+    return [(first + timedelta(days=i)).strftime(DS_FORMAT)
+            for i in range((last - first).days + 1)]
+
+
+_COMMENT = re.compile(r'--[^\n]*')
+_TARGET = re.compile(r'INSERT\s+OVERWRITE\s+TABLE\s+(\w+)', re.I)
+_PAST_READ = re.compile(
+        r'FROM\s+(\w+)\s+WHERE\s+ds\s*=\s*DATE_SUB\(\s*'
+        r"'\{\{\s*ds\s*\}\}'\s*,\s*(\d+)\s*\)", re.I)
+
+
+def self_dependency_lag(hql):
+    '''
+    Return n when the query overwrites a table and also
+    reads that same table at DATE_SUB('{{ ds }}', n),
+    i.e. ds depends on ds - n of itself. Return 0 when
+    the query does not read its own past.
+    '''
+    hql = _COMMENT.sub('', hql)
+    target = _TARGET.search(hql)
+    if target is None:
+        return 0
+    lags = [int(n) for table, n in _PAST_READ.findall(hql)
+            if table.lower() == target.group(1).lower()]
+    return min(lags) if lags else 0
+
+
+def cross_task_lags(hql_by_task):
+    '''
+    {task_id: [(other_task_id, n)]} for every task that
+    reads the table another task overwrites at
+    DATE_SUB('{{ ds }}', n). Reads of a table no task in
+    hql_by_task writes, and reads of a task's own table
+    (see self_dependency_lag), are left out.
+    '''
+    writers, reads = {}, {}
+    for task_id, hql in hql_by_task.items():
+        hql = _COMMENT.sub('', hql)
+        target = _TARGET.search(hql)
+        if target is not None:
+            writers[target.group(1).lower()] = task_id
+        reads[task_id] = [(table.lower(), int(n)) for table, n in _PAST_READ.findall(hql)]
+    lags = {}
+    for task_id, past in reads.items():
+        edges = sorted(set((writers[table], n) for table, n in past
+                           if writers.get(table, task_id) != task_id))
+        if edges:
+            lags[task_id] = edges
+    return lags
+
+
+def _read_hql(spec, root=None):
+    hql = {}
+    for task_id in spec.task_ids:
+        path = spec.hql_path(task_id, root) if root else spec.hql_path(task_id)
+        if os.path.exists(path):
+            with open(path) as f:
+                hql[task_id] = f.read()
+    return hql
+
+
+def detect_lags(spec, root=None):
+    '''Self-dependency lag for every task whose .hql file is on disk.'''
+    lags = {}
+    for task_id, hql in _read_hql(spec, root).items():
+        lag = self_dependency_lag(hql)
+        if lag:
+            lags[task_id] = lag
+    return lags
+
+
+def detect_cross_lags(spec, root=None):
+    '''cross_task_lags() over every .hql file of the DAG that is on disk.'''
+    return cross_task_lags(_read_hql(spec, root))
+
+
+def plan(task_ids, ds_list, upstream=None, lags=None, cross_lags=None):
+    '''
+    Build {(task_id, ds): set of prerequisite partitions}
+    for the backfill. Only prerequisites inside the
+    backfill are kept: partitions from before the range
+    and sensor inputs are assumed to exist already.
+    `cross_lags` is {task_id: [(other_task_id, n)]}, as
+    returned by cross_task_lags().
+    '''
+    upstream = upstream or {}
+    lags = lags or {}
+    cross_lags = cross_lags or {}
+    task_set = set(task_ids)
+    ds_set = set(ds_list)
+    graph = {}
+    for task_id in task_ids:
+        parents = [u for u in upstream.get(task_id, []) if u in task_set]
+        lag = lags.get(task_id, 0)
+        past = [(u, n) for u, n in cross_lags.get(task_id, []) if u in task_set]
+        for ds in ds_list:
+            prereqs = set((u, ds) for u in parents)
+            if lag:
+                prev = ds_add(ds, -lag)
+                if prev in ds_set:
+                    prereqs.add((task_id, prev))
+            for u, n in past:
+                prev = ds_add(ds, -n)
+                if prev in ds_set:
+                    prereqs.add((u, prev))
+            graph[(task_id, ds)] = prereqs
+    return graph
+
+
+def describe_plan(graph):
+    '''Count partitions that can start right away and those that chain.'''
+    roots = sum(1 for prereqs in graph.values() if not prereqs)
+    return {'partitions': len(graph), 'independent': roots, 'chained': len(graph) - roots}
+
+
+class Checkpoint(object):
+    '''
+    Append-only record of finished partitions, one
+    "task_id<TAB>ds" line each. Lines are flushed and
+    fsync'd as they are written, so a kill -9 loses at
+    most the partitions that were still running.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    parts = line.rstrip('\n').split('\t')
+                    if len(parts) == 2:
+                        self.done.add(tuple(parts))
+        self._f = open(path, 'a') if path else None
+
+    def __contains__(self, node):
+        return node in self.done
+
+    def mark(self, node):
+        self.done.add(node)
+        if self._f is not None:
+            self._f.write('{0}\t{1}\n'.format(*node))
+            self._f.flush()
+            os.fsync(self._f.fileno())
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+
+class ShellRunner(object):
+    '''
+    Run one partition as a shell command. `{task}` and
+    `{ds}` in the template are filled in per partition.
+    Picklable, so it can be shipped to pool workers.
+    '''
+
+    def __init__(self, template):
+        self.template = template
+
+    def __call__(self, task_id, ds):
+        cmd = self.template.format(task=task_id, ds=ds)
+        subprocess.check_call(shlex.split(cmd))
+
+
+class SleepRunner(object):
+    '''Stand-in partition that just takes `seconds` to run.'''
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def __call__(self, task_id, ds):
+        time.sleep(self.seconds)
+
+
+class BackfillReport(object):
+
+    def __init__(self, done, skipped, failed, blocked, elapsed):
+        self.done = done
+        self.skipped = skipped
+        self.failed = failed
+        self.blocked = blocked
+        self.elapsed = elapsed
+
+    @property
+    def partitions_per_minute(self):
+        if self.elapsed <= 0:
+            return 0.0
+        return len(self.done) * 60.0 / self.elapsed
+
+    def __str__(self):
+        return ('{0} partitions in {1:.1f}s ({2:.1f} partitions/min), '
+                '{3} already checkpointed, {4} failed, {5} blocked').format(
+                        len(self.done), self.elapsed, self.partitions_per_minute,
+                        len(self.skipped), len(self.failed), len(self.blocked))
+
+
+def run_backfill(graph, run_partition, max_workers=4, checkpoint=None, log=None):
+    '''
+    Run every partition in `graph` (see plan()) with at
+    most `max_workers` processes. `run_partition` is
+    called as run_partition(task_id, ds) in a worker and
+    must be picklable. A failed partition blocks its
+    dependents but not the rest of the backfill.
+    '''
+    log = log or (lambda msg: None)
+    ckpt = checkpoint if isinstance(checkpoint, Checkpoint) else Checkpoint(checkpoint)
+    skipped = [node for node in graph if node in ckpt]
+    finished = set(skipped)
+    failed, blocked, done = [], set(), []
+
+    waiting = {}
+    dependents = {}
+    for node, prereqs in graph.items():
+        if node in finished:
+            continue
+        pending = set(p for p in prereqs if p not in finished)
+        waiting[node] = pending
+        for p in pending:
+            dependents.setdefault(p, []).append(node)
+    ready = [node for node, pending in waiting.items() if not pending]
+    heapq.heapify(ready)
+
+    def block(node):
+        stack = [node]
+        while stack:
+            for child in dependents.get(stack.pop(), []):
+                if child not in blocked:
+                    blocked.add(child)
+                    stack.append(child)
+
+    start = time.time()
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            running = {}
+            while ready or running:
+                while ready and len(running) < max_workers:
+                    node = heapq.heappop(ready)
+                    running[pool.submit(run_partition, *node)] = node
+                finished_now, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished_now:
+                    node = running.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        failed.append((node, error))
+                        block(node)
+                        log('FAILED {0} ds={1}: {2}'.format(node[0], node[1], error))
+                        continue
+                    ckpt.mark(node)
+                    done.append(node)
+                    for child in dependents.get(node, []):
+                        pending = waiting[child]
+                        pending.discard(node)
+                        if not pending and child not in blocked:
+                            heapq.heappush(ready, child)
+                    log('done {0} ds={1} ({2}/{3})'.format(
+                        node[0], node[1], len(done), len(waiting)))
+    finally:
+        if ckpt is not checkpoint:
+            ckpt.close()
+    return BackfillReport(done, skipped, failed, sorted(blocked), time.time() - start)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('start')
+    parser.add_argument('end')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--checkpoint', default=None)
+    parser.add_argument('--task', action='append', default=None,
+                        help='restrict to these task_ids (default: all in the DAG)')
+    parser.add_argument('--depends-on-past', action='append', default=[],
+                        metavar='TASK[:LAG]',
+                        help='mark a task as reading its own ds - LAG partition')
+    parser.add_argument('--reads-past', action='append', default=[],
+                        metavar='TASK:UPSTREAM[:LAG]',
+                        help="mark a task as reading UPSTREAM's ds - LAG partition")
+    parser.add_argument('--hql-root', default=None,
+                        help='where hql/<task>.hql lives, used to detect DATE_SUB reads')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--command', help="e.g. 'hive -hiveconf ds={ds} -f hql/{task}.hql'")
+    group.add_argument('--simulate', type=float, metavar='SECONDS',
+                       help='sleep instead of running anything, to try out the planner')
+    args = parser.parse_args(argv)
+
+    spec = DagSpec.from_file()
+    task_ids = args.task or spec.task_ids
+    lags = detect_lags(spec, args.hql_root)
+    for item in args.depends_on_past:
+        task_id, _, lag = item.partition(':')
+        lags[task_id] = int(lag or 1)
+    cross_lags = detect_cross_lags(spec, args.hql_root)
+    for item in args.reads_past:
+        task_id, _, rest = item.partition(':')
+        source, _, lag = rest.partition(':')
+        if not source:
+            parser.error('--reads-past expects TASK:UPSTREAM[:LAG], got {0}'.format(item))
+        cross_lags.setdefault(task_id, []).append((source, int(lag or 1)))
+
+    graph = plan(task_ids, ds_range(args.start, args.end), spec.deps, lags, cross_lags)
+    print('plan: {partitions} partitions, {independent} ready now, {chained} chained'.format(
+        **describe_plan(graph)))
+    runner = ShellRunner(args.command) if args.command else SleepRunner(args.simulate)
+    report = run_backfill(graph, runner, args.workers, args.checkpoint,
+                          log=lambda msg: print(msg, file=sys.stderr))
+    print(report)
+    return 1 if report.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,352 @@
+'''
+Change data capture into ds partitions
+
+The 500px notes keep users, photos and purchases in
+MySQL and copy them into the warehouse every night. A
+full dump reads and writes every row of the table to
+pick up the 1% that changed.
+
+CDC ingestion reads the row changes instead:
+
+    BinlogWriter / BinlogReader
+        a file-based stand-in for a row-based MySQL
+        binlog: segment files binlog.000001, ... of one
+        JSON event per line, each with the full row after
+        the change (or the key, for a delete). A position
+        is (segment, byte offset), like binlog coordinates.
+
+    CdcIngestor
+        reads the events of a day in batches, keeps only
+        the last event per key, and writes the day as
+        SnapshotStore.write_changes(): the previous
+        snapshot with the changes upserted. The binlog
+        position is saved in the snapshot's manifest, so
+        the data and the position move together and a
+        restarted ingestor carries on where the last ds
+        ended.
+
+Every ds is still a complete snapshot of the dimension
+(SnapshotStore), read lazily, or exported as a plain
+partition with export().
+
+    python cdc.py --rows 1000000 --days 7 --change-rate 0.01
+
+loads the initial dump, then compares each day of CDC
+with a full dump and load of the table, both reading
+rows in the same JSON row format.
+'''
+import argparse
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from backfill import ds_add, ds_range
+from snapshot_store import SnapshotStore, evolve, synthetic_users
+from stage_check_exchange import write_partition
+
+INSERT, UPDATE, DELETE = 'I', 'U', 'D'
+
+
+def _segment_name(n):
+    return 'binlog.{0:06d}'.format(n)
+
+
+class BinlogWriter(object):
+    '''
+    Append row events to a binlog directory.
+
+        log = BinlogWriter(path)
+        log.append('users', UPDATE, '2015-01-02 10:00:00', row)
+        log.close()
+
+    Events are only visible to readers once flushed; a
+    segment is rotated once it passes max_bytes.
+    '''
+
+    def __init__(self, path, max_bytes=64 << 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        segments = sorted(f for f in os.listdir(path) if f.startswith('binlog.'))
+        self.segment = int(segments[-1].split('.')[1]) if segments else 1
+        self._file = open(os.path.join(path, _segment_name(self.segment)), 'a')
+
+    def append(self, table, op, ts, row):
+        if op not in (INSERT, UPDATE, DELETE):
+            raise ValueError('unknown binlog op {0!r}'.format(op))
+        self._file.write(json.dumps({'table': table, 'op': op, 'ts': ts, 'row': row},
+                                    separators=(',', ':')))
+        self._file.write('\n')
+        if self._file.tell() >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        self._file.close()
+        self.segment += 1
+        self._file = open(os.path.join(self.path, _segment_name(self.segment)), 'a')
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class BinlogReader(object):
+    '''
+    Events from a position on, in batches:
+
+        reader = BinlogReader(path, position=(1, 0))
+        for batch in reader.batches(10000):
+            ...
+        reader.position        -> after the last event read
+
+    Only complete lines are returned, so a reader never
+    sees half an event that the writer is still writing.
+    '''
+
+    def __init__(self, path, position=(1, 0)):
+        self.path = path
+        self.position = tuple(position)
+
+    def _segments(self):
+        names = [f for f in os.listdir(self.path) if f.startswith('binlog.')]
+        return sorted(int(n.split('.')[1]) for n in names)
+
+    def batches(self, size=10000):
+        segment, offset = self.position
+        for n in self._segments():
+            if n < segment:
+                continue
+            with open(os.path.join(self.path, _segment_name(n)), 'rb') as f:
+                f.seek(offset if n == segment else 0)
+                batch = []
+                while True:
+                    line = f.readline()
+                    if not line.endswith(b'\n'):
+                        break
+                    batch.append(json.loads(line))
+                    if len(batch) == size:
+                        self.position = (n, f.tell())
+                        yield batch
+                        batch = []
+                self.position = (n, f.tell() - len(line))
+                if batch:
+                    yield batch
+
+
+class CdcIngestor(object):
+    '''
+    Materialize a dimension's daily snapshots from the
+    binlog.
+
+        ingest = CdcIngestor(root, binlog, 'users', 'user_id')
+        ingest.load('2015-01-01', dump)       # once
+        ingest.run('2015-01-02')              # every day
+
+    run(ds) applies the events with ts before the end of
+    ds; later events stay in the log for the next day.
+    '''
+
+    def __init__(self, root, binlog, table, key, batch_size=50000):
+        self.binlog = binlog
+        self.table = table
+        self.key = key
+        self.batch_size = batch_size
+        self.store = SnapshotStore(root, table, key)
+        self.batches = 0
+        self.events = 0
+
+    def position(self):
+        written = self.store.partitions()
+        if not written:
+            return None
+        return tuple(self.store._read_manifest(written[-1])['meta']['position'])
+
+    def load(self, ds, dump, position=(1, 0)):
+        '''The initial full dump, taken at binlog `position`.'''
+        return self.store.write(ds, dump, meta={'position': list(position), 'events': 0})
+
+    def _columns(self, rows, names, like):
+        columns = {}
+        for n in names:
+            values = np.array([r[n] for r in rows]) if rows else like[n][:0]
+            dtype = like[n].dtype
+            if dtype.kind in 'US' and values.dtype.kind in 'US':
+                # a longer string widens the column instead of being cut short
+                dtype = np.result_type(dtype, values.dtype)
+            columns[n] = values.astype(dtype, copy=False)
+        return columns
+
+    def run(self, ds):
+        position = self.position()
+        if position is None:
+            raise ValueError('{0}: load() a full dump before ds={1}'.format(self.table, ds))
+        end = ds_add(ds, 1)
+        reader = BinlogReader(self.binlog, position)
+        latest = {}
+        stop = None
+        for batch in reader.batches(self.batch_size):
+            self.batches += 1
+            for i, event in enumerate(batch):
+                if event['ts'] >= end:
+                    stop = batch[i:]
+                    break
+                if event['table'] == self.table:
+                    # the last event per key wins; earlier ones are overwritten
+                    latest[event['row'][self.key]] = event
+            if stop is not None:
+                break
+        if stop is not None:
+            # back up to the first event of the next day
+            position = self._rewind(reader.position, len(stop))
+        else:
+            position = reader.position
+        self.events += len(latest)
+
+        previous = self.store._previous(ds)[2]
+        names = sorted(previous)
+        upserts = [e['row'] for e in latest.values() if e['op'] != DELETE]
+        deleted = [k for k, e in latest.items() if e['op'] == DELETE]
+        changed = self._columns(upserts, names, previous)
+        return self.store.write_changes(ds, changed, deleted,
+                                        meta={'position': list(position), 'events': len(latest)})
+
+    def _rewind(self, position, events):
+        '''The position `events` complete lines before `position`.'''
+        segment, offset = position
+        path = os.path.join(self.binlog, _segment_name(segment))
+        with open(path, 'rb') as f:
+            head = f.read(offset)
+        cut = len(head)
+        for _ in range(events):
+            cut = head.rfind(b'\n', 0, cut - 1) + 1
+        return (segment, cut)
+
+    def snapshot(self, ds):
+        return self.store.snapshot(ds)
+
+    def export(self, ds, root):
+        '''Write ds as a plain <root>/<table>/ds=<ds>/ partition of .npy columns.'''
+        path = os.path.join(root, self.table, 'ds={0}'.format(ds))
+        write_partition(path, self.snapshot(ds).to_columns())
+        return path
+
+
+def emit_changes(log, table, key, before, after, ds, rng):
+    '''Binlog events that turn `before` into `after`, at random times of ds.'''
+    old, new = before[key], after[key]
+    names = sorted(after)
+    pos = np.minimum(np.searchsorted(old, new), len(old) - 1)
+    existed = old[pos] == new
+    changed = ~existed
+    for n in names:
+        changed |= after[n] != before[n][pos]
+    gone = old[~np.isin(old, new)]
+    rows = np.flatnonzero(changed)
+    ops = [(int(rng.integers(86400)), UPDATE if existed[i] else INSERT, i) for i in rows]
+    ops += [(int(rng.integers(86400)), DELETE, k) for k in gone]
+    ops.sort(key=lambda o: o[0])
+    for second, op, i in ops:
+        ts = '{0} {1:02d}:{2:02d}:{3:02d}'.format(ds, second // 3600, second // 60 % 60, second % 60)
+        if op == DELETE:
+            row = {key: i.item()}
+        else:
+            row = dict((n, after[n][i].item()) for n in names)
+        log.append(table, op, ts, row)
+    return len(ops)
+
+
+def full_dump_and_load(source, root, ds):
+    '''
+    The nightly job: dump every row of the source table
+    in the binlog's row format, then parse it and load it
+    as the ds partition.
+    '''
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    dump = os.path.join(root, 'dump.json')
+    names = sorted(source)
+    with open(dump, 'w') as f:
+        for start in range(0, len(source[names[0]]), 1000000):
+            columns = [source[n][start:start + 1000000].tolist() for n in names]
+            for row in zip(*columns):
+                f.write(json.dumps(dict(zip(names, row)), separators=(',', ':')))
+                f.write('\n')
+    parts = dict((n, []) for n in names)
+    with open(dump) as f:
+        while True:
+            rows = [json.loads(line) for line in itertools.islice(f, 1000000)]
+            if not rows:
+                break
+            for n in names:
+                parts[n].append(np.array([r[n] for r in rows], dtype=source[n].dtype))
+    loaded = dict((n, np.concatenate(parts[n])) for n in names)
+    write_partition(os.path.join(root, 'users', 'ds={0}'.format(ds)), loaded)
+    os.remove(dump)
+
+
+def _bytes(path):
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='CDC ingestion against full dumps')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--change-rate', type=float, default=0.01)
+    parser.add_argument('--batch-size', type=int, default=50000)
+    args = parser.parse_args(argv)
+
+    tmp = tempfile.mkdtemp(prefix='cdc-')
+    try:
+        rng = np.random.default_rng(0)
+        days = ds_range('2015-01-01', ds_add('2015-01-01', args.days))
+        users = synthetic_users(args.rows)
+        log = BinlogWriter(os.path.join(tmp, 'binlog'))
+        ingest = CdcIngestor(os.path.join(tmp, 'cdc'), log.path, 'users', 'user_id',
+                             batch_size=args.batch_size)
+        t = time.time()
+        ingest.load(days[0], users)
+        initial = time.time() - t
+
+        full = cdc = 0.0
+        events = 0
+        for ds in days[1:]:
+            after = evolve(users, rng, args.change_rate)
+            events += emit_changes(log, 'users', 'user_id', users, after, ds, rng)
+            log.flush()
+            users = after
+
+            t = time.time()
+            full_dump_and_load(users, os.path.join(tmp, 'full'), ds)
+            full += time.time() - t
+            t = time.time()
+            ingest.run(ds)
+            cdc += time.time() - t
+
+        log.close()
+        rebuilt = ingest.snapshot(days[-1]).to_columns()
+        for name, values in users.items():
+            assert (rebuilt[name] == values).all(), name
+        n = len(days) - 1
+        print('{0} users, {1} days at {2:.1%} changes: {3} binlog events ({4:.1f} MB)'.format(
+            args.rows, n, args.change_rate, events, _bytes(log.path) / 1e6))
+        print('initial load:       {0:7.2f}s'.format(initial))
+        print('full dump and load: {0:7.2f}s per day, {1:8.1f} MB stored'.format(
+            full / n, _bytes(os.path.join(tmp, 'full')) / 1e6))
+        print('cdc:                {0:7.2f}s per day, {1:8.1f} MB stored, {2:.1f}x faster'.format(
+            cdc / n, _bytes(os.path.join(tmp, 'cdc')) / 1e6, full / max(cdc, 1e-9)))
+        print('last snapshot matches the source table')
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,508 @@
+'''
+An encoding columnar writer for denormalized facts
+
+The rise-of-the-data-engineer notes say denormalizing
+dimension attributes into fact tables is cheap because
+Parquet and ORC "have been taught to normalize the data
+for storage of their own". Our partitions are plain
+.npy columns (write_partition), so every dim_market
+string is stored in full on every row.
+
+write_table() stores a partition as one file of row
+groups. Each column chunk of a row group is stored with
+whichever of these is smallest for it:
+
+    plain   the raw values (bools bit-packed)
+    for     integers minus the chunk minimum, in the
+            narrowest unsigned type that fits
+    delta   the first value and the differences, packed
+            like `for`: sorted ids and timestamps
+    rle     run values and run lengths
+    dict    the sorted distinct values and a code per
+            row, the codes themselves stored as for/rle
+
+then zlib-compressed. How well that works depends on
+the row order, and a fact table has no meaningful one,
+so each partition is sorted by the columns that
+compress best: low-cardinality columns are added to
+the sort keys greedily, as long as they shrink a stored
+sample of the partition. Row groups are
+encoded in parallel on a thread pool (NumPy and zlib
+release the GIL) and written in order.
+
+The footer keeps min/max per chunk, so ColumnarFile
+skips row groups on equality filters, and compares
+dictionary-encoded columns on their codes.
+
+    python columnar_writer.py --rows 2000000
+
+writes fct_bookings- and likes-shaped partitions both
+ways and reports size, write throughput and scan time.
+'''
+import argparse
+import json
+import os
+import shutil
+import struct
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from stage_check_exchange import write_partition
+
+MAGIC = b'NCOL1\n'
+_UINTS = (np.uint8, np.uint16, np.uint32, np.uint64)
+
+
+def _narrowest(span):
+    for dtype in _UINTS:
+        if span <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+class _Buffers(object):
+    '''The byte buffers of one chunk; encoded nodes refer to them by index.'''
+
+    def __init__(self):
+        self.parts = []
+
+    def add(self, data):
+        self.parts.append(data)
+        return len(self.parts) - 1
+
+
+def _for(values, out):
+    values = values.astype(np.int64)
+    base = int(values.min()) if len(values) else 0
+    # the span of an int64 chunk can overflow int64; uint64 arithmetic wraps correctly
+    shifted = values.astype(np.uint64) - np.uint64(base & 0xFFFFFFFFFFFFFFFF)
+    dtype = _narrowest(int(shifted.max()) if len(values) else 0)
+    return {'enc': 'for', 'base': base, 'dtype': np.dtype(dtype).str,
+            'buf': out.add(shifted.astype(dtype).tobytes())}
+
+
+def _delta(values, out):
+    values = values.astype(np.int64)
+    return {'enc': 'delta', 'first': int(values[0]), 'diffs': _for(np.diff(values), out)}
+
+
+def _runs(values):
+    starts = np.flatnonzero(values[1:] != values[:-1]) + 1
+    starts = np.concatenate([[0], starts])
+    return starts, np.diff(np.append(starts, len(values)))
+
+
+def _rle(values, out, inner):
+    starts, lengths = _runs(values)
+    return {'enc': 'rle', 'values': inner(values[starts], out), 'lengths': _for(lengths, out)}
+
+
+def _plain(values, out):
+    if values.dtype == np.bool_:
+        return {'enc': 'bits', 'n': len(values), 'buf': out.add(np.packbits(values).tobytes())}
+    return {'enc': 'plain', 'dtype': values.dtype.str,
+            'buf': out.add(np.ascontiguousarray(values).tobytes())}
+
+
+def _smallest(candidates):
+    '''Encode with every candidate; keep the node whose buffers are smallest.'''
+    best = None
+    for encode in candidates:
+        out = _Buffers()
+        node = encode(out)
+        size = sum(len(p) for p in out.parts)
+        if best is None or size < best[0]:
+            best = (size, node, out)
+    return best[1], best[2]
+
+
+def _encode_ints(values, out):
+    node, inner = _smallest([
+        lambda o: _for(values, o),
+        lambda o: _delta(values, o),
+        lambda o: _rle(values, o, lambda v, oo: _for(v, oo)),
+        ])
+    return _graft(node, inner, out)
+
+
+def _graft(node, inner, out):
+    '''Move a node encoded into its own buffers into `out`.'''
+    shift = len(out.parts)
+    out.parts.extend(inner.parts)
+
+    def renumber(n):
+        n = dict(n)
+        if 'buf' in n:
+            n['buf'] += shift
+        for key, value in n.items():
+            if isinstance(value, dict):
+                n[key] = renumber(value)
+        return n
+    return renumber(node)
+
+
+def _dict(values, out):
+    uniques, codes = np.unique(values, return_inverse=True)
+    return {'enc': 'dict', 'dictionary': _plain(uniques, out), 'codes': _encode_ints(codes, out)}
+
+
+def _repeats(values, sample=4096):
+    '''Whether integers repeat enough for a dictionary to be worth sorting them for.'''
+    step = max(1, len(values) // sample)
+    probe = values[::step]
+    return len(np.unique(probe)) <= len(probe) // 2
+
+
+def encode_column(values):
+    '''(node, buffers) of the smallest encoding of one column chunk.'''
+    values = np.asarray(values)
+    kind = values.dtype.kind
+    if not len(values):
+        candidates = [lambda o: _plain(values, o)]
+    elif kind == 'b':
+        candidates = [lambda o: _plain(values, o),
+                      lambda o: _rle(values, o, lambda v, oo: _plain(v, oo))]
+    elif kind in 'iu':
+        candidates = [lambda o: _encode_ints(values, o)]
+    elif kind in 'US':
+        candidates = [lambda o: _dict(values, o)]
+    else:
+        candidates = [lambda o: _plain(values, o), lambda o: _dict(values, o),
+                      lambda o: _rle(values, o, lambda v, oo: _plain(v, oo))]
+    if kind in 'iu' and len(values) and _repeats(values):
+        candidates.append(lambda o: _dict(values, o))
+    node, out = _smallest(candidates)
+    return node, out.parts
+
+
+def decode_node(node, parts):
+    enc = node['enc']
+    if enc == 'plain':
+        return np.frombuffer(parts[node['buf']], dtype=node['dtype'])
+    if enc == 'bits':
+        return np.unpackbits(np.frombuffer(parts[node['buf']], dtype=np.uint8),
+                             count=node['n']).astype(bool)
+    if enc == 'for':
+        packed = np.frombuffer(parts[node['buf']], dtype=node['dtype'])
+        return (packed.astype(np.uint64) + np.uint64(node['base'] & 0xFFFFFFFFFFFFFFFF)).view(
+            np.int64)
+    if enc == 'delta':
+        diffs = decode_node(node['diffs'], parts)
+        out = np.empty(len(diffs) + 1, dtype=np.int64)
+        out[0] = node['first']
+        np.cumsum(diffs, out=out[1:])
+        out[1:] += node['first']
+        return out
+    if enc == 'rle':
+        return np.repeat(decode_node(node['values'], parts), decode_node(node['lengths'], parts))
+    if enc == 'dict':
+        return decode_node(node['dictionary'], parts)[decode_node(node['codes'], parts)]
+    raise ValueError('unknown encoding {0!r}'.format(enc))
+
+
+def _encodings(node):
+    '''The encodings used by a node, outermost first, e.g. dict/rle/for.'''
+    inner = [node[k] for k in ('codes', 'values', 'diffs') if isinstance(node.get(k), dict)]
+    return node['enc'] + ''.join('/' + _encodings(i) for i in inner[:1])
+
+
+def _stat(value):
+    return value.item() if hasattr(value, 'item') else value
+
+
+def _stored_size(columns, level):
+    size = 0
+    for values in columns.values():
+        payload = b''.join(encode_column(values)[1])
+        size += len(zlib.compress(payload, level) if level else payload)
+    return size
+
+
+def choose_sort(columns, sample=32768, max_keys=3, level=1, seed=0):
+    '''
+    The sort keys for a partition, picked greedily among
+    its low-cardinality columns: add the column that
+    shrinks a stored sample most, until none does.
+    '''
+    n = len(next(iter(columns.values())))
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(n, min(n, sample), replace=False))
+    part = dict((name, np.asarray(values)[rows]) for name, values in columns.items())
+    low = [c for c in sorted(part) if len(np.unique(part[c])) <= max(len(rows) // 100, 2)]
+    keys = []
+    best = _stored_size(part, level)
+    while len(keys) < max_keys:
+        tried = []
+        for c in low:
+            if c not in keys:
+                order = sort_order(part, keys + [c])
+                tried.append((_stored_size(_take(part, order), level), c))
+        if not tried or min(tried)[0] >= best:
+            break
+        best, c = min(tried)
+        keys.append(c)
+    return keys
+
+
+def _take(columns, rows):
+    return dict((name, values[rows]) for name, values in columns.items())
+
+
+def sort_order(columns, keys):
+    if not keys:
+        return np.arange(len(next(iter(columns.values()))))
+    codes = [np.unique(np.asarray(columns[k]), return_inverse=True)[1] for k in keys]
+    return np.lexsort(codes[::-1])
+
+
+def _encode_row_group(columns, names, start, stop, level):
+    chunks = []
+    for name in names:
+        values = columns[name][start:stop]
+        node, parts = encode_column(values)
+        payload = b''.join(parts)
+        if level:
+            payload = zlib.compress(payload, level)
+        meta = {'node': node, 'sizes': [len(p) for p in parts], 'zlib': bool(level)}
+        # no stats for bytes (not JSON) or an all-NaN chunk: such chunks are never skipped
+        kind = values.dtype.kind
+        if len(values) and kind == 'f':
+            if not np.isnan(values).all():
+                meta['min'], meta['max'] = _stat(np.nanmin(values)), _stat(np.nanmax(values))
+        elif len(values) and kind in 'iuU' and node['enc'] == 'dict':
+            dictionary = decode_node(node['dictionary'], parts)
+            meta['min'], meta['max'] = _stat(dictionary[0]), _stat(dictionary[-1])
+        elif len(values) and kind in 'iu':
+            meta['min'], meta['max'] = _stat(values.min()), _stat(values.max())
+        chunks.append((meta, payload))
+    return stop - start, chunks
+
+
+def write_table(path, columns, row_group_rows=262144, sort=None, workers=4, level=1):
+    '''
+    Write a partition's columns to `path`. `sort` is a
+    list of sort keys, or None to choose them. Returns
+    the footer.
+    '''
+    names = sorted(columns)
+    n = len(columns[names[0]])
+    if any(len(columns[c]) != n for c in names):
+        raise ValueError('columns of {0} have different lengths'.format(path))
+    keys = choose_sort(columns, level=level) if sort is None else list(sort)
+    order = sort_order(columns, keys)
+    data = dict((name, np.asarray(columns[name])[order]) for name in names)
+    bounds = [(s, min(s + row_group_rows, n)) for s in range(0, n, row_group_rows)] or [(0, 0)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        groups = list(pool.map(lambda b: _encode_row_group(data, names, b[0], b[1], level),
+                               bounds))
+    footer = {'columns': names, 'dtypes': dict((c, data[c].dtype.str) for c in names),
+              'rows': n, 'sort': keys, 'row_groups': []}
+    tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+        for rows, chunks in groups:
+            group = {'rows': rows, 'chunks': []}
+            for meta, payload in chunks:
+                meta = dict(meta, offset=f.tell(), length=len(payload))
+                f.write(payload)
+                group['chunks'].append(meta)
+            footer['row_groups'].append(group)
+        raw = json.dumps(footer, separators=(',', ':')).encode()
+        f.write(raw)
+        f.write(struct.pack('<Q', len(raw)))
+        f.write(MAGIC)
+    os.replace(tmp, path)
+    return footer
+
+
+class ColumnarFile(object):
+    '''
+    Read a file written by write_table().
+
+        table = ColumnarFile(path)
+        table.read(['dim_market', 'm_value'], where={'subscription_type': 'pluses'})
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            f.seek(-len(MAGIC) - 8, os.SEEK_END)
+            size = struct.unpack('<Q', f.read(8))[0]
+            f.seek(-len(MAGIC) - 8 - size, os.SEEK_END)
+            self.footer = json.loads(f.read(size))
+        self.columns = self.footer['columns']
+        self.rows = self.footer['rows']
+        self._position = dict((c, i) for i, c in enumerate(self.columns))
+
+    def _chunk(self, f, group, name):
+        meta = group['chunks'][self._position[name]]
+        f.seek(meta['offset'])
+        payload = f.read(meta['length'])
+        if meta['zlib']:
+            payload = zlib.decompress(payload)
+        parts, at = [], 0
+        for size in meta['sizes']:
+            parts.append(payload[at:at + size])
+            at += size
+        return meta['node'], parts
+
+    def _matches(self, f, group, name, value):
+        '''Row mask of column == value in a row group, on the codes when dictionary-encoded.'''
+        node, parts = self._chunk(f, group, name)
+        if node['enc'] == 'dict':
+            dictionary = decode_node(node['dictionary'], parts)
+            pos = int(np.searchsorted(dictionary, value))
+            if pos == len(dictionary) or dictionary[pos] != value:
+                return np.zeros(group['rows'], dtype=bool)
+            return decode_node(node['codes'], parts) == pos
+        return decode_node(node, parts) == value
+
+    def read(self, columns=None, where=None):
+        '''{column: values}, optionally only the rows where every where column equals its value.'''
+        columns = list(columns or self.columns)
+        where = dict(where or {})
+        out = dict((c, []) for c in columns)
+        dtypes = self.footer['dtypes']
+        with open(self.path, 'rb') as f:
+            for group in self.footer['row_groups']:
+                mask = None
+                for name, value in where.items():
+                    meta = group['chunks'][self._position[name]]
+                    if 'min' in meta and not (meta['min'] <= value <= meta['max']):
+                        mask = np.zeros(group['rows'], dtype=bool)
+                        break
+                    m = self._matches(f, group, name, value)
+                    mask = m if mask is None else mask & m
+                if mask is not None and not mask.any():
+                    continue
+                for name in columns:
+                    values = decode_node(*self._chunk(f, group, name)).astype(
+                        dtypes[name], copy=False)
+                    out[name].append(values if mask is None else values[mask])
+        return dict((c, np.concatenate(out[c]) if out[c] else np.empty(0, dtype=dtypes[c]))
+                    for c in columns)
+
+    def describe(self):
+        '''{column: (encodings of the first row group, stored bytes)}.'''
+        out = {}
+        for i, name in enumerate(self.columns):
+            chunks = [g['chunks'][i] for g in self.footer['row_groups']]
+            out[name] = (_encodings(chunks[0]['node']), sum(c['length'] for c in chunks))
+        return out
+
+
+def synthetic_fct_bookings(rows, seed=0):
+    '''fct_bookings with the listing's dimension attributes denormalized into it.'''
+    rng = np.random.default_rng(seed)
+    listings = 200000
+    id_listing = (rng.zipf(1.2, rows) % listings).astype(np.int64)
+    markets = np.array(['market_{0}'.format(i) for i in range(50)])
+    return {
+        'id_listing': id_listing,
+        'id_host': id_listing // 7,
+        'ts': np.sort(rng.integers(0, 86400, rows)).astype(np.int64) + 1518134400,
+        'dim_market': markets[(id_listing * 7919) % 50],
+        'dim_room_type': np.array(['entire_home', 'private_room', 'shared_room'])[
+            id_listing % 3],
+        'dim_is_instant_bookable': (id_listing % 5) == 0,
+        'm_bookings': (rng.random(rows) < 0.3).astype(np.int64),
+        'm_value': np.round(rng.lognormal(4.5, 0.8, rows), 2),
+        }
+
+
+def synthetic_likes(rows, users=1000000, seed=1):
+    '''likes with the user's dimension attributes denormalized into it.'''
+    rng = np.random.default_rng(seed)
+    user_id = rng.integers(1, users, rows).astype(np.int64) * 7
+    return {
+        'user_id': user_id,
+        'photo_id': rng.integers(1, 10 * rows, rows).astype(np.int64),
+        'ts': np.sort(rng.integers(0, 86400, rows)).astype(np.int64) + 1518134400,
+        'subscription_type': np.array(['free', 'awesome', 'pluses'])[user_id % 3],
+        'is_seller': (user_id % 20) == 0,
+        'has_android_app': (user_id % 10) < 3,
+        }
+
+
+def _bytes(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+def _npz_zlib(path, columns):
+    np.savez_compressed(path, **columns)
+
+
+def bench(tmp, table, columns, where, measure, workers):
+    rows = len(next(iter(columns.values())))
+    plain = os.path.join(tmp, table + '_plain')
+    t = time.time()
+    write_partition(plain, columns)
+    plain_write = time.time() - t
+    t = time.time()
+    _npz_zlib(os.path.join(tmp, table + '.npz'), columns)
+    zlib_write = time.time() - t
+    path = os.path.join(tmp, table + '.ncol')
+    t = time.time()
+    footer = write_table(path, columns, workers=workers)
+    encoded_write = time.time() - t
+
+    t = time.time()
+    loaded = dict((c, np.load(os.path.join(plain, c + '.npy'))) for c in columns)
+    plain_scan = time.time() - t
+    t = time.time()
+    table_file = ColumnarFile(path)
+    read = table_file.read()
+    encoded_scan = time.time() - t
+    order = sort_order(columns, footer['sort'])
+    for c in columns:
+        assert (read[c] == np.asarray(columns[c])[order]).all(), c
+
+    (name, value), = where.items()
+    t = time.time()
+    a = np.load(os.path.join(plain, name + '.npy'))
+    b = np.load(os.path.join(plain, measure + '.npy'))
+    plain_total = b[a == value].sum()
+    plain_filter = time.time() - t
+    t = time.time()
+    encoded_total = table_file.read([measure], where=where)[measure].sum()
+    encoded_filter = time.time() - t
+    assert np.isclose(plain_total, encoded_total)
+
+    raw = _bytes(plain)
+    print('{0}: {1} rows, sorted by {2}'.format(table, rows, ', '.join(footer['sort']) or '-'))
+    print('  plain .npy     {0:8.1f} MB  write {1:6.1f} M rows/s  scan {2:.3f}s  '
+          'filter {3:.3f}s'.format(raw / 1e6, rows / plain_write / 1e6, plain_scan, plain_filter))
+    print('  plain + zlib   {0:8.1f} MB  write {1:6.1f} M rows/s'.format(
+        _bytes(os.path.join(tmp, table + '.npz')) / 1e6, rows / zlib_write / 1e6))
+    print('  encoded        {0:8.1f} MB  write {1:6.1f} M rows/s  scan {2:.3f}s  '
+          'filter {3:.3f}s  ({4:.1f}x smaller)'.format(
+              _bytes(path) / 1e6, rows / encoded_write / 1e6, encoded_scan, encoded_filter,
+              raw / float(_bytes(path))))
+    for column, (encodings, size) in sorted(table_file.describe().items()):
+        print('    {0:<24} {1:<16} {2:8.2f} MB'.format(column, encodings, size / 1e6))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='encoding columnar writer benchmark')
+    parser.add_argument('--rows', type=int, default=2000000)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args(argv)
+
+    tmp = tempfile.mkdtemp(prefix='columnar-')
+    try:
+        bench(tmp, 'fct_bookings', synthetic_fct_bookings(args.rows),
+              {'dim_market': 'market_7'}, 'm_value', args.workers)
+        bench(tmp, 'likes', synthetic_likes(args.rows),
+              {'subscription_type': 'pluses'}, 'photo_id', args.workers)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+'''
+Critical-path scheduling for DAGs built from a deps map
+
+anatomy_of_a_dag wires its tasks with
+
+    deps = {'task_1': [...upstreams...], 'task_2': [...]}
+
+and the executor starts whatever is ready in the order
+it became ready. When the pool is full, a long task
+at the head of a long chain can wait behind a handful
+of short leaf tasks, and the whole DAG finishes later.
+
+Here every task gets a priority: its expected runtime
+plus the largest priority among its downstream tasks,
+i.e. the length of the longest chain it still has to
+drive to the end of the DAG. Expected runtimes come
+from RuntimeHistory, per task, from past runs. Ready
+tasks are dispatched highest priority first onto a
+bounded worker pool.
+
+    python critical_path.py --tasks 200 --workers 8 --runs 20
+
+replays recorded (here: synthetic) runs through a
+simulator under FIFO and critical-path dispatch and
+reports the makespans. Pass --history runs.json to
+replay real runs:
+
+    [{"run_id": "...", "durations": {"task_1": 812.0, ...}}, ...]
+'''
+import argparse
+import heapq
+import itertools
+import json
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class CycleError(ValueError):
+    pass
+
+
+def downstream_map(upstream):
+    '''Invert {task: [upstreams]} into {task: [downstreams]}, listing every task.'''
+    down = dict((t, []) for t in upstream)
+    for task, ups in upstream.items():
+        for up in ups:
+            down.setdefault(up, []).append(task)
+    return down
+
+
+def topological_order(upstream):
+    down = downstream_map(upstream)
+    indegree = dict((t, 0) for t in down)
+    for task, ups in upstream.items():
+        indegree[task] = len(ups)
+    order = [t for t in sorted(down) if indegree[t] == 0]
+    for task in order:
+        for child in down[task]:
+            indegree[child] -= 1
+            if indegree[child] == 0:
+                order.append(child)
+    if len(order) != len(down):
+        stuck = sorted(t for t, d in indegree.items() if d > 0)
+        raise CycleError('cycle through {0}'.format(', '.join(stuck[:5])))
+    return order
+
+
+class RuntimeHistory(object):
+    '''
+    Past runtimes per task. estimate() is a high
+    percentile of the recent runs, so a task that is
+    sometimes slow is planned as slow.
+    '''
+
+    def __init__(self, window=30, percentile=0.75, default=60.0):
+        self.window = window
+        self.percentile = percentile
+        self.default = default
+        self.runs = {}
+
+    def record(self, task_id, seconds):
+        runs = self.runs.setdefault(task_id, [])
+        runs.append(float(seconds))
+        if len(runs) > self.window:
+            del runs[0]
+
+    def record_run(self, durations):
+        for task_id, seconds in durations.items():
+            self.record(task_id, seconds)
+
+    def estimate(self, task_id):
+        runs = self.runs.get(task_id)
+        if not runs:
+            return self.default
+        ordered = sorted(runs)
+        return ordered[min(len(ordered) - 1, int(self.percentile * len(ordered)))]
+
+    def to_json(self):
+        return {'window': self.window, 'percentile': self.percentile,
+                'default': self.default, 'runs': self.runs}
+
+    @classmethod
+    def from_json(cls, d):
+        history = cls(d['window'], d['percentile'], d['default'])
+        history.runs = dict((k, list(v)) for k, v in d['runs'].items())
+        return history
+
+
+def critical_path_priorities(upstream, runtime):
+    '''
+    {task: runtime(task) + max priority of its downstream
+    tasks}. runtime is a callable task_id -> seconds.
+    '''
+    down = downstream_map(upstream)
+    priority = {}
+    for task in reversed(topological_order(upstream)):
+        tail = max([priority[c] for c in down[task]] or [0.0])
+        priority[task] = runtime(task) + tail
+    return priority
+
+
+def critical_path(upstream, runtime):
+    '''The chain of tasks that bounds the makespan, first to last.'''
+    priority = critical_path_priorities(upstream, runtime)
+    down = downstream_map(upstream)
+    roots = [t for t in down if not upstream.get(t)]
+    if not roots:
+        return []
+    path = [max(roots, key=priority.get)]
+    while down[path[-1]]:
+        path.append(max(down[path[-1]], key=priority.get))
+    return path
+
+
+class FifoPolicy(object):
+    '''Dispatch in the order tasks became ready, as the executor does today.'''
+
+    name = 'fifo'
+
+    def __init__(self, upstream=None, runtime=None):
+        self._seq = itertools.count()
+
+    def key(self, task_id):
+        return next(self._seq)
+
+
+class CriticalPathPolicy(object):
+    '''Dispatch the ready task with the longest remaining chain first.'''
+
+    name = 'critical-path'
+
+    def __init__(self, upstream, runtime):
+        self.priority = critical_path_priorities(upstream, runtime)
+        self._seq = itertools.count()
+
+    def key(self, task_id):
+        return (-self.priority[task_id], next(self._seq))
+
+
+class Scheduler(object):
+    '''
+    Run a DAG on a bounded local thread pool.
+
+        history = RuntimeHistory()
+        scheduler = Scheduler(deps, workers=8, history=history)
+        scheduler.run(lambda task_id: run_hive(task_id, ds))
+
+    Runtimes of finished tasks are recorded into the
+    history, so the next run plans with them. A failed
+    task stops its downstream tasks from being started;
+    the rest of the DAG still runs. Pass an
+    instrumentation.RunProfile to record queue, run and
+    I/O time per task.
+    '''
+
+    def __init__(self, upstream, workers=4, history=None, policy=CriticalPathPolicy):
+        self.upstream = dict((t, list(u)) for t, u in upstream.items())
+        self.workers = workers
+        self.history = history or RuntimeHistory()
+        self.policy_class = policy
+
+    def run(self, execute, clock=None, profile=None):
+        clock = clock or time.time
+        policy = self.policy_class(self.upstream, self.history.estimate)
+        down = downstream_map(self.upstream)
+        waiting = dict((t, len(self.upstream.get(t, []))) for t in down)
+        ready = []
+        for task in topological_order(self.upstream):
+            if waiting[task] == 0:
+                heapq.heappush(ready, (policy.key(task), task))
+                if profile is not None:
+                    profile.ready(task)
+        failed, done = {}, []
+        lock = threading.Lock()
+        if profile is not None:
+            execute = profile.wrap(execute)
+
+        def timed(task):
+            start = clock()
+            execute(task)
+            elapsed = clock() - start
+            with lock:
+                self.history.record(task, elapsed)
+            return elapsed
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            running = {}
+            while ready or running:
+                while ready and len(running) < self.workers:
+                    _, task = heapq.heappop(ready)
+                    running[pool.submit(timed, task)] = task
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    task = running.pop(future)
+                    if future.exception() is not None:
+                        failed[task] = future.exception()
+                        continue
+                    done.append(task)
+                    for child in down[task]:
+                        waiting[child] -= 1
+                        if waiting[child] == 0:
+                            heapq.heappush(ready, (policy.key(child), child))
+                            if profile is not None:
+                                profile.ready(child)
+        return done, failed
+
+
+def simulate(upstream, durations, workers, policy):
+    '''
+    Makespan of one recorded run replayed on `workers`
+    slots: tasks take exactly their recorded duration and
+    ready tasks are dispatched in `policy` order.
+    '''
+    down = downstream_map(upstream)
+    waiting = dict((t, len(upstream.get(t, []))) for t in down)
+    ready = []
+    for task in topological_order(upstream):
+        if waiting[task] == 0:
+            heapq.heappush(ready, (policy.key(task), task))
+    now, running, free = 0.0, [], workers
+    while ready or running:
+        while ready and free:
+            _, task = heapq.heappop(ready)
+            heapq.heappush(running, (now + durations.get(task, 0.0), task))
+            free -= 1
+        now, task = heapq.heappop(running)
+        free += 1
+        for child in down[task]:
+            waiting[child] -= 1
+            if waiting[child] == 0:
+                heapq.heappush(ready, (policy.key(child), child))
+    return now
+
+
+def check_warmup(runs, warmup):
+    '''Raise ValueError unless some runs are left to replay after the warmup ones.'''
+    if warmup < 0:
+        raise ValueError('warmup must not be negative, got {0}'.format(warmup))
+    if len(runs) <= warmup:
+        raise ValueError('{0} runs leave nothing to replay after {1} warmup runs'.format(
+            len(runs), warmup))
+
+
+def replay(upstream, runs, workers, warmup=5):
+    '''
+    Replay recorded runs in order. Each run is planned
+    with the history of the runs before it, then added
+    to the history; the first `warmup` runs only build
+    the history. Returns [(run_id, fifo, critical)].
+    '''
+    check_warmup(runs, warmup)
+    history = RuntimeHistory()
+    results = []
+    for i, run in enumerate(runs):
+        durations = run['durations']
+        if i >= warmup:
+            fifo = simulate(upstream, durations, workers, FifoPolicy())
+            cp = simulate(upstream, durations, workers,
+                          CriticalPathPolicy(upstream, history.estimate))
+            results.append((run.get('run_id', str(i)), fifo, cp))
+        history.record_run(durations)
+    return results
+
+
+def synthetic_dag(tasks, seed=0, max_fanin=3):
+    '''A layered DAG: a few long chains among many short independent tasks.'''
+    rng = random.Random(seed)
+    names = ['task_{0}'.format(i) for i in range(tasks)]
+    upstream = dict((n, []) for n in names)
+    for i, name in enumerate(names):
+        if i and rng.random() < 0.6:
+            for _ in range(rng.randint(1, max_fanin)):
+                up = names[rng.randrange(max(0, i - 20), i)]
+                if up not in upstream[name]:
+                    upstream[name].append(up)
+    base = dict((n, rng.lognormvariate(3.0, 1.2)) for n in names)
+    return upstream, base
+
+
+def synthetic_runs(base, runs, seed=1):
+    rng = random.Random(seed)
+    return [{'run_id': 'run_{0}'.format(r),
+             'durations': dict((t, d * rng.lognormvariate(0, 0.25)) for t, d in base.items())}
+            for r in range(runs)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='FIFO vs critical-path dispatch')
+    parser.add_argument('--tasks', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=5,
+                        help='runs that only build the history before replaying')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--history', help='recorded runs as JSON (see module docstring)')
+    parser.add_argument('--anatomy', action='store_true',
+                        help="use the notes DAG's deps instead of a synthetic DAG")
+    args = parser.parse_args(argv)
+
+    if args.anatomy:
+        from dag_spec import DagSpec
+        upstream = DagSpec.from_file().deps
+        base = dict((t, 60.0) for t in downstream_map(upstream))
+    else:
+        upstream, base = synthetic_dag(args.tasks, args.seed)
+    if args.history:
+        with open(args.history) as f:
+            runs = json.load(f)
+    else:
+        runs = synthetic_runs(base, args.runs, args.seed + 1)
+
+    try:
+        results = replay(upstream, runs, args.workers, args.warmup)
+    except ValueError as e:
+        parser.error(e)
+    print('{0} tasks, {1} workers, {2} replayed runs'.format(
+        len(downstream_map(upstream)), args.workers, len(results)))
+    print('{0:<12} {1:>12} {2:>14} {3:>8}'.format('run', 'fifo', 'critical-path', 'saved'))
+    for run_id, fifo, cp in results:
+        print('{0:<12} {1:>11.1f}s {2:>13.1f}s {3:>7.1%}'.format(run_id, fifo, cp, 1 - cp / fifo))
+    if results:
+        fifo = sum(r[1] for r in results)
+        cp = sum(r[2] for r in results)
+        print('{0:<12} {1:>11.1f}s {2:>13.1f}s {3:>7.1%}'.format('total', fifo, cp, 1 - cp / fifo))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+'''
+Cached DAG parsing
+
+Every scheduler heartbeat imports each DAG file again.
+For anatomy_of_a_dag that means rebuilding the sensors
+from wf_dependencies, the HiveOperators from `tasks`
+and every edge through dag.set_dependency, even though
+the file has not changed since the last heartbeat.
+
+DagCache stores the resolved graph (task ids, operator
+types, their templated fields and the edges) as one
+small JSON document per DAG file, keyed by the sha256
+of the file's bytes. A heartbeat hashes the file, and
+if the hash is known it loads the graph from the cache
+without executing anything. Only edited files are
+executed again.
+
+The hash only covers the DAG file itself. A DAG that
+reads other files while it is built (a config, a
+shared module) should pass them as `extra_paths`, so
+they are part of the key too.
+
+Two builders produce the cached form:
+
+    static_dag_file    the default: reads the
+                       wf_dependencies / tasks / deps
+                       literals and schedule_interval
+                       with ast and validates them with
+                       DagFactory, without Airflow
+    execute_dag_file   runs the file and walks the
+                       Airflow DAG objects it defines;
+                       needs Airflow and a DAG file the
+                       interpreter can run (the guide's
+                       uses Python 2's iteritems)
+
+A file that fails validation is reported and not
+cached. The guide's own DAG does (its deps name
+wf_upstream_N, its sensors wf_upstream_table_N), so the
+synthetic copies fix those names:
+
+    python dag_cache.py --synthetic 200
+
+times cold and warm parsing per DAG file.
+'''
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import re
+import runpy
+import shutil
+import tempfile
+import time
+
+from dag_factory import DagFactory
+from dag_spec import DagSpec, read_schedule_interval
+
+FORMAT_VERSION = 1
+
+
+class SerializedDag(object):
+    '''The part of a DAG the scheduler needs, without any operator objects.'''
+
+    def __init__(self, dag_id, tasks, edges, schedule_interval=None):
+        self.dag_id = dag_id
+        self.tasks = tasks
+        self.edges = [tuple(e) for e in edges]
+        self.schedule_interval = schedule_interval
+        self._upstream = {}
+        for up, down in self.edges:
+            self._upstream.setdefault(down, []).append(up)
+
+    @property
+    def task_ids(self):
+        return [t['task_id'] for t in self.tasks]
+
+    def upstream(self, task_id):
+        return list(self._upstream.get(task_id, []))
+
+    def to_dict(self):
+        return {'dag_id': self.dag_id, 'schedule_interval': self.schedule_interval,
+                'tasks': self.tasks, 'edges': self.edges}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['dag_id'], d['tasks'], d['edges'], d.get('schedule_interval'))
+
+
+def _interval_seconds(interval):
+    if interval is None or isinstance(interval, str):
+        return interval
+    return interval.total_seconds()
+
+
+def _jsonable(value):
+    try:
+        json.dumps(value)
+        return value
+    except (TypeError, ValueError):
+        return repr(value)
+
+
+def execute_dag_file(path):
+    '''Run a DAG file and serialize every Airflow DAG it defines.'''
+    namespace = runpy.run_path(path)
+    dags = []
+    for obj in namespace.values():
+        if not (hasattr(obj, 'dag_id') and hasattr(obj, 'task_dict')):
+            continue
+        tasks, edges = [], []
+        for task_id, task in sorted(obj.task_dict.items()):
+            fields = dict((f, _jsonable(getattr(task, f, None)))
+                          for f in getattr(task, 'template_fields', ()))
+            tasks.append({'task_id': task_id, 'operator': type(task).__name__,
+                          'fields': fields})
+            edges.extend([task_id, down] for down in sorted(task.downstream_task_ids))
+        dags.append(SerializedDag(obj.dag_id, tasks, edges,
+                                  _interval_seconds(getattr(obj, 'schedule_interval', None))))
+    return dags
+
+
+def static_dag_file(path):
+    '''
+    Build the same serialized form from the DAG file's
+    literals alone, validated by DagFactory: unknown
+    upstreams and cycles raise instead of being cached.
+    '''
+    spec = DagSpec.from_file(path)
+    upstream = DagFactory(spec.dag_id, operators=None).from_spec(spec).upstream_map()
+    tasks = []
+    for task_id, partition_name in sorted(spec.wf_dependencies.items()):
+        tasks.append({'task_id': task_id, 'operator': 'NamedHivePartitionSensor',
+                      'fields': {'partition_names': [partition_name]}})
+    for directory, task_name in spec.tasks:
+        tasks.append({'task_id': task_name, 'operator': 'HiveOperator',
+                      'fields': {'hql': '{0}/{1}.hql'.format(directory, task_name)}})
+    edges = [[up, down] for down, ups in sorted(upstream.items()) for up in ups]
+    return [SerializedDag(spec.dag_id, tasks, edges, read_schedule_interval(path))]
+
+
+def file_key(path, extra_paths=(), builder=None):
+    h = hashlib.sha256()
+    h.update('{0}:{1}\0'.format(FORMAT_VERSION, getattr(builder, '__name__', '')).encode())
+    for p in [path] + list(extra_paths):
+        with open(p, 'rb') as f:
+            h.update(f.read())
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class DagCache(object):
+    '''
+    Content-addressed cache of serialized DAG files.
+
+        cache = DagCache('/var/cache/dags')
+        dags = cache.load('dags/anatomy_of_a_dag.py')
+
+    Entries are never invalid, only unused: an edited
+    file hashes to a new key. prune() drops keys that no
+    current file maps to; give it the same extra_paths
+    as load(), as (path, extra_paths) pairs.
+    '''
+
+    def __init__(self, cache_dir, builder=static_dag_file):
+        self.cache_dir = cache_dir
+        self.builder = builder
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def load(self, path, extra_paths=()):
+        key = file_key(path, extra_paths, self.builder)
+        entry = self._entry(key)
+        try:
+            with open(entry) as f:
+                docs = json.load(f)
+            self.hits += 1
+            return [SerializedDag.from_dict(d) for d in docs]
+        except (IOError, OSError, ValueError):
+            pass
+        self.misses += 1
+        dags = self.builder(path)
+        tmp = '{0}.{1}.tmp'.format(entry, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump([d.to_dict() for d in dags], f, separators=(',', ':'))
+        os.replace(tmp, entry)
+        return dags
+
+    def prune(self, paths):
+        live = set()
+        for p in paths:
+            path, extra_paths = (p, ()) if isinstance(p, str) else p
+            live.add(file_key(path, extra_paths, self.builder) + '.json')
+        removed = 0
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.json') and name not in live:
+                os.remove(os.path.join(self.cache_dir, name))
+                removed += 1
+        return removed
+
+
+def _synthetic_dag_files(directory, n, source_path):
+    with open(source_path) as f:
+        source = f.read()
+    paths = []
+    for i in range(n):
+        path = os.path.join(directory, 'dag_{0:05d}.py'.format(i))
+        with open(path, 'w') as f:
+            f.write(re.sub(r"'wf_upstream_(\d+)'", r"'wf_upstream_table_\1'", source.replace(
+                "dag_id='anatomy_of_a_dag'", "dag_id='anatomy_of_a_dag_{0}'".format(i))))
+        paths.append(path)
+    return paths
+
+
+def _time_pass(cache, paths):
+    per_file = []
+    for path in paths:
+        t = time.time()
+        cache.load(path)
+        per_file.append(time.time() - t)
+    return per_file
+
+
+def _valid(cache, paths):
+    '''The paths that build; the others are reported, as a scheduler would.'''
+    valid = []
+    for path in paths:
+        try:
+            cache.builder(path)
+        except ValueError as e:
+            print('{0}: not cached: {1}'.format(os.path.basename(path), e))
+            continue
+        valid.append(path)
+    return valid
+
+
+def main(argv=None):
+    from dag_spec import DAG_FILE
+
+    parser = argparse.ArgumentParser(description='cold vs warm DAG file parsing')
+    parser.add_argument('paths', nargs='*', help='DAG files (default: the notes DAG)')
+    parser.add_argument('--synthetic', type=int, default=0,
+                        help='also time N copies of the notes DAG')
+    parser.add_argument('--execute', action='store_true',
+                        help='run the DAG files with Airflow instead of reading their literals')
+    parser.add_argument('--heartbeats', type=int, default=5, help='warm passes to average')
+    args = parser.parse_args(argv)
+
+    if args.execute and importlib.util.find_spec('airflow') is None:
+        parser.error('--execute needs Airflow installed')
+    builder = execute_dag_file if args.execute else static_dag_file
+    tmp = tempfile.mkdtemp(prefix='dagcache-')
+    try:
+        paths = list(args.paths) or [DAG_FILE]
+        if args.synthetic:
+            paths += _synthetic_dag_files(tmp, args.synthetic, DAG_FILE)
+        cache = DagCache(os.path.join(tmp, 'cache'), builder)
+        paths = _valid(cache, paths)
+        if not paths:
+            return
+        cold = _time_pass(cache, paths)
+        warm = [0.0] * len(paths)
+        for _ in range(args.heartbeats):
+            for i, t in enumerate(_time_pass(cache, paths)):
+                warm[i] += t / args.heartbeats
+
+        if len(paths) <= 10:
+            for path, c, w in zip(paths, cold, warm):
+                print('{0:<50} cold {1:8.3f}ms  warm {2:8.3f}ms'.format(
+                    os.path.basename(path), c * 1e3, w * 1e3))
+        print('{0} files: cold {1:.3f}ms/file  warm {2:.3f}ms/file  ({3:.1f}x), '
+              '{4} hits {5} misses'.format(
+                  len(paths), sum(cold) * 1e3 / len(paths), sum(warm) * 1e3 / len(paths),
+                  sum(cold) / max(sum(warm), 1e-9), cache.hits, cache.misses))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+'''
+Reading the anatomy_of_a_dag structures without Airflow
+
+The DAG in a_beginners_guide_to_data_engineering.py is
+built from three plain literals:
+
+    wf_dependencies   sensor task_id -> partition name
+    tasks             list of (directory, task_name)
+    deps              downstream task -> upstream task_ids
+
+Everything else in that file is Airflow boilerplate.
+The tooling in this folder (backfill, sensors, schedulers)
+only needs the literals, so we pull them out of the file
+with the ast module instead of importing it. That keeps
+the tooling usable on machines without Airflow installed
+and never executes the DAG file.
+'''
+import ast
+import os
+from datetime import timedelta
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DAG_FILE = os.path.join(HERE, 'a_beginners_guide_to_data_engineering.py')
+
+SPEC_NAMES = ('wf_dependencies', 'tasks', 'deps')
+
+
+def read_literals(path=DAG_FILE, names=SPEC_NAMES):
+    '''
+    Return {name: value} for every top-level assignment
+    in `path` whose target is in `names` and whose value
+    is a Python literal.
+    '''
+    with open(path) as f:
+        tree = ast.parse(f.read(), filename=path)
+    found = {}
+    for node in tree.body:
+        if not isinstance(node, ast.Assign):
+            continue
+        for target in node.targets:
+            if isinstance(target, ast.Name) and target.id in names:
+                found[target.id] = ast.literal_eval(node.value)
+    missing = [n for n in names if n not in found]
+    if missing:
+        raise ValueError('{0} does not define {1}'.format(path, ', '.join(missing)))
+    return found
+
+
+def read_dag_id(path=DAG_FILE):
+    '''The dag_id= keyword of the first DAG(...) call in the file, if any.'''
+    with open(path) as f:
+        tree = ast.parse(f.read(), filename=path)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and getattr(node.func, 'id', None) == 'DAG':
+            for kw in node.keywords:
+                if kw.arg == 'dag_id' and isinstance(kw.value, ast.Constant):
+                    return kw.value.value
+    return None
+
+
+def read_schedule_interval(path=DAG_FILE):
+    '''
+    The schedule_interval= of the first DAG(...) call:
+    seconds for a timedelta(...) of literals, the value
+    for a literal ('@daily', None), else None.
+    '''
+    with open(path) as f:
+        tree = ast.parse(f.read(), filename=path)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and getattr(node.func, 'id', None) == 'DAG':
+            for kw in node.keywords:
+                if kw.arg != 'schedule_interval':
+                    continue
+                value = kw.value
+                if isinstance(value, ast.Constant):
+                    return value.value
+                name = getattr(value, 'func', None)
+                name = getattr(name, 'id', None) or getattr(name, 'attr', None)
+                if name == 'timedelta':
+                    try:
+                        args = [ast.literal_eval(a) for a in value.args]
+                        kwargs = dict((k.arg, ast.literal_eval(k.value)) for k in value.keywords)
+                    except ValueError:
+                        return None
+                    return timedelta(*args, **kwargs).total_seconds()
+                return None
+    return None
+
+
+class DagSpec(object):
+    '''
+    The resolved shape of a DAG: sensors, operator tasks
+    and the upstream map, as found in the DAG file.
+    '''
+
+    def __init__(self, wf_dependencies, tasks, deps, dag_id='anatomy_of_a_dag'):
+        self.dag_id = dag_id
+        self.wf_dependencies = dict(wf_dependencies)
+        self.tasks = list(tasks)
+        self.deps = dict((k, list(v)) for k, v in deps.items())
+
+    @classmethod
+    def from_file(cls, path=DAG_FILE, dag_id=None):
+        lits = read_literals(path)
+        dag_id = dag_id or read_dag_id(path) or 'anatomy_of_a_dag'
+        return cls(lits['wf_dependencies'], lits['tasks'], lits['deps'], dag_id=dag_id)
+
+    @property
+    def sensor_ids(self):
+        return sorted(self.wf_dependencies)
+
+    @property
+    def task_ids(self):
+        return [name for _, name in self.tasks]
+
+    def hql_path(self, task_id, root=HERE):
+        for directory, name in self.tasks:
+            if name == task_id:
+                return os.path.join(root, '{0}/{1}.hql'.format(directory, name))
+        raise KeyError(task_id)
+
+    def upstream(self, task_id):
+        return list(self.deps.get(task_id, []))
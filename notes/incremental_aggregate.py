@@ -0,0 +1,419 @@
+'''
+Incremental cumulative aggregates
+
+The guide's recommended load for dim_total_bookings
+unions yesterday's partition with today's fct_bookings
+and groups again by dim_market. It beats rescanning
+`ds <= '{{ ds }}'`, but every run still rereads and
+rewrites the whole previous dimension, and a missing
+ds breaks the chain for good.
+
+IncrementalAggregate keeps the running state per key
+in a compact columnar layout:
+
+    keys                  one entry per dim_market
+    <measure>__sum        array('d')
+    <measure>__count      array('q')
+    <measure>__min/max    array('d')
+    <column>__sketch      one HyperLogLog per key
+
+Each ds writes only the keys its delta touched
+(delta.snap). Every `full_every` days, and on the first
+day, the whole state is written instead (state.snap).
+The last state stays in memory between runs, so a
+daily run costs O(delta): nothing is reread, and only
+the touched keys are written. A cold start reads the
+latest full snapshot and overlays the deltas after it.
+
+When ds - 1 has no snapshot the stage walks back to
+the last day it can rebuild and replays the missing
+days through the load_delta callable before applying
+ds, so one lost partition no longer breaks the chain.
+
+    python incremental_aggregate.py --years 3
+
+benchmarks the full rescan, the union load and this
+stage over synthetic booking history.
+'''
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+from array import array
+
+from backfill import ds_add, ds_range
+from sketches import HyperLogLog, hash64
+
+MAGIC = b'IAGG2\n'
+STATS = ('sum', 'count', 'min', 'max')
+_TYPECODES = {'sum': 'd', 'count': 'q', 'min': 'd', 'max': 'd'}
+_INITIAL = {'sum': 0.0, 'count': 0, 'min': float('inf'), 'max': float('-inf')}
+
+FULL = 'state.snap'
+DELTA = 'delta.snap'
+
+
+class AggregateState(object):
+    '''Running per-key aggregates as of one ds, column by column.'''
+
+    def __init__(self, measures, distinct, ds=None):
+        self.ds = ds
+        self.measures = list(measures)
+        self.distinct = dict(distinct)
+        self.keys = []
+        self.index = {}
+        self.columns = dict(('{0}__{1}'.format(m, s), array(_TYPECODES[s]))
+                            for m in self.measures for s in STATS)
+        self.sketches = dict((c, []) for c in self.distinct)
+
+    def _slot(self, key):
+        slot = self.index.get(key)
+        if slot is None:
+            slot = len(self.keys)
+            self.index[key] = slot
+            self.keys.append(key)
+            for name, col in self.columns.items():
+                col.append(_INITIAL[name.rsplit('__', 1)[1]])
+            for c, p in self.distinct.items():
+                self.sketches[c].append(HyperLogLog(p))
+        return slot
+
+    def apply(self, key_column, delta):
+        '''
+        Fold a columnar delta into the state and return
+        the set of slots it touched. `delta` maps column
+        name -> list, all as long as key_column. None
+        measure values are skipped like SQL does.
+        '''
+        slots = [self._slot(k) for k in delta[key_column]]
+        for m in self.measures:
+            s, n = self.columns[m + '__sum'], self.columns[m + '__count']
+            lo, hi = self.columns[m + '__min'], self.columns[m + '__max']
+            for slot, v in zip(slots, delta[m]):
+                if v is None:
+                    continue
+                s[slot] += v
+                n[slot] += 1
+                if v < lo[slot]:
+                    lo[slot] = v
+                if v > hi[slot]:
+                    hi[slot] = v
+        for c in self.distinct:
+            sketches = self.sketches[c]
+            for slot, v in zip(slots, delta[c]):
+                if v is not None:
+                    sketches[slot].add_hash(hash64(v))
+        return set(slots)
+
+    def copy(self):
+        state = AggregateState(self.measures, self.distinct, self.ds)
+        state.keys = list(self.keys)
+        state.index = dict(self.index)
+        state.columns = dict((name, array(col.typecode, col)) for name, col in self.columns.items())
+        state.sketches = dict((c, [s.copy() for s in sketches])
+                              for c, sketches in self.sketches.items())
+        return state
+
+    def overlay(self, other):
+        '''Take other's rows over ours, key by key (used to replay delta files).'''
+        for slot, key in enumerate(other.keys):
+            mine = self._slot(key)
+            for name, col in other.columns.items():
+                self.columns[name][mine] = col[slot]
+            for c in self.distinct:
+                self.sketches[c][mine] = other.sketches[c][slot].copy()
+        self.ds = other.ds
+        return self
+
+    def rows(self):
+        '''(key, {stat: value}) per key, as the dimension table would show it.'''
+        for slot, key in enumerate(self.keys):
+            row = dict((name, col[slot]) for name, col in self.columns.items())
+            for c in self.distinct:
+                row[c + '__distinct'] = self.sketches[c][slot].count()
+            yield key, row
+
+    def write(self, path, slots=None):
+        '''Write every key, or only `slots` for a delta file.'''
+        slots = sorted(slots) if slots is not None else range(len(self.keys))
+        names = sorted(self.columns)
+        header = {'ds': self.ds, 'keys': [self.keys[i] for i in slots],
+                  'measures': self.measures, 'distinct': self.distinct, 'columns': names}
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(MAGIC)
+            f.write(json.dumps(header).encode() + b'\n')
+            for name in names:
+                col = self.columns[name]
+                array(col.typecode, (col[i] for i in slots)).tofile(f)
+            for c in sorted(self.distinct):
+                sketches = self.sketches[c]
+                for i in slots:
+                    f.write(sketches[i].registers)
+        os.replace(tmp, path)
+
+    @classmethod
+    def read(cls, path):
+        with open(path, 'rb') as f:
+            if f.readline() != MAGIC:
+                raise ValueError('{0} is not an aggregate snapshot'.format(path))
+            header = json.loads(f.readline())
+            state = cls(header['measures'], header['distinct'], header['ds'])
+            state.keys = [tuple(k) if isinstance(k, list) else k for k in header['keys']]
+            state.index = dict((k, i) for i, k in enumerate(state.keys))
+            n = len(state.keys)
+            for name in header['columns']:
+                col = array(state.columns[name].typecode)
+                col.fromfile(f, n)
+                state.columns[name] = col
+            for c in sorted(state.distinct):
+                p = state.distinct[c]
+                state.sketches[c] = [HyperLogLog(p, f.read(1 << p)) for _ in range(n)]
+        return state
+
+
+class IncrementalAggregate(object):
+    '''
+    A dimension maintained as a cumulative aggregate of a
+    ds-partitioned fact table.
+
+        dim_total_bookings = IncrementalAggregate(
+                root, 'dim_total_bookings', key='dim_market',
+                measures=['m_bookings'], distinct={'id_listing': 12},
+                load_delta=read_fct_bookings_partition)
+        dim_total_bookings.run('2018-02-09')
+
+    load_delta(ds) returns the fact partition for ds as a
+    dict of columns. It is only called for ds itself and
+    for days that have to be replayed to close a gap.
+    '''
+
+    def __init__(self, root, table, key, measures, distinct=None, load_delta=None,
+                 start_ds=None, full_every=30):
+        self.root = os.path.join(root, table)
+        self.table = table
+        self.key = key
+        self.measures = list(measures)
+        self.distinct = dict(distinct or {})
+        self.load_delta = load_delta
+        self.start_ds = start_ds
+        self.full_every = full_every
+        self._state = None
+        self._last_full = None
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+    def _path(self, ds, kind):
+        return os.path.join(self.root, 'ds={0}'.format(ds), kind)
+
+    def snapshots(self):
+        '''{ds: FULL or DELTA} for every ds written so far.'''
+        found = {}
+        for name in os.listdir(self.root):
+            if not name.startswith('ds='):
+                continue
+            ds = name[3:]
+            for kind in (FULL, DELTA):
+                if os.path.exists(self._path(ds, kind)):
+                    found[ds] = kind
+                    break
+        return found
+
+    def _load_before(self, ds):
+        '''
+        Latest state we can rebuild strictly before ds:
+        the in-memory one when it is still current,
+        otherwise the newest full snapshot plus every
+        consecutive delta after it.
+        '''
+        if self._state is not None and self._state.ds < ds:
+            return self._state, self._last_full
+        written = self.snapshots()
+        fulls = sorted(d for d, kind in written.items() if kind == FULL and d < ds)
+        if not fulls:
+            return AggregateState(self.measures, self.distinct), None
+        state = AggregateState.read(self._path(fulls[-1], FULL))
+        day = ds_add(state.ds, 1)
+        while day < ds and written.get(day) == DELTA:
+            state.overlay(AggregateState.read(self._path(day, DELTA)))
+            day = ds_add(day, 1)
+        return state, fulls[-1]
+
+    def _days_before(self, state, ds):
+        '''The days between state and ds that have to be replayed first.'''
+        first = ds_add(state.ds, 1) if state.ds is not None else (self.start_ds or ds)
+        return ds_range(first, ds)[:-1] if first < ds else []
+
+    def missing_days(self, ds):
+        return self._days_before(self._load_before(ds)[0], ds)
+
+    def run(self, ds, delta=None):
+        '''
+        Materialize ds. Replays any missing days first,
+        then applies `delta` (or load_delta(ds) when no
+        delta is passed). Returns the replayed days.
+        '''
+        state, last_full = self._load_before(ds)
+        # state is updated in place and only kept once every day is written:
+        # after a failure midway the next run rebuilds it from the snapshots
+        self._state = None
+        replayed = self._days_before(state, ds)
+        if replayed and self.load_delta is None:
+            raise ValueError('{0}: no snapshot for {1} and no load_delta to replay it'.format(
+                self.table, replayed[0]))
+        for day in replayed + [ds]:
+            day_delta = delta if day == ds and delta is not None else self.load_delta(day)
+            touched = state.apply(self.key, day_delta)
+            state.ds = day
+            directory = os.path.join(self.root, 'ds={0}'.format(day))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            for stale in (FULL, DELTA):
+                if os.path.exists(self._path(day, stale)):
+                    os.remove(self._path(day, stale))
+            if last_full is None or ds_range(last_full, day)[self.full_every:]:
+                state.write(self._path(day, FULL))
+                last_full = day
+            else:
+                state.write(self._path(day, DELTA), touched)
+        self._state, self._last_full = state, last_full
+        return replayed
+
+    def read(self, ds):
+        '''The state as of ds, a copy the next run() does not change.'''
+        if self._state is not None and self._state.ds == ds:
+            return self._state.copy()
+        state, _ = self._load_before(ds_add(ds, 1))
+        if state.ds != ds:
+            raise KeyError('{0} has no complete state for {1}'.format(self.table, ds))
+        return state
+
+
+def synthetic_fct_bookings(ds, rows=2000, markets=200, listings=50000):
+    '''A reproducible fct_bookings partition for ds, as columns.'''
+    rng = random.Random(ds)
+    id_listing = [rng.randrange(listings) for _ in range(rows)]
+    return {
+        'id_listing': id_listing,
+        'id_host': [i // 7 for i in id_listing],
+        'dim_market': ['market_{0}'.format(i % markets) for i in id_listing],
+        'm_bookings': [1 if rng.random() < 0.3 else 0 for _ in range(rows)],
+        }
+
+
+def _group_sum(totals, delta):
+    for market, m in zip(delta['dim_market'], delta['m_bookings']):
+        totals[market] = totals.get(market, 0) + m
+    return totals
+
+
+def _union_load(root, ds, delta):
+    '''The guide's union query: reread ds - 1 of the dimension, add ds, write ds.'''
+    totals = {}
+    prev = os.path.join(root, ds_add(ds, -1) + '.tsv')
+    if os.path.exists(prev):
+        with open(prev) as f:
+            for line in f:
+                market, m = line.rstrip('\n').split('\t')
+                totals[market] = int(m)
+    _group_sum(totals, delta)
+    with open(os.path.join(root, ds + '.tsv'), 'w') as f:
+        for market, m in totals.items():
+            f.write('{0}\t{1}\n'.format(market, m))
+    return totals
+
+
+def _write_fct(root, ds, delta):
+    with open(os.path.join(root, ds + '.tsv'), 'w') as f:
+        for market, m in zip(delta['dim_market'], delta['m_bookings']):
+            f.write('{0}\t{1}\n'.format(market, m))
+
+
+def _full_scan(root, ds_list):
+    '''WHERE ds <= '{{ ds }}': read every fct_bookings partition back from disk.'''
+    totals = {}
+    for ds in ds_list:
+        with open(os.path.join(root, ds + '.tsv')) as f:
+            for line in f:
+                market, m = line.rstrip('\n').split('\t')
+                totals[market] = totals.get(market, 0) + int(m)
+    return totals
+
+
+def bench(days, rows, markets, p, sample_every):
+    history = ds_range('2015-01-01', ds_add('2015-01-01', days - 1))
+    load = lambda ds: synthetic_fct_bookings(ds, rows, markets, markets * 10)
+    print('{0} days of fct_bookings, {1} rows per ds, {2} markets'.format(days, rows, markets))
+    print('{0:>10}  {1:>12}  {2:>12}  {3:>12}'.format('ds #', 'full scan', 'union', 'incremental'))
+
+    root = tempfile.mkdtemp(prefix='iagg-')
+    try:
+        agg = IncrementalAggregate(root, 'dim_total_bookings', 'dim_market', ['m_bookings'],
+                                   {'id_listing': p}, load_delta=load)
+        union_root = os.path.join(root, 'union')
+        fct_root = os.path.join(root, 'fct_bookings')
+        os.makedirs(union_root)
+        os.makedirs(fct_root)
+        totals = {'full': 0.0, 'union': 0.0, 'incremental': 0.0}
+        for i, ds in enumerate(history):
+            delta = load(ds)
+            _write_fct(fct_root, ds, delta)
+            sample = (i + 1) % sample_every == 0 or i == len(history) - 1
+            if sample:
+                # WHERE ds <= '{{ ds }}': every partition, every day
+                t = time.time()
+                full_dim = _full_scan(fct_root, history[:i + 1])
+                full = time.time() - t
+
+            t = time.time()
+            dim = _union_load(union_root, ds, delta)
+            union = time.time() - t
+            if sample:
+                assert full_dim == dim, ds
+            totals['union'] += union
+
+            t = time.time()
+            agg.run(ds, delta)
+            incremental = time.time() - t
+            totals['incremental'] += incremental
+
+            if sample:
+                print('{0:>10}  {1:>11.4f}s  {2:>11.4f}s  {3:>11.4f}s'.format(
+                    i + 1, full, union, incremental))
+        print('{0:>10}  {1:>12}  {2:>11.2f}s  {3:>11.2f}s'.format(
+            'total', '-', totals['union'], totals['incremental']))
+
+        for key, row in agg.read(history[-1]).rows():
+            assert row['m_bookings__sum'] == dim[key], key
+
+        # lose the last week and let the stage rebuild it from a cold start
+        for ds in history[-8:]:
+            shutil.rmtree(os.path.join(agg.root, 'ds={0}'.format(ds)))
+        agg._state = None
+        t = time.time()
+        replayed = agg.run(history[-1])
+        print('gap fill: cold start, replayed {0} missing days in {1:.4f}s'.format(
+            len(replayed), time.time() - t))
+        for key, row in agg.read(history[-1]).rows():
+            assert row['m_bookings__sum'] == dim[key], key
+    finally:
+        shutil.rmtree(root)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='incremental dim_total_bookings benchmark')
+    parser.add_argument('--years', type=float, default=2)
+    parser.add_argument('--rows', type=int, default=2000, help='fct_bookings rows per ds')
+    parser.add_argument('--markets', type=int, default=20000, help='keys in the dimension')
+    parser.add_argument('--p', type=int, default=8, help='HyperLogLog precision per key')
+    parser.add_argument('--sample-every', type=int, default=90,
+                        help='time the full rescan every N days (it is slow)')
+    args = parser.parse_args(argv)
+    bench(int(args.years * 365), args.rows, args.markets, args.p, args.sample_every)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,439 @@
+'''
+Per-task instrumentation
+
+When task_1 or task_2 gets slow, the only number we
+have is the wall clock of the whole task. That does
+not say whether it waited for a slot, sat in a sensor,
+burned CPU or waited on storage, so there is nothing to
+point an optimization at, and nothing to prove it
+worked afterwards.
+
+RunProfile records, for every sensor and operator of
+one DAG run:
+
+    queued    from the moment the task was ready until
+              it got a worker
+    sensor    the whole wall time of a sensor
+    execute   wall time of an operator outside I/O
+    io        time inside stats.io(...) blocks
+    rows / bytes read and written, as reported by the
+              task through current()
+    cpu       thread CPU time of the task
+    peak RSS  high-water mark of the process when the
+              task finished (ru_maxrss is per process,
+              so tasks sharing a process share it)
+
+Task code does not need a new argument: current()
+returns the stats of the task running on this thread.
+
+    stats = instrumentation.current()
+    with stats.io('read fct_bookings'):
+        columns = load(...)
+    stats.read(rows=len(columns['id_listing']), bytes=size)
+
+Scheduler.run(execute, profile=profile) feeds it. A
+run is exported as a Chrome trace (chrome://tracing,
+Perfetto, speedscope) and as Prometheus text on
+MetricsServer's /metrics.
+
+    python instrumentation.py --tasks 2000 --trace run.json --serve 9108
+
+measures the overhead per task, profiles a run of the
+notes DAG and, with --serve, keeps /metrics up.
+'''
+import argparse
+import contextlib
+import http.server
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import numpy as np
+
+from sketches import hash64
+from stage_check_exchange import write_partition
+
+_LOCAL = threading.local()
+
+
+def _peak_rss_bytes():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class TaskStats(object):
+    '''What one task instance spent, filled in while it runs.'''
+
+    __slots__ = ('task_id', 'kind', 'ready_at', 'start', 'end', 'cpu', 'peak_rss', 'error',
+                 'io_seconds', 'rows_read', 'bytes_read', 'rows_written', 'bytes_written',
+                 'lane', 'spans')
+
+    def __init__(self, task_id, kind='operator'):
+        self.task_id = task_id
+        self.kind = kind
+        self.ready_at = None
+        self.start = self.end = None
+        self.cpu = 0.0
+        self.peak_rss = 0
+        self.error = None
+        self.io_seconds = 0.0
+        self.rows_read = self.bytes_read = 0
+        self.rows_written = self.bytes_written = 0
+        self.lane = 0
+        self.spans = []
+
+    @contextlib.contextmanager
+    def io(self, name='io'):
+        start = time.time()
+        try:
+            yield self
+        finally:
+            end = time.time()
+            self.io_seconds += end - start
+            self.spans.append((name, start, end))
+
+    def read(self, rows=0, bytes=0):
+        self.rows_read += rows
+        self.bytes_read += bytes
+
+    def wrote(self, rows=0, bytes=0):
+        self.rows_written += rows
+        self.bytes_written += bytes
+
+    @property
+    def phases(self):
+        '''{phase: seconds}; they add up to ready -> end.'''
+        wall = (self.end or self.start) - self.start
+        phases = {'queued': self.start - self.ready_at if self.ready_at else 0.0}
+        if self.kind == 'sensor':
+            phases['sensor'] = wall
+        else:
+            phases['execute'] = wall - self.io_seconds
+            phases['io'] = self.io_seconds
+        return phases
+
+
+def current():
+    '''
+    The TaskStats of the task running on this thread. Outside
+    an instrumented task this is a throwaway, so task code
+    can report unconditionally.
+    '''
+    stats = getattr(_LOCAL, 'stats', None)
+    return stats if stats is not None else TaskStats(None)
+
+
+class RunProfile(object):
+    '''
+    Everything recorded for one DAG run.
+
+        profile = RunProfile('anatomy_of_a_dag', ds, sensors=spec.sensor_ids)
+        Scheduler(spec.deps, workers=4).run(execute, profile=profile)
+        profile.write_trace('run.json')
+        server.publish(profile)
+
+    Tasks listed in `sensors` are recorded as sensors,
+    everything else as operators.
+    '''
+
+    def __init__(self, dag_id, run_id=None, sensors=()):
+        self.dag_id = dag_id
+        self.run_id = run_id or time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.sensors = set(sensors)
+        self.tasks = {}
+        self.created = time.time()
+        self._ready = {}
+        self._lanes = {}
+        self._lock = threading.Lock()
+
+    def ready(self, task_id):
+        '''Mark task_id as ready to run; its queued time starts here.'''
+        with self._lock:
+            self._ready[task_id] = time.time()
+
+    def _lane(self):
+        ident = threading.get_ident()
+        with self._lock:
+            return self._lanes.setdefault(ident, len(self._lanes) + 1)
+
+    @contextlib.contextmanager
+    def task(self, task_id, kind=None):
+        stats = TaskStats(task_id, kind or ('sensor' if task_id in self.sensors else 'operator'))
+        with self._lock:
+            stats.ready_at = self._ready.pop(task_id, None)
+        stats.lane = self._lane()
+        previous = getattr(_LOCAL, 'stats', None)
+        _LOCAL.stats = stats
+        cpu = time.thread_time()
+        stats.start = time.time()
+        try:
+            yield stats
+        except BaseException as e:
+            stats.error = repr(e)
+            raise
+        finally:
+            stats.end = time.time()
+            stats.cpu = time.thread_time() - cpu
+            stats.peak_rss = _peak_rss_bytes()
+            _LOCAL.stats = previous
+            with self._lock:
+                self.tasks[task_id] = stats
+
+    def wrap(self, execute):
+        '''execute(task_id) -> the same callable, run inside task().'''
+        def instrumented(task_id, *args):
+            with self.task(task_id):
+                return execute(task_id, *args)
+        return instrumented
+
+    @property
+    def elapsed(self):
+        ends = [s.end for s in self.tasks.values() if s.end]
+        starts = [s.ready_at or s.start for s in self.tasks.values()]
+        return max(ends) - min(starts) if ends else 0.0
+
+    def hot_tasks(self, n=5, phase=None):
+        '''The n tasks with the most time in `phase` (default: ready -> end).'''
+        def cost(stats):
+            phases = stats.phases
+            return phases.get(phase, 0.0) if phase else sum(phases.values())
+        return sorted(self.tasks.values(), key=cost, reverse=True)[:n]
+
+    def chrome_trace(self):
+        '''
+        The run in the Trace Event Format. Workers are
+        threads of one process; queue waits go on their own
+        track, one row per task, since they overlap.
+        '''
+        t0 = min([s.ready_at or s.start for s in self.tasks.values()] or [self.created])
+        us = lambda t: int((t - t0) * 1e6)
+        events = [
+            {'ph': 'M', 'pid': 1, 'name': 'process_name', 'args': {'name': 'workers'}},
+            {'ph': 'M', 'pid': 2, 'name': 'process_name', 'args': {'name': 'queue'}},
+            ]
+        for row, stats in enumerate(sorted(self.tasks.values(), key=lambda s: s.start)):
+            args = {'kind': stats.kind, 'cpu_s': round(stats.cpu, 6),
+                    'rows_read': stats.rows_read, 'bytes_read': stats.bytes_read,
+                    'rows_written': stats.rows_written, 'bytes_written': stats.bytes_written,
+                    'peak_rss': stats.peak_rss}
+            if stats.error:
+                args['error'] = stats.error
+            events.append({'name': stats.task_id, 'cat': stats.kind, 'ph': 'X', 'pid': 1,
+                           'tid': stats.lane, 'ts': us(stats.start),
+                           'dur': us(stats.end) - us(stats.start), 'args': args})
+            for name, start, end in stats.spans:
+                events.append({'name': name, 'cat': 'io', 'ph': 'X', 'pid': 1, 'tid': stats.lane,
+                               'ts': us(start), 'dur': us(end) - us(start)})
+            if stats.ready_at:
+                events.append({'name': stats.task_id, 'cat': 'queued', 'ph': 'X', 'pid': 2,
+                               'tid': row, 'ts': us(stats.ready_at),
+                               'dur': us(stats.start) - us(stats.ready_at)})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': {'dag_id': self.dag_id, 'run_id': self.run_id}}
+
+    def write_trace(self, path):
+        tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+        os.replace(tmp, path)
+        return path
+
+    def prometheus(self):
+        '''The run's metrics as Prometheus text exposition lines, without HELP/TYPE.'''
+        lines = []
+        base = {'dag_id': self.dag_id}
+        for stats in sorted(self.tasks.values(), key=lambda s: s.task_id):
+            labels = dict(base, task_id=stats.task_id, kind=stats.kind)
+            for phase, seconds in sorted(stats.phases.items()):
+                lines.append(_sample('dag_task_phase_seconds', dict(labels, phase=phase), seconds))
+            lines.append(_sample('dag_task_cpu_seconds', labels, stats.cpu))
+            lines.append(_sample('dag_task_peak_rss_bytes', labels, stats.peak_rss))
+            for direction, rows, size in (('read', stats.rows_read, stats.bytes_read),
+                                          ('written', stats.rows_written, stats.bytes_written)):
+                lines.append(_sample('dag_task_rows', dict(labels, direction=direction), rows))
+                lines.append(_sample('dag_task_bytes', dict(labels, direction=direction), size))
+            lines.append(_sample('dag_task_failed', labels, 1 if stats.error else 0))
+        lines.append(_sample('dag_run_seconds', base, self.elapsed))
+        return lines
+
+
+_HELP = [
+    ('dag_task_phase_seconds', 'Seconds a task spent queued, sensing, executing or in I/O.'),
+    ('dag_task_cpu_seconds', 'Thread CPU seconds of a task.'),
+    ('dag_task_peak_rss_bytes', 'Process peak RSS when the task finished.'),
+    ('dag_task_rows', 'Rows read or written by a task.'),
+    ('dag_task_bytes', 'Bytes read or written by a task.'),
+    ('dag_task_failed', '1 if the task raised.'),
+    ('dag_run_seconds', 'Wall time of the DAG run, first ready to last finished.'),
+    ]
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _sample(name, labels, value):
+    return '{0}{{{1}}} {2}'.format(
+        name, ','.join('{0}="{1}"'.format(k, _escape(v)) for k, v in sorted(labels.items())),
+        repr(float(value)))
+
+
+def exposition(profiles):
+    '''Prometheus text for the latest run of every DAG, HELP/TYPE once per metric.'''
+    samples = [line for profile in profiles for line in profile.prometheus()]
+    out = []
+    for name, text in _HELP:
+        out.append('# HELP {0} {1}'.format(name, text))
+        out.append('# TYPE {0} gauge'.format(name))
+        out.extend(line for line in samples if line.startswith(name + '{'))
+    return '\n'.join(out) + '\n'
+
+
+class MetricsServer(object):
+    '''
+    Serve /metrics for the latest published run of each
+    DAG, on a local port, from a daemon thread.
+    '''
+
+    def __init__(self, port=9108, host='127.0.0.1'):
+        self.profiles = {}
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                with server._lock:
+                    body = exposition(list(server.profiles.values())).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.port = self.httpd.server_address[1]
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}/metrics'.format(*self.httpd.server_address)
+
+    def publish(self, profile):
+        with self._lock:
+            self.profiles[profile.dag_id] = profile
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def _notes_dag_execute(root, ds, landing):
+    '''
+    Sensors wait for their landing time, operators read
+    the stg_bookings partition under root, keep a sample
+    of its rows and write them as their own partition.
+    '''
+    source = os.path.join(root, 'stg_bookings', 'ds={0}'.format(ds))
+
+    def execute(task_id):
+        stats = current()
+        if task_id in landing:
+            time.sleep(max(0.0, landing[task_id] - time.time()))
+            return
+        with stats.io('read stg_bookings'):
+            columns = dict((name[:-4], np.load(os.path.join(source, name)))
+                           for name in sorted(os.listdir(source)))
+        rows = len(columns['id_listing'])
+        stats.read(rows, sum(v.nbytes for v in columns.values()))
+        # hash() of a str differs between processes; hash64 gives every run the same sample
+        keep = np.random.default_rng(hash64(task_id)).random(rows) < 0.9
+        columns = dict((k, v[keep]) for k, v in columns.items())
+        order = np.argsort(columns['id_listing'], kind='stable')
+        out = dict((k, v[order]) for k, v in columns.items())
+        path = os.path.join(root, task_id, 'ds={0}'.format(ds))
+        with stats.io('write {0}'.format(task_id)):
+            os.makedirs(path)
+            for name, values in out.items():
+                np.save(os.path.join(path, name + '.npy'), values)
+        stats.wrote(len(order), sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)))
+    return execute
+
+
+def main(argv=None):
+    from critical_path import Scheduler, synthetic_dag
+    from dag_spec import DagSpec
+
+    parser = argparse.ArgumentParser(description='per-task instrumentation')
+    parser.add_argument('--tasks', type=int, default=2000, help='tasks for the overhead run')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--rows', type=int, default=1000000, help='rows per operator')
+    parser.add_argument('--trace', default=None, help='write the Chrome trace here')
+    parser.add_argument('--serve', type=int, default=None, metavar='PORT',
+                        help='keep /metrics up on PORT until interrupted')
+    args = parser.parse_args(argv)
+
+    upstream, _ = synthetic_dag(args.tasks)
+    noop = lambda task_id: None
+    timings = []
+    for profile in (None, RunProfile('synthetic')):
+        t = time.time()
+        Scheduler(upstream, args.workers).run(noop, profile=profile)
+        timings.append(time.time() - t)
+    print('{0} no-op tasks: {1:.3f}s bare, {2:.3f}s instrumented, {3:.1f} us/task overhead'.format(
+        args.tasks, timings[0], timings[1], 1e6 * (timings[1] - timings[0]) / args.tasks))
+
+    spec = DagSpec.from_file()
+    ds = '2018-02-09'
+    sensors = sorted(set(u for ups in spec.deps.values() for u in ups) - set(spec.task_ids))
+    landing = dict((s, time.time() + 0.05 * (i + 1)) for i, s in enumerate(sensors))
+    root = tempfile.mkdtemp(prefix='instrument-')
+    server = MetricsServer(port=args.serve or 0)
+    try:
+        rng = np.random.default_rng(0)
+        write_partition(os.path.join(root, 'stg_bookings', 'ds={0}'.format(ds)),
+                        {'id_listing': rng.integers(0, 10 ** 6, args.rows),
+                         'm_bookings': (rng.random(args.rows) < 0.3).astype(np.int64)})
+        profile = RunProfile(spec.dag_id, ds, sensors=sensors)
+        Scheduler(spec.deps, args.workers).run(
+            _notes_dag_execute(root, ds, landing), profile=profile)
+        server.publish(profile)
+        print('{0} ds={1}: {2:.3f}s'.format(spec.dag_id, ds, profile.elapsed))
+        for stats in profile.hot_tasks(len(profile.tasks)):
+            phases = ', '.join('{0} {1:.3f}s'.format(k, v) for k, v in sorted(stats.phases.items()))
+            print('  {0:<14} {1:<8} {2}  cpu {3:.3f}s  read {4:,} B  wrote {5:,} B'.format(
+                stats.task_id, stats.kind, phases, stats.cpu, stats.bytes_read,
+                stats.bytes_written))
+        trace = profile.write_trace(args.trace or os.path.join(root, 'trace.json'))
+        print('trace: {0} ({1} events)'.format(trace, len(profile.chrome_trace()['traceEvents'])))
+        body = urllib.request.urlopen(server.url).read().decode()
+        print('{0}: {1} samples, e.g.'.format(
+            server.url, sum(1 for l in body.splitlines() if not l.startswith('#'))))
+        print('  ' + next(l for l in body.splitlines() if l.startswith('dag_task_phase_seconds')))
+        if args.serve:
+            print('serving {0}, ^C to stop'.format(server.url))
+            while True:
+                time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,389 @@
+'''
+Sketch-backed metrics layer
+
+The rise of the data engineer notes describe a metric
+computation framework for engagement, growth and
+segmentation metrics. Asked as exact SQL, distinct
+users by dim_market and subscription_type over the last
+30 days rescans 30 days of facts, and so does every
+other rollup of the same numbers.
+
+MetricsLayer builds, once per ds partition of a fact
+table and once per combination of its dimensions:
+
+    count, sum        exact, they add up
+    HyperLogLog       distinct users
+    TDigest           quantiles of a measure
+    CountMinSketch    frequency of an item (listing,
+                      photo) for heavy hitters
+
+and writes them under <root>/<metric>/ds=<ds>/ as .npy
+arrays, one row per dimension combination. A query over
+any ds range and any subset of the dimensions merges
+those rows (register max, centroid re-compression,
+counter sums) and never reads a fact.
+
+Error bounds are set per metric: distinct_error picks
+the HLL precision, compression the t-digest size, and
+frequency_error / frequency_delta the count-min shape.
+
+Sketches are built with NumPy here, hashing keys with
+sketches.hash_keys: the hash HyperLogLog.add and
+CountMinSketch.add use too, so a sketch built here
+merges with one built value by value elsewhere.
+
+    python metrics_layer.py --days 30 --rows 200000
+
+reports query latency and error against exact answers
+computed from the facts.
+'''
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from backfill import ds_add, ds_range
+from sketches import CountMinSketch, HyperLogLog, TDigest, compress_centroids, hash_keys
+
+
+def _bit_length(x):
+    x = x.copy()
+    n = np.zeros(len(x), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        big = x >= (np.uint64(1) << np.uint64(shift))
+        n += big * shift
+        x = np.where(big, x >> np.uint64(shift), x)
+    return n + (x > 0)
+
+
+def hll_registers(hashes, group, groups, p):
+    '''(groups, 2 ** p) uint8 registers; hashes[i] goes to row group[i].'''
+    registers = np.zeros((groups, 1 << p), dtype=np.uint8)
+    if not len(hashes):
+        return registers
+    idx = (hashes >> np.uint64(64 - p)).astype(np.int64)
+    with np.errstate(over='ignore'):
+        rest = hashes << np.uint64(p)
+    rank = np.where(rest > 0, 65 - _bit_length(rest), 65 - p).astype(np.uint8)
+    np.maximum.at(registers, (group, idx), rank)
+    return registers
+
+
+def cm_tables(hashes, counts, group, groups, width, depth):
+    '''(groups, depth * width) int64 count-min counters, laid out as CountMinSketch.table.'''
+    tables = np.zeros((groups, depth * width), dtype=np.int64)
+    h1 = hashes & np.uint64(0xFFFFFFFF)
+    h2 = (hashes >> np.uint64(32)) | np.uint64(1)
+    for i in range(depth):
+        cell = i * width + ((h1 + np.uint64(i) * h2) % np.uint64(width)).astype(np.int64)
+        np.add.at(tables, (group, cell), counts)
+    return tables
+
+
+class MetricResult(object):
+    '''The merged sketches of one output group.'''
+
+    def __init__(self, key, count, total, hll, digest, frequency):
+        self.key = key
+        self.count = count
+        self.sum = total
+        self.hll = hll
+        self.digest = digest
+        self._frequency = frequency
+
+    @property
+    def distinct(self):
+        return self.hll.count()
+
+    def quantile(self, q):
+        return self.digest.quantile(q)
+
+    def frequency(self, item):
+        '''Estimated number of rows with this item; never under the true count.'''
+        return self._frequency.estimate(item)
+
+
+class MetricsLayer(object):
+    '''
+    One metric over one fact table.
+
+        bookings = MetricsLayer(root, 'bookings', dimensions=('dim_market', 'subscription_type'),
+                                distinct='id_user', measure='m_value', item='id_listing')
+        bookings.build(ds, facts)                         # once per partition
+        by_market = bookings.query('2018-01-10', '2018-02-08', group_by=('dim_market',))
+        by_market[('market_7',)].distinct
+
+    query() takes `where` as {dimension: value or set}.
+    '''
+
+    def __init__(self, root, name, dimensions, distinct, measure=None, item=None,
+                 distinct_error=0.01, compression=200, frequency_error=0.001,
+                 frequency_delta=0.01):
+        self.root = root
+        self.name = name
+        self.dimensions = tuple(dimensions)
+        self.distinct_column = distinct
+        self.measure = measure
+        self.item = item
+        self.p = HyperLogLog.for_error(distinct_error).p
+        self.compression = compression
+        shape = CountMinSketch.for_error(frequency_error, frequency_delta)
+        self.width, self.depth = shape.width, shape.depth
+
+    def partition_path(self, ds):
+        return os.path.join(self.root, self.name, 'ds={0}'.format(ds))
+
+    def build(self, ds, facts):
+        '''Write the sketches of one ds of facts ({column: array}); returns the group count.'''
+        keys = [np.asarray(facts[d]).astype(str) for d in self.dimensions]
+        combined = np.rec.fromarrays(keys) if len(keys) > 1 else keys[0]
+        labels, group = np.unique(combined, return_inverse=True)
+        groups = len(labels)
+        arrays = {}
+        for i, d in enumerate(self.dimensions):
+            arrays['key.' + d] = labels[labels.dtype.names[i]] if len(keys) > 1 else labels
+        arrays['count'] = np.bincount(group, minlength=groups).astype(np.int64)
+        arrays['hll'] = hll_registers(hash_keys(facts[self.distinct_column]), group, groups, self.p)
+
+        if self.measure is not None:
+            values = np.asarray(facts[self.measure], dtype=np.float64)
+            arrays['sum'] = np.bincount(group, weights=values, minlength=groups)
+            arrays['min'] = np.full(groups, np.inf)
+            arrays['max'] = np.full(groups, -np.inf)
+            np.minimum.at(arrays['min'], group, values)
+            np.maximum.at(arrays['max'], group, values)
+            # exact (value, count) pairs per group, then compressed per group
+            order = np.lexsort((values, group))
+            g, v = group[order], values[order]
+            new = np.concatenate([[True], (g[1:] != g[:-1]) | (v[1:] != v[:-1])])
+            starts = np.flatnonzero(new)
+            g, v = g[starts], v[starts]
+            w = np.diff(np.append(starts, len(order))).astype(np.float64)
+            means, weights, owner = compress_centroids(v, w, self.compression, owner=g)
+            offsets = np.zeros(groups + 1, dtype=np.int64)
+            np.cumsum(np.bincount(owner, minlength=groups), out=offsets[1:])
+            arrays['td.means'] = means
+            arrays['td.weights'] = weights
+            arrays['td.offsets'] = offsets
+
+        if self.item is not None:
+            arrays['cm'] = cm_tables(hash_keys(facts[self.item]), 1, group, groups,
+                                     self.width, self.depth)
+
+        path = self.partition_path(ds)
+        tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+        os.makedirs(tmp)
+        for name, values in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), values)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(tmp, path)
+        return groups
+
+    def _load(self, ds, name):
+        return np.load(os.path.join(self.partition_path(ds), name + '.npy'), mmap_mode='r')
+
+    def query(self, ds_min, ds_max, group_by=(), where=None):
+        '''{group key tuple: MetricResult} over ds_min..ds_max, from the sketches alone.'''
+        for d in list(group_by) + list(where or {}):
+            if d not in self.dimensions:
+                raise ValueError('{0} has no dimension {1}'.format(self.name, d))
+        where = dict((d, set([v]) if isinstance(v, str) else set(v))
+                     for d, v in (where or {}).items())
+        # first pass over the key columns only: which rows of which ds feed which output group
+        plan, labels = [], []
+        for ds in ds_range(ds_min, ds_max):
+            if not os.path.isdir(self.partition_path(ds)):
+                continue
+            keys = dict((d, self._load(ds, 'key.' + d)) for d in self.dimensions)
+            rows = np.ones(len(keys[self.dimensions[0]]), dtype=bool)
+            for d, allowed in where.items():
+                rows &= np.isin(keys[d], list(allowed))
+            rows = np.flatnonzero(rows)
+            if len(rows):
+                plan.append((ds, rows))
+                labels.append([np.asarray(keys[d][rows]).astype(str) for d in group_by])
+        if group_by and plan:
+            stacked = [np.concatenate([l[i] for l in labels]) for i in range(len(group_by))]
+            combined = np.rec.fromarrays(stacked) if len(stacked) > 1 else stacked[0]
+            out_labels, inverse = np.unique(combined, return_inverse=True)
+            out_keys = [tuple(str(x) for x in (label if len(stacked) > 1 else (label,)))
+                        for label in out_labels.tolist()]
+        else:
+            out_keys = [()] if plan else []
+            inverse = np.zeros(sum(len(rows) for _, rows in plan), dtype=np.int64)
+        bounds = np.cumsum([0] + [len(rows) for _, rows in plan])
+        plan = [(ds, rows, inverse[bounds[i]:bounds[i + 1]]) for i, (ds, rows) in enumerate(plan)]
+
+        groups = len(out_keys)
+        hll = np.zeros((groups, 1 << self.p), dtype=np.uint8)
+        count = np.zeros(groups, dtype=np.int64)
+        cm = np.zeros((groups, self.width * self.depth), dtype=np.int64) \
+            if self.item is not None else None
+        total = np.zeros(groups)
+        lo, hi = np.full(groups, np.inf), np.full(groups, -np.inf)
+        td_means, td_weights, td_owner = [], [], []
+        for ds, rows, target in plan:
+            order = np.argsort(target, kind='stable')
+            rows, target = rows[order], target[order]
+            starts = np.flatnonzero(np.concatenate([[True], target[1:] != target[:-1]]))
+            into = target[starts]
+
+            ends = np.append(starts[1:], len(rows))
+
+            def fold(ufunc, out, name):
+                block = self._load(ds, name)
+                if len(starts) > 1 or len(rows) < len(block):
+                    block = block[rows]
+                if block.ndim == 1:
+                    out[into] = ufunc(out[into], ufunc.reduceat(block, starts))
+                    return
+                # reduceat along rows of a wide block is slow, reduce each run of rows
+                for t, a, b in zip(into.tolist(), starts.tolist(), ends.tolist()):
+                    ufunc(out[t], ufunc.reduce(block[a:b], axis=0), out=out[t])
+
+            fold(np.maximum, hll, 'hll')
+            fold(np.add, count, 'count')
+            if cm is not None:
+                fold(np.add, cm, 'cm')
+            if self.measure is not None:
+                fold(np.add, total, 'sum')
+                fold(np.minimum, lo, 'min')
+                fold(np.maximum, hi, 'max')
+                # the centroids of every selected row, by index: offsets[r]..offsets[r + 1]
+                offsets = np.asarray(self._load(ds, 'td.offsets'))
+                first, lengths = offsets[rows], offsets[rows + 1] - offsets[rows]
+                run = np.repeat(first - np.cumsum(lengths) + lengths, lengths)
+                picked = run + np.arange(int(lengths.sum()))
+                td_means.append(np.asarray(self._load(ds, 'td.means'))[picked])
+                td_weights.append(np.asarray(self._load(ds, 'td.weights'))[picked])
+                td_owner.append(np.repeat(target, lengths))
+
+        digests = {}
+        if td_means:
+            m, w, owner = compress_centroids(np.concatenate(td_means), np.concatenate(td_weights),
+                                             self.compression, owner=np.concatenate(td_owner))
+            cuts = np.searchsorted(owner, np.arange(groups + 1))
+            for t in np.flatnonzero(np.diff(cuts)).tolist():
+                digests[t] = TDigest(self.compression, m[cuts[t]:cuts[t + 1]].tolist(),
+                                     w[cuts[t]:cuts[t + 1]].tolist(), lo[t], hi[t])
+
+        results = {}
+        for t, key in enumerate(out_keys):
+            digest = digests.get(t)
+            frequency = CountMinSketch(self.width, self.depth, cm[t].tolist()) \
+                if cm is not None else None
+            results[key] = MetricResult(key, int(count[t]), float(total[t]),
+                                        HyperLogLog(self.p, hll[t].tobytes()), digest, frequency)
+        return results
+
+
+def synthetic_bookings(ds, rows, users=500000, markets=50, listings=200000):
+    '''A day of bookings facts with a user, a market, a subscription and a value.'''
+    rng = np.random.default_rng(int(ds.replace('-', '')))
+    id_user = (rng.zipf(1.3, rows) % users).astype(np.int64)
+    id_listing = (rng.zipf(1.2, rows) % listings).astype(np.int64)
+    return {
+        'id_user': id_user,
+        'id_listing': id_listing,
+        'dim_market': np.array(['market_{0}'.format(i) for i in range(markets)])[
+            (id_listing * 7919) % markets],
+        'subscription_type': np.array(['free', 'awesome', 'pluses'])[id_user % 3],
+        'm_value': np.round(rng.lognormal(4.5, 0.8, rows), 2),
+        }
+
+
+def _exact(facts_by_ds, ds_list, group_by, where, what, item=None):
+    '''The rescan: concatenate the facts of every ds and group them.'''
+    columns = set([what] + list(group_by) + list(where))
+    facts = dict((c, np.concatenate([facts_by_ds[ds][c] for ds in ds_list])) for c in columns)
+    keep = np.ones(len(facts[what]), dtype=bool)
+    for d, v in where.items():
+        keep &= facts[d] == v
+    values = facts[what][keep]
+    if group_by:
+        keys = np.rec.fromarrays([facts[d][keep] for d in group_by])
+        labels, group = np.unique(keys, return_inverse=True)
+        labels = [tuple(str(x) for x in label) for label in labels.tolist()]
+    else:
+        labels, group = [()], np.zeros(len(values), dtype=np.int64)
+    out = {}
+    for i, label in enumerate(labels):
+        mine = values[group == i]
+        if what == 'id_user':
+            out[label] = len(np.unique(mine))
+        elif what == 'id_listing':
+            out[label] = int((mine == item).sum())
+        else:
+            out[label] = np.sort(mine)
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='sketch-backed metrics vs exact rescans')
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--rows', type=int, default=200000, help='bookings per ds')
+    parser.add_argument('--distinct-error', type=float, default=0.01)
+    parser.add_argument('--compression', type=float, default=200)
+    args = parser.parse_args(argv)
+
+    tmp = tempfile.mkdtemp(prefix='metrics-')
+    try:
+        layer = MetricsLayer(tmp, 'bookings', ('dim_market', 'subscription_type'),
+                             distinct='id_user', measure='m_value', item='id_listing',
+                             distinct_error=args.distinct_error, compression=args.compression)
+        ds_list = ds_range('2018-01-10', ds_add('2018-01-10', args.days - 1))
+        facts_by_ds = {}
+        t = time.time()
+        for ds in ds_list:
+            facts_by_ds[ds] = synthetic_bookings(ds, args.rows)
+            layer.build(ds, facts_by_ds[ds])
+        print('{0} days x {1:,} bookings sketched in {2:.1f}s (HLL p={3}, t-digest {4:g}, '
+              'count-min {5}x{6})'.format(args.days, args.rows, time.time() - t, layer.p,
+                                          args.compression, layer.depth, layer.width))
+
+        week = ds_list[-7:]
+        queries = [
+            ('distinct users by market, all days', ds_list, ('dim_market',), {}, 'id_user'),
+            ('distinct users by subscription, 7d', week, ('subscription_type',), {}, 'id_user'),
+            ('distinct users, awesome, all days', ds_list, (), {'subscription_type': 'awesome'},
+             'id_user'),
+            ('p50/p95/p99 value by subscription', ds_list, ('subscription_type',), {}, 'm_value'),
+            ('bookings of top listings, all days', ds_list, (), {}, 'id_listing'),
+            ]
+        for label, days, group_by, where, what in queries:
+            t = time.time()
+            result = layer.query(days[0], days[-1], group_by, where)
+            sketch_ms = 1000 * (time.time() - t)
+            t = time.time()
+            if what == 'id_listing':
+                exact = dict((item, _exact(facts_by_ds, days, group_by, where, what, item)[()])
+                             for item in range(5))
+            else:
+                exact = _exact(facts_by_ds, days, group_by, where, what)
+            exact_ms = 1000 * (time.time() - t)
+            errors = []
+            if what == 'id_user':
+                for key, value in exact.items():
+                    errors.append(abs(result[key].distinct - value) / float(value))
+            elif what == 'm_value':
+                for key, values in exact.items():
+                    for q in (0.5, 0.95, 0.99):
+                        truth = values[min(len(values) - 1, int(q * len(values)))]
+                        errors.append(abs(result[key].quantile(q) - truth) / truth)
+            else:
+                total = result[()].count
+                for item, value in exact.items():
+                    # count-min error is relative to the total count
+                    errors.append((result[()].frequency(item) - value) / float(total))
+            print('{0:<38} sketch {1:8.2f} ms  exact {2:9.2f} ms  error mean {3:.3%} max {4:.3%}'.format(
+                label, sketch_ms, exact_ms, sum(errors) / len(errors), max(errors)))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,416 @@
+'''
+Partition statistics index
+
+The guide calls WHERE ds <= '{{ ds }}' "expensive": the
+query opens every partition of the table, even when the
+answer lives in a handful of them. The engine has
+nothing that tells it which partitions can be skipped.
+
+PartitionIndex is a small SQLite file next to the
+warehouse that records, for every (table, ds):
+
+    - row count and bytes on disk
+    - min, max and null count of every column
+    - a bloom filter over key columns (id_listing, ...)
+
+It is written when a partition is published (see
+StageCheckExchange(index=...) and LocalEngine(index=...)),
+so reading it never lists storage: LocalEngine takes
+its partition list from it, and query(sql, prune=...)
+reads only what prune() keeps. prune() turns a ds range plus equality
+or range predicates into the partitions that can hold a
+matching row: min/max rule out partitions whose range
+misses the value, the bloom filter rules out most of
+those where the value is in range but absent. Counts
+over a ds range come straight from the index, and
+IndexedPartitionSensor pokes the index instead of the
+filesystem.
+
+    python partition_index.py --days 365 --rows 100000 --lookups 200
+
+compares listing lookups over WHERE ds <= '{{ ds }}'
+with and without the index, in latency and bytes read.
+'''
+import argparse
+import math
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import numpy as np
+
+from backfill import ds_add, ds_range
+from partition_sensor import render_partition
+from sketches import mix64, hash_keys
+from stage_check_exchange import ColumnScan, write_partition
+
+_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS partitions (
+        table_name TEXT, ds TEXT, path TEXT, rows INTEGER, bytes INTEGER,
+        PRIMARY KEY (table_name, ds))''',
+    '''CREATE TABLE IF NOT EXISTS columns (
+        table_name TEXT, ds TEXT, column_name TEXT,
+        min_value, max_value, nulls INTEGER,
+        PRIMARY KEY (table_name, ds, column_name))''',
+    '''CREATE TABLE IF NOT EXISTS blooms (
+        table_name TEXT, ds TEXT, column_name TEXT, m INTEGER, k INTEGER, bits BLOB,
+        PRIMARY KEY (table_name, ds, column_name))''',
+    ]
+
+
+class BloomFilter(object):
+    '''
+    Bloom filter over the hashes of a column, k probes
+    by double hashing. Numeric keys are hashed in NumPy,
+    anything else through blake2b (sketches.hash_keys). m is a power
+    of two, so partitions of similar size share m and a
+    lookup can be probed against all of them at once.
+    '''
+
+    __slots__ = ('m', 'k', 'bits')
+
+    def __init__(self, m, k, bits=None):
+        self.m = m
+        self.k = k
+        self.bits = bits if bits is not None else np.zeros((m + 7) // 8, dtype=np.uint8)
+
+    @classmethod
+    def for_capacity(cls, n, error=0.01):
+        needed = -max(n, 1) * math.log(error) / math.log(2) ** 2
+        m = 1 << max(6, int(math.ceil(math.log(needed, 2))))
+        return cls(m, max(1, int(math.ceil(-math.log(error, 2)))))
+
+    def _positions(self, hashes):
+        h1 = hashes
+        h2 = mix64(hashes ^ np.uint64(0x9E3779B97F4A7C15)) | np.uint64(1)
+        m = np.uint64(self.m)
+        with np.errstate(over='ignore'):
+            return [(h1 + np.uint64(i) * h2) % m for i in range(self.k)]
+
+    def probes(self, value):
+        '''[(byte offset, bit mask)] that must all be set for value to be present.'''
+        return [(int(pos[0]) >> 3, 1 << (int(pos[0]) & 7))
+                for pos in self._positions(hash_keys([value]))]
+
+    def add(self, values):
+        hashes = np.unique(hash_keys(values))
+        for pos in self._positions(hashes):
+            np.bitwise_or.at(self.bits, (pos >> np.uint64(3)).astype(np.intp),
+                             (np.uint8(1) << (pos & np.uint64(7)).astype(np.uint8)))
+
+    def __contains__(self, value):
+        return all(self.bits[offset] & mask for offset, mask in self.probes(value))
+
+
+def _sql_value(value):
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, bytes):
+        value = value.decode()
+    return value
+
+
+def partition_bytes(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+class PartitionIndex(object):
+    '''
+    Statistics of every ds partition, in one SQLite file.
+
+        index = PartitionIndex('warehouse/_index.db',
+                               bloom_columns={'fct_bookings': ['id_listing']})
+        index.record('fct_bookings', ds, path)
+        for ds in index.prune('fct_bookings', ds_max=ds, equals={'id_listing': 42}):
+            ...
+
+    Strings are compared in code point order, floats
+    ignore NaN, and a column that is all NULL in a
+    partition has no min/max, so it is never pruned on.
+    '''
+
+    def __init__(self, path, bloom_columns=None, bloom_error=0.01):
+        self.path = path
+        self.bloom_columns = dict(bloom_columns or {})
+        self.bloom_error = bloom_error
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        for statement in _SCHEMA:
+            self.connection.execute(statement)
+        self.connection.commit()
+
+    def record(self, table, ds, path, bloom_columns=None, columns=None):
+        '''
+        Compute and store the statistics of the partition
+        at path: its .npy columns, or `columns` ({name:
+        array}) when it is stored in another format.
+        '''
+        if columns is None:
+            scan = ColumnScan(path)
+            names = sorted(f[:-4] for f in os.listdir(path) if f.endswith('.npy'))
+        else:
+            scan = ColumnScan.from_columns(columns)
+            names = sorted(columns)
+        if bloom_columns is None:
+            bloom_columns = self.bloom_columns.get(table, ())
+        column_rows, bloom_rows = [], []
+        for name in names:
+            values = scan.values(name)
+            lo = hi = None
+            if len(values) and values.dtype.kind in 'USO':
+                distinct = scan.distinct(name)
+                lo, hi = _sql_value(distinct[0]), _sql_value(distinct[-1])
+            elif len(values):
+                lo, hi = _sql_value(values.min()), _sql_value(values.max())
+            column_rows.append((table, ds, name, lo, hi, int(scan.nulls(name).sum())))
+            if name in bloom_columns:
+                bloom = BloomFilter.for_capacity(len(values), self.bloom_error)
+                bloom.add(values)
+                bloom_rows.append((table, ds, name, bloom.m, bloom.k, bloom.bits.tobytes()))
+        with self.connection:
+            self.remove(table, ds, commit=False)
+            self.connection.execute('INSERT INTO partitions VALUES (?, ?, ?, ?, ?)',
+                                    (table, ds, path, scan.row_count, partition_bytes(path)))
+            self.connection.executemany('INSERT INTO columns VALUES (?, ?, ?, ?, ?, ?)',
+                                        column_rows)
+            self.connection.executemany('INSERT INTO blooms VALUES (?, ?, ?, ?, ?, ?)', bloom_rows)
+
+    def remove(self, table, ds, commit=True):
+        for name in ('partitions', 'columns', 'blooms'):
+            self.connection.execute(
+                'DELETE FROM {0} WHERE table_name = ? AND ds = ?'.format(name), (table, ds))
+        if commit:
+            self.connection.commit()
+
+    @staticmethod
+    def _ds_filter(ds_min, ds_max):
+        sql, params = '', []
+        if ds_min is not None:
+            sql += ' AND p.ds >= ?'
+            params.append(ds_min)
+        if ds_max is not None:
+            sql += ' AND p.ds <= ?'
+            params.append(ds_max)
+        return sql, params
+
+    def tables(self):
+        return [row[0] for row in self.connection.execute(
+            'SELECT DISTINCT table_name FROM partitions ORDER BY table_name')]
+
+    def partitions(self, table, ds_min=None, ds_max=None):
+        '''[(ds, path)] of the table's partitions in the range, from the index only.'''
+        where, params = self._ds_filter(ds_min, ds_max)
+        return self.connection.execute(
+            'SELECT p.ds, p.path FROM partitions p WHERE p.table_name = ?' + where +
+            ' ORDER BY p.ds', [table] + params).fetchall()
+
+    def stats(self, table, ds):
+        row = self.connection.execute(
+            'SELECT rows, bytes FROM partitions WHERE table_name = ? AND ds = ?',
+            (table, ds)).fetchone()
+        if row is None:
+            return None
+        columns = dict((name, {'min': lo, 'max': hi, 'nulls': nulls})
+                       for name, lo, hi, nulls in self.connection.execute(
+                               'SELECT column_name, min_value, max_value, nulls FROM columns '
+                               'WHERE table_name = ? AND ds = ?', (table, ds)))
+        return {'rows': row[0], 'bytes': row[1], 'columns': columns}
+
+    def row_count(self, table, ds_min=None, ds_max=None):
+        '''SELECT COUNT(*) ... WHERE ds in range, without opening a partition.'''
+        where, params = self._ds_filter(ds_min, ds_max)
+        return self.connection.execute(
+            'SELECT COALESCE(SUM(p.rows), 0) FROM partitions p WHERE p.table_name = ?' + where,
+            [table] + params).fetchone()[0]
+
+    def exists(self, table, ds, min_rows=0):
+        row = self.connection.execute(
+            'SELECT rows FROM partitions WHERE table_name = ? AND ds = ?', (table, ds)).fetchone()
+        return row is not None and row[0] >= min_rows
+
+    def prune(self, table, ds_min=None, ds_max=None, equals=None, ranges=None):
+        '''
+        [(ds, path)] of the partitions that may hold rows
+        with column == value for every item of `equals`
+        and lo <= column <= hi for every (lo, hi) of
+        `ranges` (None for an open end).
+        '''
+        where, params = self._ds_filter(ds_min, ds_max)
+        predicates = [(name, value, value) for name, value in (equals or {}).items()]
+        predicates += [(name, lo, hi) for name, (lo, hi) in (ranges or {}).items()]
+        for name, lo, hi in predicates:
+            # no stats for the column (all NULL): keep the partition
+            where += (' AND NOT EXISTS (SELECT 1 FROM columns c WHERE c.table_name = p.table_name'
+                      ' AND c.ds = p.ds AND c.column_name = ? AND c.min_value IS NOT NULL AND (0')
+            params.append(name)
+            if hi is not None:
+                where += ' OR c.min_value > ?'
+                params.append(_sql_value(hi))
+            if lo is not None:
+                where += ' OR c.max_value < ?'
+                params.append(_sql_value(lo))
+            where += '))'
+        candidates = self.connection.execute(
+            'SELECT p.ds, p.path FROM partitions p WHERE p.table_name = ?' + where +
+            ' ORDER BY p.ds', [table] + params).fetchall()
+        if not equals or not candidates:
+            return candidates
+        absent = set()
+        for name, value in equals.items():
+            absent.update(self._bloom_absent(table, name, value, candidates[0][0],
+                                             candidates[-1][0]))
+        return [(ds, path) for ds, path in candidates if ds not in absent]
+
+    def _bloom_absent(self, table, name, value, ds_min, ds_max):
+        '''
+        ds values whose bloom filter on `name` rules value
+        out. Only the k probed bytes of each filter are
+        read, with substr(), grouped by filter size.
+        '''
+        absent = []
+        shapes = self.connection.execute(
+            'SELECT DISTINCT m, k FROM blooms WHERE table_name = ? AND column_name = ? '
+            'AND ds >= ? AND ds <= ?', (table, name, ds_min, ds_max)).fetchall()
+        for m, k in shapes:
+            probes = BloomFilter(m, k, bits=b'').probes(value)
+            select = ', '.join('substr(bits, {0}, 1)'.format(offset + 1) for offset, _ in probes)
+            for row in self.connection.execute(
+                    'SELECT ds, {0} FROM blooms WHERE table_name = ? AND column_name = ? '
+                    'AND m = ? AND k = ? AND ds >= ? AND ds <= ?'.format(select),
+                    (table, name, m, k, ds_min, ds_max)):
+                if not all(byte[0] & mask for byte, (_, mask) in zip(row[1:], probes)):
+                    absent.append(row[0])
+        return absent
+
+    def close(self):
+        self.connection.close()
+
+
+class IndexedPartitionSensor(object):
+    '''
+    NamedHivePartitionSensor against the index: a poke is
+    one primary key lookup instead of a storage listing,
+    and min_rows=1 also waits out empty partitions.
+    Partition names look like 'fct_bookings/ds={{ ds }}'.
+    '''
+
+    def __init__(self, task_id, partition_names, index, min_rows=1, poke_interval=60):
+        self.task_id = task_id
+        self.partition_names = list(partition_names)
+        self.index = index
+        self.min_rows = min_rows
+        self.poke_interval = poke_interval
+
+    def poke(self, ds):
+        for name in self.partition_names:
+            table, _, spec = render_partition(name, ds).partition('/')
+            if not self.index.exists(table, spec.split('=', 1)[1], self.min_rows):
+                return False
+        return True
+
+    def execute(self, ds):
+        while not self.poke(ds):
+            time.sleep(self.poke_interval)
+
+
+def synthetic_fct_bookings(ds_list, rows, window=2000000, step=20000, seed=0):
+    '''
+    Yield (ds, columns) for fct_bookings. Listings are
+    created over time, so each one books within a span
+    of window / step days, as a real listing would.
+    '''
+    rng = np.random.default_rng(seed)
+    for day, ds in enumerate(ds_list):
+        id_listing = rng.integers(day * step, day * step + window, rows)
+        yield ds, {
+            'id_listing': id_listing,
+            'id_host': id_listing // 7,
+            'm_bookings': (rng.random(rows) < 0.3).astype(np.int64),
+            }
+
+
+def _lookup_scan(root, table, listing, ds_max):
+    '''Today's way: list the table and open id_listing of every partition up to ds_max.'''
+    total, scanned = 0, 0
+    table_path = os.path.join(root, table)
+    for name in sorted(os.listdir(table_path)):
+        if not name.startswith('ds=') or name[3:] > ds_max:
+            continue
+        path = os.path.join(table_path, name)
+        keys = np.load(os.path.join(path, 'id_listing.npy'))
+        scanned += os.path.getsize(os.path.join(path, 'id_listing.npy'))
+        hit = keys == listing
+        if hit.any():
+            total += int(np.load(os.path.join(path, 'm_bookings.npy'))[hit].sum())
+            scanned += os.path.getsize(os.path.join(path, 'm_bookings.npy'))
+    return total, scanned
+
+
+def _lookup_indexed(index, table, listing, ds_max):
+    total, scanned = 0, 0
+    for ds, path in index.prune(table, ds_max=ds_max, equals={'id_listing': listing}):
+        keys = np.load(os.path.join(path, 'id_listing.npy'))
+        scanned += os.path.getsize(os.path.join(path, 'id_listing.npy'))
+        hit = keys == listing
+        if hit.any():
+            total += int(np.load(os.path.join(path, 'm_bookings.npy'))[hit].sum())
+            scanned += os.path.getsize(os.path.join(path, 'm_bookings.npy'))
+    return total, scanned
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='partition pruning with a statistics index')
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--rows', type=int, default=100000, help='fct_bookings rows per ds')
+    parser.add_argument('--lookups', type=int, default=200)
+    args = parser.parse_args(argv)
+
+    tmp = tempfile.mkdtemp(prefix='partindex-')
+    try:
+        ds_list = ds_range('2017-02-09', ds_add('2017-02-09', args.days - 1))
+        index = PartitionIndex(os.path.join(tmp, '_index.db'),
+                               bloom_columns={'fct_bookings': ['id_listing']})
+        t = time.time()
+        for ds, columns in synthetic_fct_bookings(ds_list, args.rows):
+            path = os.path.join(tmp, 'fct_bookings', 'ds={0}'.format(ds))
+            write_partition(path, columns)
+            index.record('fct_bookings', ds, path)
+        print('{0} days x {1} rows written and indexed in {2:.1f}s ({3:.0f} KB of index)'.format(
+            args.days, args.rows, time.time() - t, os.path.getsize(index.path) / 1024.0))
+
+        rng = np.random.default_rng(1)
+        ds_max = ds_list[-1]
+        top = (args.days - 1) * 20000 + 2000000
+        listings = rng.integers(0, top, args.lookups).tolist()
+        results = {}
+        for label, lookup in (('scan', lambda l: _lookup_scan(tmp, 'fct_bookings', l, ds_max)),
+                              ('index', lambda l: _lookup_indexed(index, 'fct_bookings', l, ds_max))):
+            latencies, scanned = [], 0
+            for listing in listings:
+                t = time.time()
+                total, read = lookup(listing)
+                latencies.append(time.time() - t)
+                scanned += read
+                assert results.setdefault(listing, total) == total, listing
+            print("{0:<6} id_listing = ? AND ds <= '{1}': p50 {2:7.2f} ms  p95 {3:7.2f} ms  "
+                  "{4:8.1f} MB read per query".format(
+                      label, ds_max, 1000 * _percentile(latencies, 0.5),
+                      1000 * _percentile(latencies, 0.95), scanned / args.lookups / 2 ** 20))
+
+        t = time.time()
+        count = index.row_count('fct_bookings', ds_max=ds_list[len(ds_list) // 2])
+        print('COUNT(*) over half the table from the index: {0} rows in {1:.2f} ms'.format(
+            count, 1000 * (time.time() - t)))
+        index.close()
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,416 @@
+'''
+Event-driven partition sensors
+
+In anatomy_of_a_dag every entry of wf_dependencies
+becomes a NamedHivePartitionSensor that pokes the
+metastore on a timer:
+
+    'wf_upstream_table_1': 'upstream_table_1/ds={{ ds }}'
+
+Each of those sensors holds a worker slot for as long
+as it waits, and on average the partition sits there
+for half a poke interval before anyone notices it.
+
+Here partitions are published to a change log: an
+append-only file with one partition name per line,
+next to a local warehouse directory laid out as
+<table>/ds=<ds>/ (our metastore stand-in). A single
+PartitionWatcher tails that log for the whole process
+and serves every sensor in every DAG run. On Linux it
+blocks on inotify, so it wakes up as soon as the log
+is written to; elsewhere it falls back to a short
+sleep on the log size, which is still one cheap stat
+for all sensors instead of one metastore query each.
+
+Sensors do not sit in a slot while they wait. They
+register a callback with the watcher and the task is
+started from that callback the moment its last
+partition lands. Callbacks run on a small thread pool,
+so a slow one does not hold up the watcher or the
+other sensors.
+
+    python partition_sensor.py --runs 20 --poke-interval 1
+
+runs the benchmark against polling sensors.
+'''
+import argparse
+import ctypes
+import ctypes.util
+import os
+import random
+import select
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from backfill import ds_add
+
+CHANGELOG = '_changelog'
+
+IN_MODIFY = 0x00000002
+_EVENT_HEADER = struct.calcsize('iIII')
+
+
+def render_partition(partition_name, ds):
+    '''upstream_table_1/ds={{ ds }} -> upstream_table_1/ds=2018-02-09'''
+    return partition_name.replace('{{ ds }}', ds).replace('{{ds}}', ds)
+
+
+def partition_path(root, partition_name):
+    return os.path.join(root, *partition_name.split('/'))
+
+
+def publish(root, partition_name):
+    '''
+    Land a partition: create its directory, then
+    append it to the change log. Writers must go
+    through here (or append to the log themselves)
+    for event-driven sensors to see the partition.
+    '''
+    path = partition_path(root, partition_name)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    with open(os.path.join(root, CHANGELOG), 'a') as f:
+        f.write(partition_name + '\n')
+        f.flush()
+
+
+class _Inotify(object):
+    '''Just enough of inotify(7) through ctypes to wait on one file.'''
+
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        if libc.inotify_add_watch(self.fd, path.encode(), IN_MODIFY) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, 'inotify_add_watch failed')
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable:
+            # drain the queued events, we only care that something changed
+            os.read(self.fd, 64 * _EVENT_HEADER)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _StatWait(object):
+    '''Fallback for platforms without inotify: watch the log size.'''
+
+    def __init__(self, path, interval=0.01):
+        self.path = path
+        self.interval = interval
+        self.size = os.path.getsize(path)
+
+    def wait(self, timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            size = os.path.getsize(self.path)
+            if size != self.size:
+                self.size = size
+                return
+            time.sleep(self.interval)
+
+    def close(self):
+        pass
+
+
+class PartitionWatcher(object):
+    '''
+    One background thread that tails the change log of
+    a warehouse root and hands the callbacks registered
+    for landed partitions to a pool of `workers` threads.
+    Safe to share between any number of sensors and DAG
+    runs. busy_seconds is the time the watcher spent
+    reading the log and the callbacks spent running.
+    With a PartitionIndex, a partition that is already
+    there is looked up in the index, not on storage.
+    '''
+
+    def __init__(self, root, use_inotify=True, workers=4, index=None):
+        self.root = root
+        self.index = index
+        self.log_path = os.path.join(root, CHANGELOG)
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        open(self.log_path, 'a').close()
+        self.landed = set()
+        self._offset = 0
+        self._waiters = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix='partition-callback')
+        self.busy_seconds = 0.0
+        self._waiter = None
+        if use_inotify and sys.platform.startswith('linux'):
+            try:
+                self._waiter = _Inotify(self.log_path)
+            except OSError:
+                self._waiter = None
+        if self._waiter is None:
+            self._waiter = _StatWait(self.log_path)
+        self._read_log()
+        self._thread = threading.Thread(target=self._run, name='partition-watcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read_log(self):
+        with open(self.log_path, 'rb') as f:
+            f.seek(self._offset)
+            chunk = f.read()
+        # only consume whole lines, a writer may be halfway through one
+        end = chunk.rfind(b'\n') + 1
+        self._offset += end
+        fired = []
+        with self._lock:
+            for name in chunk[:end].decode().splitlines():
+                if name and name not in self.landed:
+                    self.landed.add(name)
+                    fired.extend(self._waiters.pop(name, []))
+        for callback in fired:
+            self._pool.submit(self._call, callback)
+
+    def _call(self, callback):
+        begin = time.time()
+        try:
+            callback()
+        finally:
+            with self._lock:
+                self.busy_seconds += time.time() - begin
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._waiter.wait(0.5)
+            begin = time.time()
+            self._read_log()
+            with self._lock:
+                self.busy_seconds += time.time() - begin
+
+    def _exists(self, partition_name):
+        table, _, spec = partition_name.partition('/')
+        if self.index is not None and spec.startswith('ds='):
+            return self.index.exists(table, spec[3:])
+        return os.path.isdir(partition_path(self.root, partition_name))
+
+    def on_partition(self, partition_name, callback):
+        '''
+        Call callback() once partition_name has
+        landed, straight away if it already has.
+        '''
+        with self._lock:
+            if partition_name not in self.landed:
+                if not self._exists(partition_name):
+                    self._waiters.setdefault(partition_name, []).append(callback)
+                    return
+                self.landed.add(partition_name)
+        callback()
+
+    def cancel(self, partition_name, callback):
+        '''Unregister a callback that has not fired; False if it already has.'''
+        with self._lock:
+            waiting = self._waiters.get(partition_name, [])
+            if callback not in waiting:
+                return False
+            waiting.remove(callback)
+            if not waiting:
+                del self._waiters[partition_name]
+            return True
+
+    def pending(self):
+        with self._lock:
+            return sum(len(v) for v in self._waiters.values())
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self._pool.shutdown(wait=True)
+        self._waiter.close()
+
+
+class EventPartitionSensor(object):
+    '''
+    Drop-in for NamedHivePartitionSensor in event mode.
+    Takes the same templated partition_names, but
+    instead of poking it registers with the shared
+    watcher and calls on_ready(task_id, ds) when every
+    partition for that ds has landed.
+    '''
+
+    def __init__(self, task_id, partition_names, watcher):
+        self.task_id = task_id
+        self.partition_names = list(partition_names)
+        self.watcher = watcher
+
+    def arm(self, ds, on_ready):
+        '''Call on_ready(task_id, ds) once ready; returns a disarm() that unregisters it.'''
+        names = [render_partition(p, ds) for p in self.partition_names]
+        remaining = [len(names)]
+        lock = threading.Lock()
+
+        def landed():
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            on_ready(self.task_id, ds)
+
+        for name in names:
+            self.watcher.on_partition(name, landed)
+
+        def disarm():
+            for name in names:
+                self.watcher.cancel(name, landed)
+        return disarm
+
+    def wait(self, ds, timeout=None):
+        '''Blocking form, for callers that do want to hold a thread.'''
+        done = threading.Event()
+        disarm = self.arm(ds, lambda task_id, ds: done.set())
+        if not done.wait(timeout):
+            disarm()
+        return done.is_set()
+
+
+class PollingPartitionSensor(object):
+    '''
+    What NamedHivePartitionSensor does today: hold a slot
+    and check every poke_interval seconds. Kept here as
+    the baseline for the benchmark.
+    '''
+
+    def __init__(self, task_id, partition_names, root, poke_interval=60):
+        self.task_id = task_id
+        self.partition_names = list(partition_names)
+        self.root = root
+        self.poke_interval = poke_interval
+
+    def poke(self, ds):
+        return all(os.path.isdir(partition_path(self.root, render_partition(p, ds)))
+                   for p in self.partition_names)
+
+    def execute(self, ds):
+        while not self.poke(ds):
+            time.sleep(self.poke_interval)
+
+
+def sensors_from_spec(spec, watcher):
+    return [EventPartitionSensor(task_id, [name], watcher)
+            for task_id, name in sorted(spec.wf_dependencies.items())]
+
+
+def _landing_schedule(spec, runs, window, seed):
+    rng = random.Random(seed)
+    schedule = []
+    for i in range(runs):
+        ds = ds_add('2018-02-01', i)
+        for task_id, name in sorted(spec.wf_dependencies.items()):
+            schedule.append((rng.uniform(0, window), task_id, ds, render_partition(name, ds)))
+    schedule.sort()
+    return schedule
+
+
+def _land_all(root, schedule, t0):
+    for at, _, _, name in schedule:
+        delay = t0 + at - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        publish(root, name)
+
+
+def bench_polling(spec, schedule, poke_interval):
+    root = tempfile.mkdtemp(prefix='poll-')
+    try:
+        landed_at = dict(((task_id, ds), at) for at, task_id, ds, _ in schedule)
+        started, slot_seconds = {}, [0.0]
+        lock = threading.Lock()
+        t0 = time.time() + 0.1
+
+        def occupy(sensor, ds):
+            begin = time.time()
+            sensor.execute(ds)
+            end = time.time()
+            with lock:
+                started[(sensor.task_id, ds)] = end - t0
+                slot_seconds[0] += end - begin
+
+        threads = []
+        for task_id, name in sorted(spec.wf_dependencies.items()):
+            sensor = PollingPartitionSensor(task_id, [name], root, poke_interval)
+            for ds in sorted(set(ds for _, _, ds, _ in schedule)):
+                t = threading.Thread(target=occupy, args=(sensor, ds))
+                t.start()
+                threads.append(t)
+        _land_all(root, schedule, t0)
+        for t in threads:
+            t.join()
+        return slot_seconds[0], [started[k] - landed_at[k] for k in landed_at]
+    finally:
+        shutil.rmtree(root)
+
+
+def bench_events(spec, schedule):
+    root = tempfile.mkdtemp(prefix='event-')
+    try:
+        landed_at = dict(((task_id, ds), at) for at, task_id, ds, _ in schedule)
+        started = {}
+        all_started = threading.Event()
+        lock = threading.Lock()
+        t0 = time.time() + 0.1
+        watcher = PartitionWatcher(root)
+
+        def on_ready(task_id, ds):
+            with lock:
+                started[(task_id, ds)] = time.time() - t0
+                if len(started) == len(landed_at):
+                    all_started.set()
+
+        for sensor in sensors_from_spec(spec, watcher):
+            for ds in sorted(set(ds for _, _, ds, _ in schedule)):
+                sensor.arm(ds, on_ready)
+        _land_all(root, schedule, t0)
+        all_started.wait()
+        watcher.close()
+        # no sensor holds a slot while waiting: what is used is the time the
+        # watcher thread read the log and the callbacks ran
+        return watcher.busy_seconds, [started[k] - landed_at[k] for k in landed_at]
+    finally:
+        shutil.rmtree(root)
+
+
+def _summary(label, slot_seconds, latencies):
+    latencies = sorted(latencies)
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    return '{0:<8} slot-seconds {1:9.2f}   landing->start p50 {2:7.3f}s  p99 {3:7.3f}s  max {4:7.3f}s'.format(
+            label, slot_seconds, p50, p99, latencies[-1])
+
+
+def main(argv=None):
+    from dag_spec import DagSpec
+
+    parser = argparse.ArgumentParser(description='polling vs event-driven partition sensors')
+    parser.add_argument('--runs', type=int, default=10, help='concurrent DAG runs')
+    parser.add_argument('--window', type=float, default=5.0,
+                        help='partitions land uniformly over this many seconds')
+    parser.add_argument('--poke-interval', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    spec = DagSpec.from_file()
+    schedule = _landing_schedule(spec, args.runs, args.window, args.seed)
+    print('{0} sensors x {1} DAG runs, {2} partitions over {3}s'.format(
+        len(spec.wf_dependencies), args.runs, len(schedule), args.window))
+    print(_summary('polling', *bench_polling(spec, schedule, args.poke_interval)))
+    print(_summary('events', *bench_events(spec, schedule)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,487 @@
+'''
+A result cache for the warehouse front-end
+
+The 500px notes end with "a front-end to this database
+... so that anyone can query the data". Once anyone
+can, a dozen people ask for likes by subscription_type
+over the last week every morning, each with their own
+spacing and capitalisation, and each one scans seven
+partitions of the likes fact table again.
+
+QueryCache sits in front of a LocalEngine:
+
+    - SQL is normalized (comments, whitespace and case
+      outside string literals, trailing ;) into the
+      cache key, so near-identical queries share it
+    - every result records the partitions it read, as
+      (table, first ds, last ds); rewriting a partition
+      through execute(), or calling invalidate(), drops
+      exactly the results whose range covers it
+    - entries are evicted least recently used first once
+      the results take more than max_bytes
+    - a query of the form
+          SELECT dims, SUM/COUNT/MIN/MAX/AVG(...)
+          FROM t WHERE ds BETWEEN a AND b [AND ...]
+          GROUP BY dims [ORDER BY ...] [LIMIT n]
+      is answered from one cached aggregate per ds
+      partition in the range, combined with NumPy. Next
+      week's query reuses six of this week's days and
+      only runs the new one. Days without a partition
+      cost nothing; a range over more than max_days
+      partitions, or over none, is cached as a whole.
+
+Anything else is cached as a whole. Each table it reads
+depends on the ds range its WHERE clause puts on that
+table, or on the whole table when there is none (a
+joined dimension, say) or it cannot be read off the
+query.
+
+    python query_cache.py --queries 2000 --days 60
+
+replays a synthetic query log, with partitions landing
+and being rewritten meanwhile, and reports hit rate and
+latency against running every query.
+'''
+import argparse
+import random
+import re
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from backfill import ds_add, ds_range
+from local_engine import LocalEngine, split_statements
+from run_ledger import hql_io
+
+_COMMENTS = re.compile(r'--[^\n]*|/\*.*?\*/', re.S)
+_LITERAL = re.compile(r"('(?:[^']|'')*')")
+_PUNCT = re.compile(r'\s*([(),=<>+*/])\s*')
+_DATE = r"'(\d{4}-\d{2}-\d{2})'"
+_QUERY = re.compile(r'^select (?P<items>.+?) from (?P<table>\w+) where (?P<where>.+?)'
+                    r'(?: group by (?P<group>.+?))?(?: order by (?P<order>.+?))?'
+                    r'(?: limit (?P<limit>\d+))?$')
+_AGG = re.compile(r'^(?P<fn>sum|count|min|max|avg)\((?P<arg>[^()]*)\)'
+                  r'(?:\s*(?:as\s+)?(?P<alias>\w+))?$')
+_COLUMN = re.compile(r'^\w+$')
+_FROM = re.compile(r'\bfrom (.+?)(?=\b(?:where|group by|order by|limit|union)\b|\)|$)')
+_JOIN = re.compile(r',| (?:natural )?(?:(?:left|right|full|inner|cross) )?(?:outer )?join ')
+
+
+def normalize(sql):
+    '''The cache key of a query: comments, spacing and case outside literals do not matter.'''
+    parts = _LITERAL.split(_COMMENTS.sub(' ', sql))
+    for i in range(0, len(parts), 2):
+        text = re.sub(r'\s+', ' ', parts[i].lower())
+        parts[i] = _PUNCT.sub(r'\1', text).replace('count(1)', 'count(*)')
+    return ''.join(parts).strip().rstrip(';').strip()
+
+
+def _split(text, sep=','):
+    '''Split on sep outside parentheses.'''
+    out, depth, start = [], 0, 0
+    for i, ch in enumerate(text):
+        if ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+        elif depth == 0 and text.startswith(sep, i):
+            out.append(text[start:i].strip())
+            start = i + len(sep)
+    out.append(text[start:].strip())
+    return out
+
+
+def ds_bounds(where):
+    '''(first ds, last ds, rest of the where clause) from a normalized WHERE.'''
+    lo = hi = None
+    m = re.search(r'\bds between {0} and {0}'.format(_DATE), where)
+    if m:
+        lo, hi = m.groups()
+        where = where.replace(m.group(0), '')
+    for op, value in re.findall(r'\bds(>=|<=|=){0}'.format(_DATE), where):
+        if op in ('>=', '='):
+            lo = max(lo, value) if lo else value
+        if op in ('<=', '='):
+            hi = min(hi, value) if hi else value
+    where = re.sub(r'\bds(?:>=|<=|=){0}'.format(_DATE), '', where)
+    rest = sorted(c for c in (t.strip() for t in _split(where, ' and ')) if c)
+    return lo, hi, rest
+
+
+class Aggregate(object):
+    '''A query that can be answered from per-ds partial aggregates.'''
+
+    def __init__(self, table, lo, hi, rest, items, group, order, limit):
+        self.table = table
+        self.lo, self.hi = lo, hi
+        self.rest = rest
+        self.items = items
+        self.group = group
+        self.order = order
+        self.limit = limit
+
+    @classmethod
+    def parse(cls, key):
+        m = _QUERY.match(key)
+        if m is None:
+            return None
+        lo, hi, rest = ds_bounds(m.group('where'))
+        if lo is None or hi is None or any(re.search(r'\bds\b|\bor\b', c) for c in rest):
+            return None
+        group = _split(m.group('group')) if m.group('group') else []
+        items = []
+        for item in _split(m.group('items')):
+            agg = _AGG.match(item)
+            if agg is not None:
+                if agg.group('arg').startswith('distinct'):
+                    return None
+                items.append(('agg', agg.group('fn'), agg.group('arg'), agg.group('alias') or item))
+            elif _COLUMN.match(item) and item in group:
+                items.append(('col', item, None, item))
+            else:
+                return None
+        if any(not _COLUMN.match(g) for g in group):
+            return None
+        names = [i[3] for i in items]
+        order = []
+        for term in _split(m.group('order')) if m.group('order') else []:
+            name, _, direction = term.partition(' ')
+            if name not in names or direction not in ('', 'asc', 'desc'):
+                return None
+            order.append((names.index(name), direction == 'desc'))
+        limit = int(m.group('limit')) if m.group('limit') else None
+        return cls(m.group('table'), lo, hi, rest, items, group, order, limit)
+
+    def parts(self):
+        '''Partial aggregates per ds: (function, argument, how they combine).'''
+        parts = []
+        for kind, fn, arg, _ in self.items:
+            if kind != 'agg':
+                continue
+            if fn == 'avg':
+                parts.extend([('sum', arg, 'sum'), ('count', arg, 'sum')])
+            else:
+                parts.append((fn, arg, {'count': 'sum'}.get(fn, fn)))
+        return parts
+
+    def daily_sql(self, ds):
+        select = self.group + ['{0}({1}) AS _p{2}'.format(fn, arg, i)
+                               for i, (fn, arg, _) in enumerate(self.parts())]
+        where = ["ds='{0}'".format(ds)] + self.rest
+        sql = 'select {0} from {1} where {2}'.format(','.join(select), self.table,
+                                                     ' and '.join(where))
+        if self.group:
+            sql += ' group by {0}'.format(','.join(self.group))
+        return sql
+
+    def combine(self, partials):
+        '''The query's result from its per-ds partial results.'''
+        parts = self.parts()
+        columns = self.group + ['_p{0}'.format(i) for i in range(len(parts))]
+        data = dict((c, np.concatenate([p[c] for p in partials])) for c in columns)
+        rows = len(data[columns[0]])
+        if self.group:
+            codes = [np.unique(data[g], return_inverse=True)[1] for g in self.group]
+            order = np.lexsort(codes[::-1])
+            keys = np.stack([c[order] for c in codes])
+            starts = np.flatnonzero(np.concatenate(
+                [[True], (keys[:, 1:] != keys[:, :-1]).any(axis=0)])) if rows else np.empty(0, int)
+        else:
+            order, starts = np.arange(rows), np.array([0] if rows else [], dtype=int)
+        combined = {}
+        for g in self.group:
+            combined[g] = data[g][order][starts]
+        reduce = {'sum': np.add, 'min': np.minimum, 'max': np.maximum}
+        for i, (_, _, how) in enumerate(parts):
+            values = data['_p{0}'.format(i)][order]
+            combined[i] = reduce[how].reduceat(values, starts) if len(starts) else values[:0]
+        out, p = OrderedDict(), 0
+        for kind, fn, arg, name in self.items:
+            if kind == 'col':
+                out[name] = combined[fn]
+            elif fn == 'avg':
+                out[name] = combined[p] / np.maximum(combined[p + 1], 1)
+                p += 2
+            else:
+                out[name] = combined[p]
+                p += 1
+        names = list(out)
+        if self.order:
+            keys = []
+            for index, desc in reversed(self.order):
+                codes = np.unique(out[names[index]], return_inverse=True)[1]
+                keys.append(-codes if desc else codes)
+            rank = np.lexsort(keys)
+            out = OrderedDict((n, v[rank]) for n, v in out.items())
+        if self.limit is not None:
+            out = OrderedDict((n, v[:self.limit]) for n, v in out.items())
+        return out
+
+
+def _nbytes(result):
+    size = 0
+    for values in result.values():
+        size += values.nbytes
+        if values.dtype == object:
+            size += sum(len(str(v)) for v in values[:1000]) * max(1, len(values) // 1000)
+    return size
+
+
+def _dependencies(key):
+    '''
+    [(table, first ds, last ds)] a whole-query entry
+    depends on; None bounds are open. A ds predicate only
+    bounds the table it qualifies (or the only table), so
+    a joined table read without one depends on all of it.
+    '''
+    tables = []
+    for clause in _FROM.findall(key):
+        for item in _JOIN.split(clause):
+            words = re.split(r' on |\busing\(', item.strip())[0].split()
+            if words and re.match(r'^\w+$', words[0]):
+                tables.append((words[0], words[-1] if len(words) > 1 else None))
+    names = [t for t, _ in tables]
+    m = re.search(r'\bwhere (.+?)(?:\b(?:group by|order by|limit)\b|$)', key)
+    deps = []
+    for table, alias in tables:
+        lo = hi = None
+        if (m and names.count(table) == 1 and len(re.findall(r'\bselect\b', key)) == 1
+                and not re.search(r'\bor\b', m.group(1))):
+            own = set([table, alias, None]) if len(tables) == 1 else set([table, alias or table])
+            where = re.sub(r'\b(?:(\w+)\.)?ds\b',
+                           lambda d: 'ds' if d.group(1) in own else 'other_ds', m.group(1))
+            lo, hi, _ = ds_bounds(where)
+        deps.append((table, lo, hi))
+    return sorted(set(deps))
+
+
+class QueryCache(object):
+    '''
+    Cached query() in front of a LocalEngine.
+
+        cache = QueryCache(LocalEngine(root), max_bytes=256 << 20)
+        cache.query("SELECT subscription_type, COUNT(*) FROM likes "
+                    "WHERE ds BETWEEN '2018-02-03' AND '2018-02-09' GROUP BY subscription_type")
+        cache.execute(hql)            # INSERT OVERWRITE invalidates what it rewrites
+        cache.invalidate('likes', '2018-02-05')   # for writes made elsewhere
+    '''
+
+    def __init__(self, engine, max_bytes=256 << 20, daily=True, max_days=366):
+        self.engine = engine
+        self.max_bytes = max_bytes
+        self.daily = daily
+        self.max_days = max_days
+        self.entries = OrderedDict()
+        self.size = 0
+        self._deps = {}
+        self.hits = self.partial = self.misses = 0
+        self.evicted = self.invalidated = 0
+
+    def _get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            return entry[0]
+        return None
+
+    def _put(self, key, result, deps):
+        size = _nbytes(result)
+        if size > self.max_bytes:
+            return
+        self._drop(key)
+        self.entries[key] = (result, size, deps)
+        self.size += size
+        for table, lo, hi in deps:
+            self._deps.setdefault(table, {})[key] = (lo, hi)
+        while self.size > self.max_bytes:
+            self._drop(next(iter(self.entries)))
+            self.evicted += 1
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return False
+        self.size -= entry[1]
+        for table, _, _ in entry[2]:
+            self._deps.get(table, {}).pop(key, None)
+        return True
+
+    def invalidate(self, table, ds=None):
+        '''Drop every result that read table/ds (any partition of table when ds is None).'''
+        stale = [key for key, (lo, hi) in self._deps.get(table, {}).items()
+                 if ds is None or ((lo is None or lo <= ds) and (hi is None or ds <= hi))]
+        for key in stale:
+            self._drop(key)
+        self.invalidated += len(stale)
+        return len(stale)
+
+    def query(self, sql):
+        key = normalize(sql)
+        result = self._get(key)
+        if result is not None:
+            self.hits += 1
+            return result
+        aggregate = Aggregate.parse(key) if self.daily else None
+        days = []
+        if aggregate is not None and aggregate.lo <= aggregate.hi:
+            days = [ds for ds, _ in self.engine.partitions(aggregate.table)
+                    if aggregate.lo <= ds <= aggregate.hi]
+        if not days or len(days) > self.max_days:
+            self.misses += 1
+            result = self.engine.query(sql)
+            self._put(key, result, _dependencies(key))
+            return result
+        partials, ran = [], 0
+        for ds in days:
+            daily_key = aggregate.daily_sql(ds)
+            partial = self._get(daily_key)
+            if partial is None:
+                partial = self.engine.query(daily_key)
+                self._put(daily_key, partial, [(aggregate.table, ds, ds)])
+                ran += 1
+            partials.append(partial)
+        if ran:
+            self.misses += 1
+        else:
+            self.partial += 1
+        result = aggregate.combine(partials)
+        self._put(key, result, [(aggregate.table, aggregate.lo, aggregate.hi)])
+        return result
+
+    def execute(self, hql):
+        '''Run HQL on the engine and invalidate the partitions it overwrote.'''
+        result = self.engine.execute(hql)
+        for statement in split_statements(hql):
+            for table, ds in hql_io(statement)[1]:
+                self.invalidate(table, ds)
+        return result
+
+    def stats(self):
+        total = self.hits + self.partial + self.misses
+        return {'queries': total, 'hits': self.hits, 'from_daily': self.partial,
+                'misses': self.misses, 'entries': len(self.entries), 'bytes': self.size,
+                'evicted': self.evicted, 'invalidated': self.invalidated}
+
+
+LIKES = """\
+SELECT
+    user_id
+  , hash(i, '{ds}', 'photo') % 500000 AS photo_id
+  , ['free', 'awesome', 'pluses'][CAST(user_id % 3 AS INTEGER) + 1] AS subscription_type
+  , user_id % 20 = 0 AS is_seller
+FROM (
+    SELECT i, hash(i, '{ds}{salt}') % 1000000 AS user_id FROM range({rows}) t(i)
+)
+"""
+
+_TEMPLATES = [
+    (0.45, "SELECT subscription_type, COUNT(*) AS likes FROM likes "
+           "WHERE ds BETWEEN '{lo}' AND '{hi}' GROUP BY subscription_type "
+           "ORDER BY subscription_type"),
+    (0.15, "select  subscription_type ,count(1) as likes\nfrom likes\n"
+           "where ds >= '{lo}' and ds <= '{hi}'\ngroup by subscription_type\n"
+           "order by subscription_type;"),
+    (0.15, "SELECT COUNT(*) AS likes, COUNT(DISTINCT user_id) AS users FROM likes "
+           "WHERE ds = '{hi}'"),
+    (0.15, "SELECT photo_id, COUNT(*) AS likes FROM likes WHERE ds = '{hi}' "
+           "GROUP BY photo_id ORDER BY likes DESC, photo_id LIMIT 10"),
+    (0.10, "SELECT is_seller, AVG(photo_id) AS avg_photo, MAX(user_id) AS top_user "
+           "FROM likes WHERE ds BETWEEN '{lo}' AND '{hi}' AND subscription_type = 'pluses' "
+           "GROUP BY is_seller ORDER BY is_seller"),
+    ]
+
+
+def query_log(n, days, seed=0):
+    '''A morning of analysts' queries: mostly last week, ending on a recent day.'''
+    rng = random.Random(seed)
+    weights = [w for w, _ in _TEMPLATES]
+    log = []
+    for _ in range(n):
+        template = rng.choices([t for _, t in _TEMPLATES], weights)[0]
+        hi = days[-1 - min(int(rng.expovariate(0.5)), len(days) - 8)]
+        log.append(template.format(lo=ds_add(hi, -6), hi=hi))
+    return log
+
+
+def _same(a, b):
+    a, b = list(a.values()), list(b.values())
+    if len(a) != len(b):
+        return False
+    for x, y in zip(a, b):
+        x, y = np.asarray(x), np.asarray(y)
+        if len(x) != len(y):
+            return False
+        if x.dtype.kind == 'f' or y.dtype.kind == 'f':
+            if not np.allclose(x.astype(float), y.astype(float)):
+                return False
+        elif not (x.astype(str) == y.astype(str)).all():
+            return False
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='query result cache, replayed')
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--days', type=int, default=60)
+    parser.add_argument('--rows', type=int, default=200000, help='likes rows per ds')
+    parser.add_argument('--max-mb', type=float, default=64)
+    parser.add_argument('--writes', type=int, default=20,
+                        help='partitions landing or rewritten during the replay')
+    args = parser.parse_args(argv)
+
+    tmp = tempfile.mkdtemp(prefix='query-cache-')
+    try:
+        engine = LocalEngine(tmp)
+        days = ds_range('2018-01-01', ds_add('2018-01-01', args.days - 1))
+        for ds in days:
+            engine.insert_overwrite('likes', ds, LIKES.format(ds=ds, rows=args.rows, salt=''))
+        log = query_log(args.queries, days)
+        rng = random.Random(1)
+        writes = dict((rng.randrange(1, len(log)), w) for w in range(args.writes))
+        cache = QueryCache(engine, max_bytes=int(args.max_mb * 1e6))
+
+        cold, warm, wrong = [], [], 0
+        landed = days[-1]
+        for i, sql in enumerate(log):
+            if i in writes:
+                if writes[i] % 2:
+                    # a new day lands; nothing cached can depend on it yet
+                    landed = ds_add(landed, 1)
+                    ds, salt = landed, ''
+                else:
+                    # a backfill rewrites a recent day
+                    ds, salt = days[-1 - rng.randrange(7)], '-fix{0}'.format(i)
+                cache.execute("INSERT OVERWRITE TABLE likes PARTITION (ds = '{0}') {1}".format(
+                    ds, LIKES.format(ds=ds, rows=args.rows, salt=salt)))
+            t = time.time()
+            expected = engine.query(sql)
+            cold.append(time.time() - t)
+            t = time.time()
+            got = cache.query(sql)
+            warm.append(time.time() - t)
+            if not _same(expected, got):
+                wrong += 1
+        engine.close()
+
+        stats = cache.stats()
+        p = lambda xs, q: 1000 * sorted(xs)[min(len(xs) - 1, int(len(xs) * q))]
+        print('{0} queries over {1} days of {2} likes rows, {3} partition writes'.format(
+            len(log), args.days, args.rows, len(writes)))
+        print('cache: {0} hits, {1} from cached daily aggregates, {2} ran on the engine '
+              '({3:.0%} answered without a scan)'.format(
+                  stats['hits'], stats['from_daily'], stats['misses'],
+                  (stats['hits'] + stats['from_daily']) / float(len(log))))
+        print('       {0} entries, {1:.1f} MB, {2} evicted, {3} invalidated by writes'.format(
+            stats['entries'], stats['bytes'] / 1e6, stats['evicted'], stats['invalidated']))
+        print('latency  no cache: p50 {0:7.2f} ms  p95 {1:7.2f} ms'.format(p(cold, 0.5), p(cold, 0.95)))
+        print('         cache:    p50 {0:7.2f} ms  p95 {1:7.2f} ms'.format(p(warm, 0.5), p(warm, 0.95)))
+        print('{0} results differ from running the query'.format(wrong))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
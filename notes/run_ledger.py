@@ -0,0 +1,338 @@
+'''
+Run ledger: skip partitions whose inputs did not change
+
+The guide asks for idempotent tasks: running task_2 for
+a ds twice gives the same partition. It follows that a
+rerun whose inputs and HQL are the same as last time
+can be skipped, yet a rerun of a backfill recomputes
+every partition.
+
+RunLedger is a SQLite file that records, for every
+successful (task, ds):
+
+    - the fingerprint of the run: sha256 of the rendered
+      HQL and of the content digest of every input
+      partition it reads
+    - the content digest of the partition it wrote
+
+The input partitions come from the rendered HQL itself:
+every FROM <table> WHERE [alias.]ds = '...' (or
+DATE_SUB / DATE_ADD of a literal) is one partition; a
+table read anywhere in the statement without such a
+predicate counts with all its partitions.
+
+Content digests are sha256 over the partition's files,
+cached in the ledger under the files' (name, size,
+mtime) signature: a partition is only read again when
+its files changed on disk, and a partition rewritten
+with the same bytes (an upstream redelivery, a rerun of
+a deterministic task) keeps its digest, so nothing
+downstream of it reruns.
+
+LedgerRunner wraps a runner such as local_engine's
+LocalRunner for backfill.run_backfill: before running
+it fingerprints the run, and returns without running
+when the ledger has the same fingerprint and the output
+partition is still the one it wrote.
+
+    python run_ledger.py --days 60 --rows 50000 --fix 3
+
+runs a backfill, reruns it, fixes a few upstream
+partitions and reruns it again, and counts what had to
+be recomputed each time.
+'''
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from backfill import ds_add, ds_range, plan, run_backfill
+from local_engine import (LocalEngine, LocalRunner, STG_BOOKINGS, TASK_1_HQL, TASK_2_HQL,
+                          build_reference, partition_dir, split_statements)
+from stage_check_exchange import VERSIONS, swap_partition
+
+_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS runs (
+        task_id TEXT, ds TEXT, fingerprint TEXT, inputs TEXT,
+        output_table TEXT, output_ds TEXT, output_digest TEXT, seconds REAL, finished REAL,
+        PRIMARY KEY (task_id, ds))''',
+    '''CREATE TABLE IF NOT EXISTS digests (
+        path TEXT PRIMARY KEY, signature TEXT, digest TEXT)''',
+    ]
+
+_DS = r"'(\d{4}-\d{2}-\d{2})'"
+_DS_EXPR = r"(?:{0}|DATE_(SUB|ADD)\s*\(\s*{0}\s*,\s*(\d+)\s*\))".format(_DS)
+_READ_DS = re.compile(r"\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?\s+WHERE\s+(?:(\w+)\.)?ds\s*=\s*"
+                      + _DS_EXPR, re.I)
+_READ = re.compile(r"\b(?:FROM|JOIN)\s+(\w+)", re.I)
+# the rest of a WHERE clause: up to the next clause, subquery or closing parenthesis
+_WHERE_END = re.compile(r"\b(?:GROUP|ORDER|LIMIT|HAVING|UNION|SELECT|FROM|JOIN)\b|[);]|$", re.I)
+_WIDENS = re.compile(r"\bOR\b|\bds\b", re.I)
+_WRITE = re.compile(r"INSERT\s+OVERWRITE\s+TABLE\s+(\w+)\s+PARTITION\s*\(\s*ds\s*=\s*"
+                    + _DS + r"\s*\)", re.I)
+_KEYWORDS = set(['select', 'where', 'group', 'order', 'range'])
+
+
+def hql_io(hql):
+    '''
+    (inputs, outputs) of rendered HQL: sets of (table, ds)
+    partitions, ds None for a table read without one.
+    '''
+    inputs, outputs, whole = set(), set(), set()
+    for statement in split_statements(hql):
+        for table, ds in _WRITE.findall(statement):
+            outputs.add((table, ds))
+        # every read on its own: a table also read without a ds
+        # predicate (a UNION of earlier days, say) counts whole,
+        # and so does one whose WHERE has an OR or another ds term
+        for read in _READ.finditer(statement):
+            table = read.group(1)
+            if table.lower() in _KEYWORDS:
+                continue
+            m = _READ_DS.match(statement, read.start())
+            if m is None or m.group(3) not in (None, table, m.group(2)):
+                whole.add(table)
+                continue
+            if _WIDENS.search(statement, m.end(), _WHERE_END.search(statement, m.end()).start()):
+                whole.add(table)
+                continue
+            ds, op, base, days = m.group(4, 5, 6, 7)
+            if not ds:
+                ds = ds_add(base, int(days) if op.upper() == 'ADD' else -int(days))
+            inputs.add((table, ds))
+    inputs = set((table, ds) for table, ds in inputs if table not in whole)
+    inputs.update((table, None) for table in whole)
+    return inputs - outputs, outputs
+
+
+def _files(path):
+    if not os.path.isdir(path):
+        return []
+    return sorted(os.path.join(d, f) for d, _, files in os.walk(path) for f in files)
+
+
+class RunLedger(object):
+    '''
+    Fingerprints of successful runs and content digests
+    of partitions, under a warehouse root.
+
+        ledger = RunLedger('warehouse/_ledger.sqlite', 'warehouse/')
+        fingerprint, inputs = ledger.fingerprint(hql)
+        if not ledger.unchanged(task_id, ds, fingerprint):
+            ...run...
+            ledger.record(task_id, ds, fingerprint, inputs, output, seconds)
+
+    Safe to share between backfill worker processes.
+    '''
+
+    def __init__(self, path, root):
+        self.path = path
+        self.root = root
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        for statement in _SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+        self.hashed_bytes = 0
+
+    def signature(self, path):
+        h = hashlib.sha256()
+        for name in _files(path):
+            st = os.stat(name)
+            h.update('{0}\0{1}\0{2}\n'.format(
+                os.path.relpath(name, path), st.st_size, st.st_mtime_ns).encode())
+        return h.hexdigest()
+
+    def digest(self, table, ds):
+        '''Content digest of one partition, reading it only when its files changed.'''
+        path = partition_dir(self.root, table, ds)
+        if not os.path.isdir(path):
+            return 'missing'
+        signature = self.signature(path)
+        row = self.db.execute('SELECT signature, digest FROM digests WHERE path = ?',
+                              (path,)).fetchone()
+        if row is not None and row[0] == signature:
+            return row[1]
+        h = hashlib.sha256()
+        for name in _files(path):
+            h.update(os.path.relpath(name, path).encode() + b'\0')
+            with open(name, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+                    self.hashed_bytes += len(block)
+        digest = h.hexdigest()
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO digests VALUES (?, ?, ?)',
+                            (path, signature, digest))
+        return digest
+
+    def _table_partitions(self, table):
+        path = os.path.join(self.root, table)
+        if not os.path.isdir(path):
+            return []
+        return sorted(p[3:] for p in os.listdir(path) if p.startswith('ds='))
+
+    def fingerprint(self, hql):
+        '''(fingerprint, {'table/ds': digest}) of a rendered task.'''
+        inputs, _ = hql_io(hql)
+        digests = {}
+        for table, ds in sorted(inputs, key=lambda p: (p[0], p[1] or '')):
+            for d in ([ds] if ds is not None else self._table_partitions(table)):
+                digests['{0}/{1}'.format(table, d)] = self.digest(table, d)
+        h = hashlib.sha256(hql.encode())
+        h.update(json.dumps(digests, sort_keys=True).encode())
+        return h.hexdigest(), digests
+
+    def last(self, task_id, ds):
+        row = self.db.execute(
+            'SELECT fingerprint, output_table, output_ds, output_digest FROM runs '
+            'WHERE task_id = ? AND ds = ?', (task_id, ds)).fetchone()
+        return row
+
+    def unchanged(self, task_id, ds, fingerprint):
+        '''Same fingerprint as the last success, and its output is still in place.'''
+        row = self.last(task_id, ds)
+        if row is None or row[0] != fingerprint:
+            return False
+        return row[1] is None or self.digest(row[1], row[2]) == row[3]
+
+    def record(self, task_id, ds, fingerprint, inputs, output=None, seconds=None):
+        table, out_ds = output if output else (None, None)
+        digest = self.digest(table, out_ds) if output else None
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                            (task_id, ds, fingerprint, json.dumps(inputs, sort_keys=True),
+                             table, out_ds, digest, seconds, time.time()))
+
+    def forget(self, task_id=None, ds=None):
+        '''Drop recorded runs, so they run again.'''
+        with self.db:
+            self.db.execute('DELETE FROM runs WHERE (? IS NULL OR task_id = ?) '
+                            'AND (? IS NULL OR ds = ?)', (task_id, task_id, ds, ds))
+
+    def close(self):
+        self.db.close()
+
+
+_LEDGERS = {}
+
+
+class LedgerRunner(object):
+    '''
+    Skip-if-unchanged around a runner with render() and
+    __call__(task_id, ds), e.g. LocalRunner. Picklable,
+    for backfill.run_backfill:
+
+        runner = LedgerRunner(LocalRunner(root, hql_root, tasks), ledger_path)
+        run_backfill(plan(...), runner, max_workers=8)
+
+    Returns 'skipped' for a skipped run and the runner's
+    result otherwise.
+    '''
+
+    def __init__(self, runner, ledger_path):
+        self.runner = runner
+        self.ledger_path = ledger_path
+
+    def ledger(self):
+        ledger = _LEDGERS.get(self.ledger_path)
+        if ledger is None:
+            ledger = _LEDGERS[self.ledger_path] = RunLedger(self.ledger_path, self.runner.root)
+        return ledger
+
+    def __call__(self, task_id, ds):
+        ledger = self.ledger()
+        hql = self.runner.render(task_id, ds)
+        fingerprint, inputs = ledger.fingerprint(hql)
+        if ledger.unchanged(task_id, ds, fingerprint):
+            return 'skipped'
+        start = time.time()
+        result = self.runner(task_id, ds)
+        outputs = sorted(hql_io(hql)[1])
+        ledger.record(task_id, ds, fingerprint, inputs, outputs[0] if outputs else None,
+                      time.time() - start)
+        return result
+
+
+def _ran(ledger_path, since):
+    db = sqlite3.connect(ledger_path, timeout=60)
+    try:
+        rows = db.execute('SELECT task_id, COUNT(*) FROM runs WHERE finished >= ? '
+                          'GROUP BY task_id', (since,)).fetchall()
+    finally:
+        db.close()
+    return dict(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='run ledger against full reruns')
+    parser.add_argument('--days', type=int, default=60)
+    parser.add_argument('--rows', type=int, default=50000, help='stg_bookings rows per ds')
+    parser.add_argument('--fix', type=int, default=3, help='upstream partitions to rewrite')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args(argv)
+
+    tmp = tempfile.mkdtemp(prefix='run-ledger-')
+    try:
+        hql_root = os.path.join(tmp, 'dags')
+        os.makedirs(os.path.join(hql_root, 'hql'))
+        tasks = [('hql', 'task_1'), ('hql', 'task_2')]
+        for (directory, name), source in zip(tasks, (TASK_1_HQL, TASK_2_HQL)):
+            with open(os.path.join(hql_root, directory, name + '.hql'), 'w') as f:
+                f.write(source)
+        root = os.path.join(tmp, 'warehouse')
+        ds_list = ds_range('2018-02-09', ds_add('2018-02-09', args.days - 1))
+        build_reference(root, ds_list, args.rows)
+        local = LocalRunner(root, hql_root, tasks)
+        ledger_path = os.path.join(tmp, 'ledger.sqlite')
+        runner = LedgerRunner(local, ledger_path)
+        graph = plan([name for _, name in tasks], ds_list, {'task_2': ['task_1']}, local.lags())
+
+        def backfill(label, run):
+            since = time.time()
+            report = run_backfill(graph, run, args.workers)
+            if report.failed:
+                raise report.failed[0][1]
+            ran = _ran(ledger_path, since) if run is runner else {}
+            recomputed = sum(ran.values()) if run is runner else len(report.done)
+            print('{0:<34} {1:7.2f}s  {2:4d}/{3} partitions recomputed'.format(
+                label, report.elapsed, recomputed, len(graph)))
+            return report.elapsed
+
+        print('{0} days x 2 tasks, {1} stg_bookings rows per ds'.format(args.days, args.rows))
+        backfill('first backfill, with ledger', runner)
+        full = backfill('rerun, no ledger', local)
+        backfill('rerun, with ledger', runner)
+
+        # an upstream redelivery with the same content: new files, same bytes
+        for ds in ds_list[args.days // 3:args.days // 3 + args.fix]:
+            path = partition_dir(root, 'stg_bookings', ds)
+            table = os.path.dirname(path)
+            copy = os.path.join(table, VERSIONS, 'ds={0}.redelivered'.format(ds))
+            shutil.copytree(path, copy)
+            swap_partition(table, path, copy)
+        backfill('upstream rewritten, same content', runner)
+
+        # an upstream fix: the same days with different rows
+        engine = LocalEngine(root)
+        fixed = ds_list[args.days // 2:args.days // 2 + args.fix]
+        for ds in fixed:
+            engine.insert_overwrite('stg_bookings', ds, STG_BOOKINGS.format(
+                ds=ds + '-fixed', rows=args.rows, markets=2000, listings=200000))
+        engine.close()
+        fixed_time = backfill('{0} upstream days fixed'.format(len(fixed)), runner)
+        print('expected: task_1 for the {0} fixed days, task_2 from {1} on ({2} partitions); '
+              '{3:.1f}x faster than a full rerun'.format(
+                  len(fixed), fixed[0], len(fixed) + len(ds_list) - ds_list.index(fixed[0]),
+                  full / max(fixed_time, 1e-9)))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+'''
+Streaming sessionization
+
+Sessionization is on the list of specialized pipelines
+in the rise of the data engineer notes. Done as a window
+function over a day of 500px-style (user_id, timestamp)
+events,
+
+    LAG(ts) OVER (PARTITION BY user_id ORDER BY ts)
+
+it sorts the whole day at once and needs the whole day
+in memory to do it.
+
+Events arrive in time order anyway (activity_log writes
+them as they come), so Sessionizer takes them in batches
+and only keeps the sessions that are still open:
+
+    - open sessions are four parallel arrays sorted by
+      user_id: user, start, last event, event count
+    - a batch is sorted by user (stable, so each user's
+      events stay in time order), cut wherever a user's
+      gap exceeds `gap`, and joined to the open sessions
+      with one searchsorted
+    - every session a batch closes is emitted right away;
+      after the batch, open sessions idle for more than
+      `gap` before the batch's last event expire and are
+      emitted too, so the state holds only users active
+      within the last `gap`
+
+State is checkpointed at the end of a ds (save/load,
+an .npz written next to the output and renamed into
+place), so a session running over midnight continues in
+the next ds's run instead of being cut in two. Closed
+sessions go to the ds in which they closed.
+
+    python sessionize.py --events 20000000 --users 2000000
+
+compares events/s and peak RSS with a sort of the whole
+day; --events 100000000 --no-baseline for a full day.
+'''
+import argparse
+import os
+import resource
+import shutil
+import tempfile
+import time
+from multiprocessing import Process, Queue
+
+import numpy as np
+
+SESSION_COLUMNS = ('user_id', 'start', 'end', 'events')
+
+
+def _empty(columns=SESSION_COLUMNS):
+    return dict((name, np.empty(0, dtype=np.int64)) for name in columns)
+
+
+def _concat(parts):
+    parts = [p for p in parts if len(p['user_id'])]
+    if not parts:
+        return _empty()
+    return dict((name, np.concatenate([p[name] for p in parts])) for name in SESSION_COLUMNS)
+
+
+class Sessionizer(object):
+    '''
+    Sessions of time-ordered events, a batch at a time.
+
+        sessions = Sessionizer(gap=30 * 60 * 10 ** 6)   # timestamps in microseconds
+        for batch in batches:
+            write(sessions.add(batch['user_id'], batch['ts']))
+        sessions.save(checkpoint)                        # open sessions go to the next ds
+
+    add() and flush() return the sessions they close as
+    {user_id, start, end, events} arrays. A session is
+    closed once its user has been quiet for more than
+    gap; the next event starts a new session.
+    '''
+
+    def __init__(self, gap):
+        self.gap = int(gap)
+        self.user = np.empty(0, dtype=np.int64)
+        self.start = np.empty(0, dtype=np.int64)
+        self.last = np.empty(0, dtype=np.int64)
+        self.count = np.empty(0, dtype=np.int64)
+        self.watermark = None
+        self.events = 0
+
+    def __len__(self):
+        return len(self.user)
+
+    @property
+    def nbytes(self):
+        return self.user.nbytes + self.start.nbytes + self.last.nbytes + self.count.nbytes
+
+    def add(self, user_id, ts):
+        user_id = np.asarray(user_id, dtype=np.int64)
+        ts = np.asarray(ts, dtype=np.int64)
+        if not len(ts):
+            return _empty()
+        if self.watermark is not None and ts[0] < self.watermark - self.gap:
+            raise ValueError('batch starts {0}us before the last event seen, more than '
+                             'the gap: events must arrive in time order'.format(
+                                 self.watermark - ts[0]))
+        self.events += len(ts)
+
+        order = np.argsort(user_id, kind='stable')
+        u, t = user_id[order], ts[order]
+        n = len(u)
+        new_user = np.empty(n, dtype=bool)
+        new_user[0] = True
+        new_user[1:] = u[1:] != u[:-1]
+        cut = new_user.copy()
+        cut[1:] |= (t[1:] - t[:-1]) > self.gap
+        seg = np.flatnonzero(cut)
+        seg_user, seg_start = u[seg], t[seg]
+        seg_end_idx = np.append(seg[1:], n) - 1
+        seg_last = t[seg_end_idx]
+        seg_count = np.diff(np.append(seg, n))
+        seg_first_of_user = new_user[seg]
+        seg_last_of_user = np.append(seg_first_of_user[1:], True)
+
+        # join each user's first segment of the batch to its open session
+        if len(self.user):
+            pos = np.minimum(np.searchsorted(self.user, seg_user), len(self.user) - 1)
+            has_open = seg_first_of_user & (self.user[pos] == seg_user)
+            extends = has_open & (seg_start - self.last[pos] <= self.gap)
+        else:
+            pos = np.zeros(len(seg_user), dtype=np.intp)
+            has_open = extends = np.zeros(len(seg_user), dtype=bool)
+        j = pos[extends]
+        seg_start[extends] = self.start[j]
+        seg_count[extends] += self.count[j]
+        touched = np.zeros(len(self.user), dtype=bool)
+        touched[pos[has_open]] = True
+        broken = touched.copy()
+        broken[j] = False
+
+        # closed now: open sessions the batch broke off, and segments
+        # followed by another segment of the same user
+        out = [
+            {'user_id': self.user[broken], 'start': self.start[broken],
+             'end': self.last[broken], 'events': self.count[broken]},
+            {'user_id': seg_user[~seg_last_of_user], 'start': seg_start[~seg_last_of_user],
+             'end': seg_last[~seg_last_of_user], 'events': seg_count[~seg_last_of_user]},
+            ]
+
+        keep = ~touched
+        tail = seg_last_of_user
+        user = np.concatenate([self.user[keep], seg_user[tail]])
+        merge = np.argsort(user, kind='stable')
+        self.user = user[merge]
+        self.start = np.concatenate([self.start[keep], seg_start[tail]])[merge]
+        self.last = np.concatenate([self.last[keep], seg_last[tail]])[merge]
+        self.count = np.concatenate([self.count[keep], seg_count[tail]])[merge]
+
+        last = int(ts[-1])
+        self.watermark = last if self.watermark is None else max(self.watermark, last)
+        out.append(self.expire(self.watermark))
+        return _concat(out)
+
+    def expire(self, now):
+        '''Close the sessions idle for more than gap at `now`, e.g. on a quiet stream.'''
+        idle = self.last < int(now) - self.gap
+        out = {'user_id': self.user[idle], 'start': self.start[idle],
+               'end': self.last[idle], 'events': self.count[idle]}
+        keep = ~idle
+        self.user, self.start = self.user[keep], self.start[keep]
+        self.last, self.count = self.last[keep], self.count[keep]
+        return out
+
+    def flush(self):
+        '''Close every open session, at the end of the stream.'''
+        out = {'user_id': self.user, 'start': self.start, 'end': self.last, 'events': self.count}
+        self.user, self.start, self.last, self.count = (np.empty(0, dtype=np.int64)
+                                                        for _ in range(4))
+        return out
+
+    def save(self, path):
+        tmp = '{0}.{1}.tmp.npz'.format(path, os.getpid())
+        np.savez(tmp, user=self.user, start=self.start, last=self.last, count=self.count,
+                 meta=np.array([self.gap, -1 if self.watermark is None else self.watermark,
+                                self.events], dtype=np.int64))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, gap=None):
+        '''A sessionizer resuming from a checkpoint; gap defaults to the saved one.'''
+        with np.load(path) as saved:
+            saved_gap, watermark, events = saved['meta'].tolist()
+            sessions = cls(saved_gap if gap is None else gap)
+            sessions.user, sessions.start = saved['user'], saved['start']
+            sessions.last, sessions.count = saved['last'], saved['count']
+        sessions.watermark = None if watermark < 0 else watermark
+        sessions.events = events
+        return sessions
+
+
+def sessionize_partition(batches, out_dir, checkpoint, gap, ds):
+    '''
+    One ds of the pipeline: resume from the previous
+    checkpoint if there is one, write the sessions closed
+    during ds under out_dir/ds=<ds>/, save the checkpoint.
+    '''
+    sessions = Sessionizer.load(checkpoint, gap) if os.path.exists(checkpoint) else Sessionizer(gap)
+    closed = _concat([sessions.add(b['user_id'], b['ts']) for b in batches])
+    path = os.path.join(out_dir, 'ds={0}'.format(ds))
+    os.makedirs(path)
+    for name, values in closed.items():
+        np.save(os.path.join(path, name + '.npy'), values)
+    sessions.save(checkpoint)
+    return closed
+
+
+def sessionize_sorted(user_id, ts, gap):
+    '''The window function: sort the whole day by (user, ts) and cut on gaps.'''
+    order = np.lexsort((ts, user_id))
+    u, t = user_id[order], ts[order]
+    n = len(u)
+    cut = np.empty(n, dtype=bool)
+    cut[0] = True
+    cut[1:] = (u[1:] != u[:-1]) | ((t[1:] - t[:-1]) > gap)
+    seg = np.flatnonzero(cut)
+    return {'user_id': u[seg], 'start': t[seg], 'end': t[np.append(seg[1:], n) - 1],
+            'events': np.diff(np.append(seg, n))}
+
+
+def synthetic_batches(events, users, batch_size=1000000, day_us=86400 * 10 ** 6, seed=0):
+    '''
+    A day of time-ordered events in batches. Users come
+    and go: at any time about a tenth of them are in the
+    active pool, which drifts over the day.
+    '''
+    rng = np.random.default_rng(seed)
+    pool = max(1, users // 10)
+    done = 0
+    while done < events:
+        n = min(batch_size, events - done)
+        t0 = done * day_us // events
+        t1 = (done + n) * day_us // events
+        ts = np.sort(rng.integers(t0, max(t1, t0 + 1), n))
+        base = (ts * (users - pool) // day_us)
+        user = 1 + (base + rng.integers(0, pool, n)) % users
+        yield {'user_id': user.astype(np.int64), 'ts': ts.astype(np.int64)}
+        done += n
+
+
+def _fingerprint(sessions, total=(0, 0, 0)):
+    '''Order-independent digest of a set of sessions, added onto `total`.'''
+    h = int((sessions['user_id'] * 1000003 + sessions['start'] % 999983 +
+             sessions['events']).sum()) % (1 << 61)
+    return (total[0] + len(sessions['user_id']), total[1] + int(sessions['events'].sum()),
+            (total[2] + h) % (1 << 61))
+
+
+def _streaming_job(events, users, batch_size, gap):
+    '''Closed sessions are folded into the digest as they come, as a writer would.'''
+    sessions = Sessionizer(gap)
+    digest, peak_state = (0, 0, 0), 0
+    for batch in synthetic_batches(events, users, batch_size):
+        digest = _fingerprint(sessions.add(batch['user_id'], batch['ts']), digest)
+        peak_state = max(peak_state, len(sessions))
+    return _fingerprint(sessions.flush(), digest), peak_state
+
+
+def _sorted_job(events, users, batch_size, gap):
+    batches = list(synthetic_batches(events, users, batch_size))
+    user_id = np.concatenate([b['user_id'] for b in batches])
+    ts = np.concatenate([b['ts'] for b in batches])
+    del batches
+    return _fingerprint(sessionize_sorted(user_id, ts, gap)), None
+
+
+def _measure(queue, job, *args):
+    t = time.time()
+    result = job(*args)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    queue.put((time.time() - t, rss, result))
+
+
+def _in_child(job, *args):
+    '''Run a job in a fresh process, so its peak RSS is its own.'''
+    queue = Queue()
+    p = Process(target=_measure, args=(queue, job) + args)
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='streaming sessionization')
+    parser.add_argument('--events', type=int, default=20000000)
+    parser.add_argument('--users', type=int, default=2000000)
+    parser.add_argument('--batch', type=int, default=1000000)
+    parser.add_argument('--gap-minutes', type=float, default=30)
+    parser.add_argument('--no-baseline', action='store_true',
+                        help='skip the whole-day sort, which needs the day in memory')
+    args = parser.parse_args(argv)
+    gap = int(args.gap_minutes * 60 * 10 ** 6)
+
+    print('{0:,} events from {1:,} users, gap {2:g} min, batches of {3:,}'.format(
+        args.events, args.users, args.gap_minutes, args.batch))
+    jobs = [('streaming', _streaming_job)]
+    if not args.no_baseline:
+        jobs.append(('sort day', _sorted_job))
+    answers = []
+    for label, job in jobs:
+        elapsed, rss, (fingerprint, peak_state) = _in_child(
+            job, args.events, args.users, args.batch, gap)
+        answers.append(fingerprint)
+        extra = '  max open sessions {0:,}'.format(peak_state) if peak_state is not None else ''
+        print('{0:<10} {1:7.2f}s  {2:>12,.0f} events/s  peak RSS {3:8.1f} MB  {4:,} sessions{5}'.format(
+            label, elapsed, args.events / elapsed, rss, fingerprint[0], extra))
+    assert len(set(answers)) == 1, answers
+
+    # a session running over midnight is carried by the checkpoint, not cut
+    tmp = tempfile.mkdtemp(prefix='sessionize-')
+    try:
+        day = 86400 * 10 ** 6
+        checkpoint = os.path.join(tmp, '_sessions.npz')
+        first = [{'user_id': np.array([7, 8]), 'ts': np.array([day - 60 * 10 ** 6, day - 10])}]
+        second = [{'user_id': np.array([7, 9]), 'ts': np.array([day + 60 * 10 ** 6, day + 2 * gap])}]
+        sessionize_partition(first, tmp, checkpoint, gap, '2015-02-10')
+        closed = sessionize_partition(second, tmp, checkpoint, gap, '2015-02-11')
+        carried = dict(zip(closed['user_id'].tolist(), closed['events'].tolist()))
+        assert carried == {7: 2, 8: 1}, carried
+        print('checkpoint: sessions over midnight closed in the next ds with all their events')
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
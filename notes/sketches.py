@@ -0,0 +1,375 @@
+'''
+Mergeable sketches
+
+Distinct counts do not add up across days: the users
+who booked on Monday and the users who booked on
+Tuesday overlap. A HyperLogLog keeps a fixed number of
+small registers per key instead of the set of values,
+two sketches merge by taking the register-wise max,
+and the merged sketch estimates the distinct count of
+the union with a relative error of about 1.04 / sqrt(m)
+(m = 2 ** p registers, ~1.6% at the default p = 12).
+
+TDigest does the same for quantiles: a few hundred
+weighted centroids, small near the tails where
+accuracy matters, that merge by re-compressing the
+union. CountMinSketch estimates how often a value
+occurs, never under, over by at most epsilon times the
+total count with probability 1 - delta; two of them
+merge by adding their counters.
+
+Values are hashed with hash64 / hash_keys, never
+hash(), so sketches written by one process can be
+merged by another: whole numbers (42, 42.0, True) go
+through splitmix64 of their int64 value, anything else
+through blake2b of its str. Every sketch here and in
+metrics_layer, and partition_index's bloom filters,
+use this hash.
+'''
+import hashlib
+import math
+import struct
+from array import array
+
+import numpy as np
+
+
+_MASK64 = 0xFFFFFFFFFFFFFFFF
+
+
+def _blake64(value):
+    if not isinstance(value, bytes):
+        value = str(value).encode()
+    return int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), 'little')
+
+
+def mix64(x):
+    '''splitmix64 finalizer over a uint64 array.'''
+    x = x.astype(np.uint64, copy=True)
+    with np.errstate(over='ignore'):
+        x ^= x >> np.uint64(30)
+        x *= np.uint64(0xBF58476D1CE4E5B9)
+        x ^= x >> np.uint64(27)
+        x *= np.uint64(0x94D049BB133111EB)
+        x ^= x >> np.uint64(31)
+    return x
+
+
+def _integral(value):
+    '''value as an int when it is a whole number (42, 42.0, True), else None.'''
+    if isinstance(value, (bool, int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)) and math.isfinite(value) \
+            and float(value).is_integer() and abs(value) < 2 ** 63:
+        return int(value)
+    return None
+
+
+def hash64(value):
+    '''64-bit hash of one value, the same as hash_keys gives it in a column.'''
+    i = _integral(value)
+    if i is None:
+        return _blake64(value)
+    x = i & _MASK64
+    x ^= x >> 30
+    x = (x * 0xBF58476D1CE4E5B9) & _MASK64
+    x ^= x >> 27
+    x = (x * 0x94D049BB133111EB) & _MASK64
+    return x ^ (x >> 31)
+
+
+def hash_keys(values):
+    '''
+    64-bit hashes of a column, vectorized for numbers.
+    Whole numbers hash the same whatever their type, so
+    a probe for 42 finds 42.0 in a float column.
+    '''
+    values = np.asarray(values)
+    if values.dtype.kind in 'iub':
+        return mix64(values.astype(np.int64).view(np.uint64))
+    if values.dtype.kind == 'f':
+        whole = np.isfinite(values) & (values == np.round(values)) & (np.abs(values) < 2.0 ** 63)
+        out = np.empty(len(values), dtype=np.uint64)
+        out[whole] = mix64(values[whole].astype(np.int64).view(np.uint64))
+        out[~whole] = [_blake64(v) for v in values[~whole].tolist()]
+        return out
+    items = values.tolist()
+    ints = [_integral(v) for v in items]
+    out = np.array([0 if i is not None else _blake64(v) for v, i in zip(items, ints)],
+                   dtype=np.uint64)
+    numeric = np.array([i is not None for i in ints], dtype=bool)
+    if numeric.any():
+        out[numeric] = mix64(np.array([i for i in ints if i is not None],
+                                       dtype=np.int64).view(np.uint64))
+    return out
+
+
+class HyperLogLog(object):
+
+    __slots__ = ('p', 'm', 'registers')
+
+    def __init__(self, p=12, registers=None):
+        if not 4 <= p <= 18:
+            raise ValueError('p must be between 4 and 18, got {0}'.format(p))
+        self.p = p
+        self.m = 1 << p
+        if registers is None:
+            registers = bytearray(self.m)
+        elif len(registers) != self.m:
+            raise ValueError('expected {0} registers, got {1}'.format(self.m, len(registers)))
+        self.registers = bytearray(registers)
+
+    @classmethod
+    def for_error(cls, relative_error):
+        '''Smallest sketch whose standard error is at most relative_error.'''
+        p = int(math.ceil(math.log((1.04 / relative_error) ** 2, 2)))
+        return cls(max(4, min(18, p)))
+
+    def add(self, value):
+        self.add_hash(hash64(value))
+
+    def add_hash(self, h):
+        idx = h >> (64 - self.p)
+        rest = (h << self.p) & 0xFFFFFFFFFFFFFFFF
+        rank = 65 - rest.bit_length() if rest else 65 - self.p
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add_hash(hash64(value))
+        return self
+
+    def merge(self, other):
+        if other.p != self.p:
+            raise ValueError('cannot merge sketches with p={0} and p={1}'.format(self.p, other.p))
+        regs = self.registers
+        for i, r in enumerate(other.registers):
+            if r > regs[i]:
+                regs[i] = r
+        return self
+
+    def copy(self):
+        return HyperLogLog(self.p, self.registers)
+
+    def count(self):
+        m = self.m
+        if m >= 128:
+            alpha = 0.7213 / (1 + 1.079 / m)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}[m]
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # linear counting is much better for small cardinalities
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+    def __len__(self):
+        return self.count()
+
+    def to_bytes(self):
+        return bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data, p=None):
+        if p is None:
+            p = int(math.log(len(data), 2))
+        return cls(p, data)
+
+
+def compress_centroids(means, weights, compression, owner=None):
+    '''
+    Merge centroids so that each covers at most one unit
+    of the k1 scale function, vectorized. With `owner`,
+    the centroids of each owner are compressed on their
+    own, all in one pass, and (means, weights, owner)
+    come back sorted by owner, then mean.
+    '''
+    means = np.asarray(means, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    groups = np.zeros(len(means), dtype=np.int64) if owner is None else np.asarray(owner)
+    order = np.lexsort((means, groups))
+    means, weights, groups = means[order], weights[order], groups[order]
+    if not len(means):
+        return (means, weights) if owner is None else (means, weights, groups)
+    first = np.concatenate([[True], groups[1:] != groups[:-1]])
+    starts = np.flatnonzero(first)
+    cum = np.cumsum(weights)
+    group = np.cumsum(first) - 1
+    before = (cum - weights)[starts][group]
+    total = np.add.reduceat(weights, starts)[group]
+    q = (cum - before - weights / 2) / total
+    k = np.floor(compression / (2 * np.pi) * np.arcsin(np.clip(2 * q - 1, -1, 1)))
+    cuts = np.flatnonzero(first | np.concatenate([[True], k[1:] != k[:-1]]))
+    w = np.add.reduceat(weights, cuts)
+    m = np.add.reduceat(means * weights, cuts) / w
+    return (m, w) if owner is None else (m, w, groups[cuts])
+
+
+class TDigest(object):
+    '''
+    Merging t-digest (Dunning). Centroids are kept sorted
+    by mean; each covers at most one unit of the k1 scale
+    function, so there are at most about compression / 2
+    of them and the error in q is roughly proportional
+    to q * (1 - q) / compression.
+    '''
+
+    __slots__ = ('compression', 'means', 'weights', 'min', 'max', '_buffer')
+
+    def __init__(self, compression=100, means=(), weights=(), min=None, max=None):
+        self.compression = float(compression)
+        self.means = list(means)
+        self.weights = list(weights)
+        self.min = min if min is not None else (self.means[0] if self.means else None)
+        self.max = max if max is not None else (self.means[-1] if self.means else None)
+        self._buffer = []
+
+    def add(self, value, weight=1.0):
+        value = float(value)
+        self._buffer.append((value, float(weight)))
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self._buffer) > 5 * self.compression:
+            self._compress()
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+        return self
+
+    def merge(self, other):
+        other._compress()
+        self._buffer.extend(zip(other.means, other.weights))
+        for bound in (other.min, other.max):
+            if bound is not None:
+                self.min = bound if self.min is None else min(self.min, bound)
+                self.max = bound if self.max is None else max(self.max, bound)
+        self._compress()
+        return self
+
+    def _compress(self):
+        if not self._buffer:
+            return
+        means, weights = compress_centroids(self.means + [m for m, _ in self._buffer],
+                                            self.weights + [w for _, w in self._buffer],
+                                            self.compression)
+        self._buffer = []
+        self.means, self.weights = means.tolist(), weights.tolist()
+
+    @property
+    def count(self):
+        self._compress()
+        return sum(self.weights)
+
+    def quantile(self, q):
+        '''Estimated value at quantile q, interpolating between centroid centers.'''
+        self._compress()
+        if not self.means:
+            return None
+        if not 0 <= q <= 1:
+            raise ValueError('q must be between 0 and 1, got {0}'.format(q))
+        total = sum(self.weights)
+        target = q * total
+        # centers of the centroids on the cumulative weight axis, with min and max at the ends
+        xs, ys = [0.0], [self.min]
+        cum = 0.0
+        for m, w in zip(self.means, self.weights):
+            xs.append(cum + w / 2)
+            ys.append(m)
+            cum += w
+        xs.append(total)
+        ys.append(self.max)
+        for i in range(1, len(xs)):
+            if target <= xs[i]:
+                span = xs[i] - xs[i - 1]
+                if span <= 0:
+                    return ys[i]
+                return ys[i - 1] + (ys[i] - ys[i - 1]) * (target - xs[i - 1]) / span
+        return self.max
+
+    def to_bytes(self):
+        self._compress()
+        n = len(self.means)
+        header = struct.pack('<dddI', self.compression,
+                             self.min if self.min is not None else math.nan,
+                             self.max if self.max is not None else math.nan, n)
+        return header + array('d', self.means).tobytes() + array('d', self.weights).tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        compression, lo, hi, n = struct.unpack_from('<dddI', data)
+        offset = struct.calcsize('<dddI')
+        means, weights = array('d'), array('d')
+        means.frombytes(data[offset:offset + 8 * n])
+        weights.frombytes(data[offset + 8 * n:offset + 16 * n])
+        return cls(compression, means, weights,
+                   None if math.isnan(lo) else lo, None if math.isnan(hi) else hi)
+
+
+class CountMinSketch(object):
+    '''
+    depth rows of width counters. A value adds to one
+    counter per row, picked by double hashing its 64-bit
+    hash; its estimate is the smallest of those counters.
+    '''
+
+    __slots__ = ('width', 'depth', 'table')
+
+    def __init__(self, width=272, depth=5, table=None):
+        self.width = width
+        self.depth = depth
+        if table is None:
+            table = array('q', bytes(8 * width * depth))
+        elif len(table) != width * depth:
+            raise ValueError('expected {0} counters, got {1}'.format(width * depth, len(table)))
+        self.table = table if isinstance(table, array) else array('q', table)
+
+    @classmethod
+    def for_error(cls, epsilon, delta=0.01):
+        '''Overestimates by at most epsilon * total, with probability 1 - delta.'''
+        return cls(int(math.ceil(math.e / epsilon)), int(math.ceil(math.log(1.0 / delta))))
+
+    def cells(self, h):
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        return [i * self.width + (h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, value, count=1):
+        self.add_hash(hash64(value), count)
+
+    def add_hash(self, h, count=1):
+        for cell in self.cells(h):
+            self.table[cell] += count
+
+    def estimate(self, value):
+        return self.estimate_hash(hash64(value))
+
+    def estimate_hash(self, h):
+        return min(self.table[cell] for cell in self.cells(h))
+
+    @property
+    def total(self):
+        return sum(self.table[:self.width])
+
+    def merge(self, other):
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError('cannot merge {0}x{1} and {2}x{3} sketches'.format(
+                self.depth, self.width, other.depth, other.width))
+        table = self.table
+        for i, c in enumerate(other.table):
+            table[i] += c
+        return self
+
+    def copy(self):
+        return CountMinSketch(self.width, self.depth, array('q', self.table))
+
+    def to_bytes(self):
+        return struct.pack('<II', self.width, self.depth) + self.table.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        width, depth = struct.unpack_from('<II', data)
+        table = array('q')
+        table.frombytes(data[8:])
+        return cls(width, depth, table)
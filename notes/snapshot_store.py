@@ -0,0 +1,528 @@
+'''
+Deduplicated dimension snapshots
+
+The rise-of-the-data-engineer notes recommend
+"systematically snapshotting dimensions": a full copy
+of the users dimension in every ds partition. It keeps
+ETL and queries simple, but a year of daily snapshots
+is 365 near-identical copies of the table.
+
+SnapshotStore keeps the simple model (every ds is a
+complete snapshot) and stores each row version once:
+
+    base    every `rebase_every` days the snapshot is
+            sorted by key and cut into row blocks. A
+            block ends after every row whose key hashes
+            to 0 mod `block_rows`, so cut points depend
+            on the keys only. Blocks are content
+            addressed (sha256 of their columns), so key
+            ranges that did not change since the last
+            base are not stored again.
+    delta   on the other days only the rows that are new
+            or changed since the previous ds are stored,
+            plus the keys that were deleted.
+
+Each ds is a small JSON manifest naming its base and
+its delta. Storage grows with the number of changed
+rows, not with the number of days.
+
+When the changes are known already, e.g. from a change
+stream (cdc.py), write_changes() applies them to the
+previous snapshot instead of diffing two full ones.
+
+Reads stay lazy. A block of ds is rebuilt from its
+base block and the slice of every delta since the base
+that falls in its key range, and rebuilt blocks are
+kept in an LRU cache. A point lookup touches one block;
+reading a whole column rebuilds each block once.
+
+    python snapshot_store.py --users 200000 --days 365
+
+prints storage and read latency against full copies.
+'''
+import argparse
+import bisect
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+DELETED = '_deleted'
+
+
+def _cut_points(keys, block_rows):
+    '''Row positions after which a block ends; derived from the keys only.'''
+    with np.errstate(over='ignore'):
+        mixed = keys.astype(np.uint64) * _GOLDEN
+    mixed ^= mixed >> np.uint64(29)
+    ends = np.flatnonzero(mixed % np.uint64(block_rows) == 0) + 1
+    if not len(ends) or ends[-1] != len(keys):
+        ends = np.append(ends, len(keys))
+    return ends
+
+
+def _block_hash(columns, names):
+    h = hashlib.sha256()
+    for n in names:
+        col = np.ascontiguousarray(columns[n])
+        h.update('{0}:{1}:{2}\0'.format(n, col.dtype.str, len(col)).encode())
+        h.update(col.tobytes())
+    return h.hexdigest()
+
+
+def _save_npz(path, arrays):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, path)
+
+
+def _load_npz(path):
+    with np.load(path) as npz:
+        return dict((name, npz[name]) for name in npz.files)
+
+
+def _take(columns, rows):
+    return dict((name, values[rows]) for name, values in columns.items())
+
+
+def _differs(a, b):
+    '''a != b elementwise, except that NaN equals NaN.'''
+    out = a != b
+    if a.dtype.kind in 'fcO' and b.dtype.kind in 'fcO':
+        # x != x only holds for NaN
+        out &= ~((a != a) & (b != b))
+    return out
+
+
+def diff(key, previous, current):
+    '''
+    Rows of `current` that are new or changed compared
+    with `previous` (both sorted by key), and the keys of
+    `previous` that are gone.
+    '''
+    prev_keys, keys = previous[key], current[key]
+    if not len(prev_keys):
+        return current, keys[:0]
+    pos = np.minimum(np.searchsorted(prev_keys, keys), len(prev_keys) - 1)
+    exists = prev_keys[pos] == keys
+    changed = ~exists
+    for name, values in current.items():
+        if name != key:
+            changed |= _differs(values, previous[name][pos])
+    back = np.minimum(np.searchsorted(keys, prev_keys), max(len(keys) - 1, 0))
+    gone = keys[back] != prev_keys if len(keys) else np.ones(len(prev_keys), bool)
+    return _take(current, np.flatnonzero(changed)), prev_keys[gone]
+
+
+def upsert(key, data, changed, deleted):
+    '''
+    `data` (sorted by key) with the rows of `changed`
+    (sorted by key) replacing or added to it and the
+    `deleted` keys removed. One pass over data.
+    '''
+    keys = data[key]
+    drop = np.zeros(len(keys), dtype=bool)
+    for gone in (changed[key], deleted):
+        pos = np.minimum(np.searchsorted(keys, gone), max(len(keys) - 1, 0))
+        if len(keys):
+            drop[pos[keys[pos] == gone]] = True
+    keep = np.flatnonzero(~drop)
+    at = np.searchsorted(keys[keep], changed[key])
+    out = {}
+    for name, values in data.items():
+        # np.insert casts to the old dtype, which would cut longer strings short
+        dtype = np.result_type(values.dtype, changed[name].dtype)
+        out[name] = np.insert(values[keep].astype(dtype, copy=False), at, changed[name])
+    return out
+
+
+def apply_delta(key, block, delta, deleted):
+    '''Rows of `block` with `delta` upserted and `deleted` removed, sorted by key.'''
+    drop = np.isin(block[key], deleted) | np.isin(block[key], delta[key])
+    keep = np.flatnonzero(~drop)
+    merged = dict((name, np.concatenate([block[name][keep], delta[name]])) for name in block)
+    return _take(merged, np.argsort(merged[key], kind='stable'))
+
+
+class Snapshot(object):
+    '''
+    One ds as a complete, lazily read snapshot.
+
+        users = store.snapshot('2015-02-10')
+        users.get(23432423)            -> {'subscription_type': ...}
+        users.column('is_seller')      -> whole column
+    '''
+
+    def __init__(self, store, ds, manifest, base):
+        self.store = store
+        self.ds = ds
+        self.key = manifest['key']
+        self.columns = manifest['columns']
+        self.rows = manifest['rows']
+        self.chain = manifest['chain']
+        self.blocks = base['blocks']
+        # block 0 takes every key below block 1, so its min (None when the
+        # base is empty) is never compared
+        self._first_keys = [b['min'] for b in self.blocks[1:]]
+
+    def __len__(self):
+        return self.rows
+
+    def _block_for(self, key):
+        return bisect.bisect_right(self._first_keys, key)
+
+    def get(self, key):
+        '''The row for key as a dict, or None.'''
+        block = self.store.block(self, self._block_for(key))
+        keys = block[self.key]
+        pos = int(np.searchsorted(keys, key))
+        if pos == len(keys) or keys[pos] != key:
+            return None
+        return dict((name, block[name][pos].item()) for name in self.columns)
+
+    def iter_blocks(self):
+        for i in range(len(self.blocks)):
+            yield self.store.block(self, i)
+
+    def column(self, name):
+        parts = [block[name] for block in self.iter_blocks()]
+        return np.concatenate(parts) if parts else np.array([])
+
+    def to_columns(self):
+        blocks = list(self.iter_blocks())
+        return dict((name, np.concatenate([b[name] for b in blocks])) for name in self.columns)
+
+
+class SnapshotStore(object):
+    '''
+    Snapshot storage for one dimension table.
+
+        store = SnapshotStore(root, 'users', key='user_id')
+        store.write('2015-02-10', columns)
+        store.snapshot('2015-02-10').get(23432423)
+
+    Snapshots must be written in ds order; the delta of a
+    ds is taken against the previous ds written.
+    '''
+
+    def __init__(self, root, table, key, block_rows=4096, rebase_every=30,
+                 cache_blocks=512, cache_deltas=512):
+        self.root = os.path.join(root, table)
+        self.table = table
+        self.key = key
+        self.block_rows = block_rows
+        self.rebase_every = rebase_every
+        self.cache_blocks = cache_blocks
+        self.cache_deltas = cache_deltas
+        self._cache = OrderedDict()
+        self._deltas = OrderedDict()
+        self._last = None
+        for sub in ('blocks', 'deltas', 'manifests'):
+            path = os.path.join(self.root, sub)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def _block_path(self, digest):
+        return os.path.join(self.root, 'blocks', digest[:2], digest + '.npz')
+
+    def _delta_path(self, ds):
+        return os.path.join(self.root, 'deltas', 'ds={0}.npz'.format(ds))
+
+    def _manifest_path(self, ds):
+        return os.path.join(self.root, 'manifests', 'ds={0}.json'.format(ds))
+
+    def _write_manifest(self, ds, manifest):
+        tmp = self._manifest_path(ds) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, separators=(',', ':'))
+        os.replace(tmp, self._manifest_path(ds))
+
+    def _read_manifest(self, ds):
+        with open(self._manifest_path(ds)) as f:
+            return json.load(f)
+
+    def _write_base(self, data, names):
+        keys = data[self.key]
+        blocks, start = [], 0
+        for end in _cut_points(keys, self.block_rows):
+            block = dict((n, data[n][start:end]) for n in names)
+            digest = _block_hash(block, names)
+            if not os.path.exists(self._block_path(digest)):
+                _save_npz(self._block_path(digest), block)
+            blocks.append({'hash': digest, 'rows': int(end - start),
+                           'min': keys[start].item() if end > start else None})
+            start = end
+        return blocks
+
+    def _previous(self, ds):
+        '''(ds, manifest, data) of the last snapshot, read back after a restart.'''
+        if self._last is None:
+            written = self.partitions()
+            if written:
+                manifest = self._read_manifest(written[-1])
+                self._last = (written[-1], manifest, self.snapshot(written[-1]).to_columns())
+        last = self._last
+        if last is not None and last[0] >= ds:
+            raise ValueError('{0}: ds={1} written after ds={2}'.format(self.table, ds, last[0]))
+        return last
+
+    def _commit(self, ds, names, data, last, changed, deleted, meta):
+        if last is None or last[1]['columns'] != names or \
+                len(last[1]['chain']) >= self.rebase_every:
+            manifest = {'ds': ds, 'key': self.key, 'columns': names, 'rows': len(data[self.key]),
+                        'base': ds, 'chain': [], 'blocks': self._write_base(data, names)}
+        else:
+            if changed is None:
+                changed, deleted = diff(self.key, last[2], data)
+            delta = dict(changed)
+            delta[DELETED] = deleted
+            _save_npz(self._delta_path(ds), delta)
+            manifest = {'ds': ds, 'key': self.key, 'columns': names, 'rows': len(data[self.key]),
+                        'base': last[1]['base'], 'chain': last[1]['chain'] + [ds],
+                        'changed': len(changed[self.key]), 'deleted': len(deleted)}
+        if meta is not None:
+            manifest['meta'] = meta
+        self._write_manifest(ds, manifest)
+        self._last = (ds, manifest, data)
+        return manifest
+
+    def _sorted(self, ds, columns):
+        order = np.argsort(np.asarray(columns[self.key]), kind='stable')
+        data = dict((n, np.asarray(columns[n])[order]) for n in sorted(columns))
+        keys = data[self.key]
+        if len(keys) > 1 and (keys[1:] == keys[:-1]).any():
+            raise ValueError('{0}.{1} is not unique for ds={2}'.format(self.table, self.key, ds))
+        return data
+
+    def write(self, ds, columns, meta=None):
+        '''
+        Store a full snapshot of the dimension for ds.
+        `meta` is kept in the manifest. Returns the manifest.
+        '''
+        if self.key not in columns:
+            raise ValueError('snapshot has no {0} column'.format(self.key))
+        data = self._sorted(ds, columns)
+        last = self._previous(ds)
+        return self._commit(ds, sorted(columns), data, last, None, None, meta)
+
+    def write_changes(self, ds, changed, deleted, meta=None):
+        '''
+        Store the snapshot for ds as the previous one with
+        the rows of `changed` upserted and the `deleted`
+        keys removed: O(changes) to find the delta, one
+        pass over the table to keep the full snapshot for
+        the next day. Returns the manifest.
+        '''
+        last = self._previous(ds)
+        if last is None:
+            raise ValueError('{0}: no snapshot before ds={1} to apply changes to'.format(
+                self.table, ds))
+        names = last[1]['columns']
+        if sorted(changed) != names:
+            raise ValueError('{0}: changes have columns {1}, snapshot has {2}'.format(
+                self.table, sorted(changed), names))
+        changed = self._sorted(ds, changed)
+        previous = last[2]
+        keys = previous[self.key]
+        deleted = np.asarray(deleted)
+        deleted = np.unique(deleted if len(deleted) else deleted.astype(keys.dtype))
+        if len(keys):
+            pos = np.minimum(np.searchsorted(keys, deleted), len(keys) - 1)
+            deleted = deleted[keys[pos] == deleted]
+            # updates that wrote the same values are not changes
+            pos = np.minimum(np.searchsorted(keys, changed[self.key]), len(keys) - 1)
+            same = keys[pos] == changed[self.key]
+            for name in names:
+                same &= previous[name][pos] == changed[name]
+            changed = _take(changed, np.flatnonzero(~same))
+        data = upsert(self.key, previous, changed, deleted)
+        return self._commit(ds, names, data, last, changed, deleted, meta)
+
+    def partitions(self):
+        names = os.listdir(os.path.join(self.root, 'manifests'))
+        return sorted(n[3:-5] for n in names if n.startswith('ds=') and n.endswith('.json'))
+
+    def snapshot(self, ds):
+        manifest = self._read_manifest(ds)
+        base = manifest if manifest['base'] == ds else self._read_manifest(manifest['base'])
+        return Snapshot(self, ds, manifest, base)
+
+    def _delta(self, ds):
+        delta = self._deltas.get(ds)
+        if delta is None:
+            delta = self._deltas[ds] = _load_npz(self._delta_path(ds))
+            if len(self._deltas) > self.cache_deltas:
+                self._deltas.popitem(last=False)
+        return delta
+
+    def block(self, snap, i):
+        '''
+        Block i of a snapshot. Starts from the newest
+        cached version of the block along the snapshot's
+        delta chain (or the base block) and applies only
+        the deltas after it.
+        '''
+        cache_key = (snap.ds, i)
+        block = self._cache.get(cache_key)
+        if block is not None:
+            self._cache.move_to_end(cache_key)
+            return block
+        pending = list(snap.chain)
+        while pending:
+            block = self._cache.get((pending[-1], i))
+            if block is not None:
+                break
+            pending.pop()
+        else:
+            block = _load_npz(self._block_path(snap.blocks[i]['hash']))
+        start = len(pending)
+        lo = snap.blocks[i]['min'] if i else None
+        hi = snap.blocks[i + 1]['min'] if i + 1 < len(snap.blocks) else None
+        for ds in snap.chain[start:]:
+            delta = self._delta(ds)
+            keys, gone = delta[self.key], delta[DELETED]
+            a = np.searchsorted(keys, lo) if lo is not None else 0
+            b = np.searchsorted(keys, hi) if hi is not None else len(keys)
+            ga = np.searchsorted(gone, lo) if lo is not None else 0
+            gb = np.searchsorted(gone, hi) if hi is not None else len(gone)
+            if a < b or ga < gb:
+                piece = dict((name, delta[name][a:b]) for name in snap.columns)
+                block = apply_delta(self.key, block, piece, gone[ga:gb])
+        self._cache[cache_key] = block
+        if len(self._cache) > self.cache_blocks:
+            self._cache.popitem(last=False)
+        return block
+
+    def disk_bytes(self):
+        total = 0
+        for dirpath, _, files in os.walk(self.root):
+            total += sum(os.path.getsize(os.path.join(dirpath, f)) for f in files)
+        return total
+
+
+def synthetic_users(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return {
+        'user_id': np.arange(1, n + 1, dtype=np.int64) * 3,
+        'subscription_type': np.array(['free', 'awesome', 'pluses'])[rng.integers(0, 3, n)],
+        'is_seller': rng.random(n) < 0.05,
+        'has_android_app': rng.random(n) < 0.3,
+        'photos_uploaded': rng.integers(0, 500, n),
+        }
+
+
+def evolve(users, rng, change_rate=0.005, growth_rate=0.001, churn_rate=0.0002):
+    '''Next day's users: some rows updated, a few deleted, a few new users appended.'''
+    n = len(users['user_id'])
+    keep = np.ones(n, dtype=bool)
+    keep[rng.choice(n, int(n * churn_rate), replace=False)] = False
+    users = dict((k, v[keep].copy()) for k, v in users.items())
+    n = len(users['user_id'])
+    changed = rng.choice(n, int(n * change_rate), replace=False)
+    users['subscription_type'][changed] = np.array(['free', 'awesome', 'pluses'])[
+        rng.integers(0, 3, len(changed))]
+    users['photos_uploaded'][changed] += 1
+    new = int(n * growth_rate)
+    start = users['user_id'][-1] + 3
+    fresh = {
+        'user_id': np.arange(start, start + 3 * new, 3, dtype=np.int64),
+        'subscription_type': np.array(['free'] * new),
+        'is_seller': np.zeros(new, dtype=bool),
+        'has_android_app': rng.random(new) < 0.3,
+        'photos_uploaded': np.zeros(new, dtype=np.int64),
+        }
+    return dict((k, np.concatenate([users[k], fresh[k]])) for k in users)
+
+
+def main(argv=None):
+    from backfill import ds_add, ds_range
+
+    parser = argparse.ArgumentParser(description='deduplicated snapshot store benchmark')
+    parser.add_argument('--users', type=int, default=200000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--change-rate', type=float, default=0.005)
+    parser.add_argument('--rebase-every', type=int, default=30)
+    parser.add_argument('--lookups', type=int, default=20000)
+    args = parser.parse_args(argv)
+
+    tmp = tempfile.mkdtemp(prefix='snapstore-')
+    try:
+        rng = np.random.default_rng(0)
+        days = ds_range('2015-01-01', ds_add('2015-01-01', args.days - 1))
+        store = SnapshotStore(tmp, 'users', 'user_id', rebase_every=args.rebase_every)
+        full_root = os.path.join(tmp, 'full_copies')
+        users = synthetic_users(args.users)
+        per_day = args.lookups // len(days) + 1
+        lookups = []
+        write_store = write_full = 0.0
+        for i, ds in enumerate(days):
+            if i:
+                users = evolve(users, rng, args.change_rate)
+            keys = users['user_id'][rng.integers(0, len(users['user_id']), per_day)]
+            lookups.extend((ds, int(k)) for k in keys)
+            t = time.time()
+            store.write(ds, users)
+            write_store += time.time() - t
+            t = time.time()
+            path = os.path.join(full_root, 'ds={0}'.format(ds))
+            os.makedirs(path)
+            for name, values in users.items():
+                np.save(os.path.join(path, name + '.npy'), values)
+            write_full += time.time() - t
+
+        full_bytes = sum(os.path.getsize(os.path.join(d, f))
+                         for d, _, files in os.walk(full_root) for f in files)
+        print('{0} daily snapshots, {1} -> {2} users, {3:.1%} rows changed per day'.format(
+            args.days, args.users, len(users['user_id']), args.change_rate))
+        print('storage: full copies {0:8.1f} MB ({1:.2f}s to write)'.format(
+            full_bytes / 1e6, write_full))
+        print('         store       {0:8.1f} MB ({1:.2f}s to write), {2:.1f}x smaller'.format(
+            store.disk_bytes() / 1e6, write_store, float(full_bytes) / store.disk_bytes()))
+
+        lookups = [lookups[j] for j in rng.permutation(len(lookups))[:args.lookups]]
+        for label in ('cold', 'warm'):
+            if label == 'cold':
+                store._cache.clear()
+                store._deltas.clear()
+            snapshots = {}
+            latencies = []
+            for ds, key in lookups:
+                t = time.time()
+                snap = snapshots.get(ds)
+                if snap is None:
+                    snap = snapshots[ds] = store.snapshot(ds)
+                row = snap.get(key)
+                latencies.append(time.time() - t)
+                assert row is not None, (ds, key)
+            latencies.sort()
+            print('point reads ({0}): p50 {1:8.1f}us  p99 {2:8.1f}us'.format(
+                label, latencies[len(latencies) // 2] * 1e6,
+                latencies[int(len(latencies) * 0.99)] * 1e6))
+
+        ds = days[-1]
+        store._cache.clear()
+        t = time.time()
+        rebuilt = store.snapshot(ds).to_columns()
+        scan_store = time.time() - t
+        t = time.time()
+        path = os.path.join(full_root, 'ds={0}'.format(ds))
+        dict((n[:-4], np.load(os.path.join(path, n))) for n in os.listdir(path))
+        scan_full = time.time() - t
+        for name, values in users.items():
+            assert (rebuilt[name] == values).all(), name
+        print('full snapshot read: full copy {0:.3f}s  store {1:.3f}s'.format(scan_full, scan_store))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
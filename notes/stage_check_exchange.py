@@ -0,0 +1,394 @@
+'''
+Stage-check-exchange
+
+The guide's "add data checks early and often" in code:
+
+    stage     write the new ds into a staging version
+              that nobody reads yet
+    check     run every registered check against the
+              staged columns
+    exchange  make the staged version the production
+              partition in one atomic step
+
+A partition is a directory of .npy files, one per
+column, so the checks memory-map the columns they need
+and run as NumPy expressions. Each column is loaded
+once and the derived stats (null mask, mean/std) are
+computed once and shared by every check that asks for
+them, so N checks cost one pass over the data instead
+of N queries.
+
+Production partitions are symlinks:
+
+    dim_total_bookings/ds=2018-02-09 -> _versions/ds=2018-02-09.<id>
+
+Exchange points a fresh symlink at the staged version
+and os.replace()s it over the old one. That rename is
+atomic, so readers see either the old partition or the
+new one, and nothing is copied.
+
+    python stage_check_exchange.py --rows 2000000 --checks 8
+
+compares this with N check queries and a copy exchange.
+'''
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+import numpy as np
+
+VERSIONS = '_versions'
+STAGING = '_staging'
+
+
+class DataQualityError(Exception):
+
+    def __init__(self, table, ds, results, staging_path):
+        self.table = table
+        self.ds = ds
+        self.results = results
+        self.staging_path = staging_path
+        failed = ', '.join('{0} ({1})'.format(r.name, r.detail) for r in results if not r.passed)
+        super(DataQualityError, self).__init__(
+            '{0} ds={1} failed checks: {2}'.format(table, ds, failed))
+
+
+class CheckResult(object):
+
+    __slots__ = ('name', 'passed', 'detail')
+
+    def __init__(self, name, passed, detail=''):
+        self.name = name
+        self.passed = bool(passed)
+        self.detail = detail
+
+    def __repr__(self):
+        return '<{0} {1} {2}>'.format(self.name, 'ok' if self.passed else 'FAILED', self.detail)
+
+
+class ColumnScan(object):
+    '''
+    The single pass over a staged partition. Columns are
+    memory-mapped on first use and every derived array is
+    computed once, no matter how many checks need it.
+    '''
+
+    def __init__(self, path, mmap=True):
+        self.path = path
+        self.mmap_mode = 'r' if mmap else None
+        self._cache = {}
+
+    @classmethod
+    def from_columns(cls, columns):
+        '''A scan over arrays in memory; masked (NULL) entries become NaN or None.'''
+        scan = cls(None)
+        for name, values in columns.items():
+            if isinstance(values, np.ma.MaskedArray):
+                mask = np.ma.getmaskarray(values)
+                if values.dtype.kind == 'f':
+                    values = values.filled(np.nan)
+                else:
+                    values = values.data.astype(object)
+                    values[mask] = None
+            scan._cache[('col', name)] = np.asarray(values)
+        scan._cache['rows'] = len(next(iter(scan._cache.values()))) if columns else 0
+        return scan
+
+    def _memo(self, key, compute):
+        if key not in self._cache:
+            self._cache[key] = compute()
+        return self._cache[key]
+
+    def column(self, name):
+        return self._memo(('col', name), lambda: np.load(
+            os.path.join(self.path, name + '.npy'), mmap_mode=self.mmap_mode))
+
+    @property
+    def row_count(self):
+        def count():
+            names = [f[:-4] for f in os.listdir(self.path) if f.endswith('.npy')]
+            return len(self.column(names[0])) if names else 0
+        return self._memo('rows', count)
+
+    def nulls(self, name):
+        def mask():
+            col = self.column(name)
+            if col.dtype.kind == 'f':
+                return np.isnan(col)
+            if col.dtype.kind in 'US':
+                return col == col.dtype.type()
+            if col.dtype.kind == 'O':
+                return np.equal(col, None)
+            return np.zeros(len(col), dtype=bool)
+        return self._memo(('nulls', name), mask)
+
+    def values(self, name):
+        '''Non-null values of a column.'''
+        return self._memo(('values', name), lambda: np.asarray(self.column(name))[~self.nulls(name)])
+
+    def moments(self, name):
+        def compute():
+            v = self.values(name).astype(np.float64)
+            return (v.mean(), v.std()) if len(v) else (0.0, 0.0)
+        return self._memo(('moments', name), compute)
+
+    def distinct(self, name):
+        return self._memo(('distinct', name), lambda: np.unique(self.values(name)))
+
+
+class RowCountCheck(object):
+
+    def __init__(self, min_rows=1):
+        self.name = 'row_count>={0}'.format(min_rows)
+        self.min_rows = min_rows
+
+    def __call__(self, scan):
+        n = scan.row_count
+        return CheckResult(self.name, n >= self.min_rows, '{0} rows'.format(n))
+
+
+class NullRateCheck(object):
+
+    def __init__(self, column, max_rate=0.0):
+        self.name = 'null_rate({0})<={1}'.format(column, max_rate)
+        self.column = column
+        self.max_rate = max_rate
+
+    def __call__(self, scan):
+        n = scan.row_count
+        rate = float(scan.nulls(self.column).sum()) / n if n else 0.0
+        return CheckResult(self.name, rate <= self.max_rate, '{0:.4%} null'.format(rate))
+
+
+class UnseenCategoryCheck(object):
+    '''
+    Fail when a categorical column has values that are
+    not in `known` (e.g. the dim_market values of the
+    current production partition). `known` may be a
+    callable, so it is only resolved when the check runs.
+    '''
+
+    def __init__(self, column, known, max_unseen=0):
+        self.name = 'unseen({0})<={1}'.format(column, max_unseen)
+        self.column = column
+        self.known = known
+        self.max_unseen = max_unseen
+
+    def __call__(self, scan):
+        known = self.known() if callable(self.known) else self.known
+        seen = scan.distinct(self.column)
+        # compared as objects: casting known to the staged column's dtype
+        # would cut longer values down to its string width
+        unseen = seen[~np.isin(seen.astype(object), np.array(sorted(known), dtype=object))]
+        detail = '{0} unseen'.format(len(unseen))
+        if len(unseen):
+            detail += ': ' + ', '.join(str(v) for v in unseen[:5])
+        return CheckResult(self.name, len(unseen) <= self.max_unseen, detail)
+
+
+class ZScoreCheck(object):
+    '''Fail when more than max_fraction of rows are beyond `threshold` standard deviations.'''
+
+    def __init__(self, column, threshold=4.0, max_fraction=0.001):
+        self.name = 'zscore({0})>{1}'.format(column, threshold)
+        self.column = column
+        self.threshold = threshold
+        self.max_fraction = max_fraction
+
+    def __call__(self, scan):
+        mean, std = scan.moments(self.column)
+        values = scan.values(self.column)
+        if std == 0 or not len(values):
+            return CheckResult(self.name, True, 'constant column')
+        outliers = int((np.abs(values - mean) > self.threshold * std).sum())
+        fraction = float(outliers) / len(values)
+        return CheckResult(self.name, fraction <= self.max_fraction,
+                           '{0} outliers ({1:.4%})'.format(outliers, fraction))
+
+
+def write_partition(path, columns):
+    '''Write {name: array-like} as one .npy file per column.'''
+    os.makedirs(path)
+    lengths = set(len(v) for v in columns.values())
+    if len(lengths) > 1:
+        raise ValueError('columns have different lengths: {0}'.format(sorted(lengths)))
+    for name, values in columns.items():
+        np.save(os.path.join(path, name + '.npy'), np.asarray(values))
+
+
+def swap_partition(table_path, link, version):
+    '''
+    Point the partition symlink `link` at `version`, a
+    directory under table_path, with one rename, then
+    remove the version it pointed at before.
+
+    A partition written before the table was versioned
+    is a plain directory, which a symlink cannot be
+    renamed over. Its first swap moves it into _versions
+    and renames the link into its place right after.
+    '''
+    # not ds=...: a reader globbing the partitions must not see it
+    tmp_link = os.path.join(os.path.dirname(link), '_tmp.{0}.{1}'.format(
+        os.path.basename(link), uuid.uuid4().hex))
+    os.symlink(os.path.relpath(version, table_path), tmp_link)
+    previous = None
+    if os.path.islink(link):
+        previous = os.path.realpath(link)
+    elif os.path.isdir(link):
+        previous = os.path.join(table_path, VERSIONS, '{0}.legacy-{1}'.format(
+            os.path.basename(link), uuid.uuid4().hex))
+        os.rename(link, previous)
+    os.replace(tmp_link, link)
+    if previous and previous != os.path.realpath(version):
+        shutil.rmtree(previous, ignore_errors=True)
+    return link
+
+
+class StageCheckExchange(object):
+    '''
+    One stage-check-exchange table.
+
+        stage = StageCheckExchange(root, 'dim_total_bookings', [
+                RowCountCheck(),
+                NullRateCheck('dim_market'),
+                UnseenCategoryCheck('dim_market', known_markets),
+                ZScoreCheck('m_bookings'),
+                ])
+        stage.run('2018-02-09', columns)
+
+    run() raises DataQualityError and leaves production
+    alone when a check fails; the staged data is kept so
+    it can be inspected. With a PartitionIndex, every
+    exchanged partition is also recorded in it.
+    '''
+
+    def __init__(self, root, table, checks=(), index=None):
+        self.root = root
+        self.table = table
+        self.checks = list(checks)
+        self.index = index
+        self.table_path = os.path.join(root, table)
+        for sub in (VERSIONS, STAGING):
+            path = os.path.join(self.table_path, sub)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def register(self, check):
+        self.checks.append(check)
+        return check
+
+    def partition_path(self, ds):
+        return os.path.join(self.table_path, 'ds={0}'.format(ds))
+
+    def stage(self, ds, columns):
+        path = os.path.join(self.table_path, STAGING, 'ds={0}.{1}'.format(ds, uuid.uuid4().hex))
+        write_partition(path, columns)
+        return path
+
+    def check(self, path):
+        scan = ColumnScan(path)
+        return [check(scan) for check in self.checks]
+
+    def exchange(self, ds, staged_path):
+        '''
+        Publish staged_path as the ds partition. The
+        directory is moved, not copied, and the symlink
+        swap is a single rename (see swap_partition).
+        '''
+        version = os.path.join(self.table_path, VERSIONS, os.path.basename(staged_path))
+        os.rename(staged_path, version)
+        return swap_partition(self.table_path, self.partition_path(ds), version)
+
+    def run(self, ds, columns):
+        staged = self.stage(ds, columns)
+        results = self.check(staged)
+        if not all(r.passed for r in results):
+            raise DataQualityError(self.table, ds, results, staged)
+        link = self.exchange(ds, staged)
+        if self.index is not None:
+            self.index.record(self.table, ds, link)
+        return results
+
+    def read(self, ds, column):
+        return np.load(os.path.join(self.partition_path(ds), column + '.npy'), mmap_mode='r')
+
+
+def synthetic_dim_total_bookings(rows, markets=500, seed=0):
+    rng = np.random.default_rng(seed)
+    return {
+        'dim_market': np.array(['market_{0}'.format(i) for i in range(markets)])[
+            rng.integers(0, markets, rows)],
+        'id_listing': rng.integers(0, 10 * rows, rows),
+        'm_bookings': rng.poisson(20, rows).astype(np.float64),
+        }
+
+
+def _checks(known, n):
+    base = [RowCountCheck(), NullRateCheck('dim_market'), NullRateCheck('m_bookings', 0.01),
+            UnseenCategoryCheck('dim_market', known), ZScoreCheck('m_bookings')]
+    extra = [ZScoreCheck('m_bookings', 3 + i, 0.01) for i in range(max(0, n - len(base)))]
+    return (base + extra)[:n]
+
+
+def _separate_queries(path, checks):
+    '''Today's way: each check is its own query that reads the table again.'''
+    return [check(ColumnScan(path, mmap=False)) for check in checks]
+
+
+def bench(rows, n_checks, seed):
+    data = synthetic_dim_total_bookings(rows, seed=seed)
+    known = set(np.unique(data['dim_market']).tolist())
+    root = tempfile.mkdtemp(prefix='sce-')
+    try:
+        print('{0} rows, {1} checks'.format(rows, n_checks))
+
+        plain = os.path.join(root, 'plain')
+        write_partition(os.path.join(plain, 'load'), data)
+        t = time.time()
+        _separate_queries(os.path.join(plain, 'load'), _checks(known, n_checks))
+        checks_time = time.time() - t
+        t = time.time()
+        shutil.copytree(os.path.join(plain, 'load'), os.path.join(plain, 'ds=2018-02-09'))
+        exchange_time = time.time() - t
+        print('separate queries + copy: checks {0:.3f}s  exchange {1:.3f}s'.format(
+            checks_time, exchange_time))
+
+        stage = StageCheckExchange(root, 'dim_total_bookings', _checks(known, n_checks))
+        staged = stage.stage('2018-02-09', data)
+        t = time.time()
+        results = stage.check(staged)
+        checks_time = time.time() - t
+        t = time.time()
+        stage.exchange('2018-02-09', staged)
+        exchange_time = time.time() - t
+        print('single scan + rename:    checks {0:.3f}s  exchange {1:.6f}s'.format(
+            checks_time, exchange_time))
+        for r in results:
+            print('    {0!r}'.format(r))
+
+        bad = dict(data)
+        bad['dim_market'] = data['dim_market'].astype('U32')
+        bad['dim_market'][:3] = 'market_atlantis'
+        try:
+            stage.run('2018-02-10', bad)
+        except DataQualityError as e:
+            print('rejected as expected: {0}'.format(e))
+        assert not os.path.exists(stage.partition_path('2018-02-10'))
+    finally:
+        shutil.rmtree(root)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='stage-check-exchange benchmark')
+    parser.add_argument('--rows', type=int, default=2000000)
+    parser.add_argument('--checks', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    bench(args.rows, args.checks, args.seed)
+
+
+if __name__ == '__main__':
+    main()
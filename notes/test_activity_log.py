@@ -0,0 +1,25 @@
+import numpy as np
+
+from activity_log import parse_chunk
+
+
+def _parse(*stamps):
+    text = ''.join('{0} 7 photo_like 9 1.2.3.4 /get?photo=9\n'.format(s) for s in stamps)
+    columns, _, malformed = parse_chunk(np.frombuffer(text.encode(), dtype=np.uint8))
+    return [str(t) for t in columns['datetime']], malformed
+
+
+def test_fractions_and_calendar_days():
+    parsed, malformed = _parse('2015-02-10 01:02:03.12345', '2015-02-10 01:02:03',
+                               '2016-02-29 01:02:03.5', '2015–02–10 01:02:03.1234567')
+    assert parsed == ['2015-02-10T01:02:03.123450', '2015-02-10T01:02:03.000000',
+                      '2016-02-29T01:02:03.500000', '2015-02-10T01:02:03.123456']
+    assert malformed == 0
+
+
+def test_malformed_fractions_and_days_are_dropped():
+    parsed, malformed = _parse('2015-02-10 01:02:03.12x45', '2015-02-10 01:02:03xabc',
+                               '2015-02-10 01:02:03.', '2015-02-31 01:02:03',
+                               '2015-02-29 01:02:03', '2015-04-31 01:02:03')
+    assert parsed == []
+    assert malformed == 6
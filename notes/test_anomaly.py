@@ -0,0 +1,28 @@
+import numpy as np
+
+from anomaly import AnomalyDetector, KeyedEwma
+from backfill import ds_add
+
+
+def test_day_of_zeros_does_not_poison_keyed_state(tmp_path):
+    detector = AnomalyDetector(str(tmp_path), 'bookings', keyed=[('dim_market', 'm_bookings')],
+                               warmup=3)
+    markets = np.array(['a', 'b', 'c'])
+    normal = [[10.0, 10.0, 10.0]] * 5
+    days = normal + [[0.0, 0.0, 5.0]] + normal + [[10.0, 10.0, 90.0]]
+    ds = '2018-01-01'
+    for values in days:
+        anomalies, _ = detector.observe(ds, {'dim_market': markets,
+                                             'm_bookings': np.array(values)}, save=False)
+        ds = ds_add(ds, 1)
+    state = detector.by_key[('dim_market', 'm_bookings')]
+    assert np.isfinite(state.mean).all()
+    assert [a.key for a in anomalies if a.kind == 'outlier'] == ['c']
+
+
+def test_update_drops_non_finite_values():
+    state = KeyedEwma()
+    state.update(np.array(['a', 'b'], dtype=object), np.array([1.0, np.nan]), 0)
+    state.update(np.array(['a'], dtype=object), np.array([np.inf]), 1)
+    assert state.keys.tolist() == ['a']
+    assert state.mean.tolist() == [1.0]
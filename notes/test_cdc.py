@@ -0,0 +1,18 @@
+import numpy as np
+
+from cdc import INSERT, UPDATE, BinlogWriter, CdcIngestor
+
+
+def test_longer_strings_are_not_truncated(tmp_path):
+    binlog = str(tmp_path / 'binlog')
+    ingest = CdcIngestor(str(tmp_path / 'warehouse'), binlog, 'users', 'user_id')
+    ingest.load('2015-01-01', {'user_id': np.array([1, 2]), 'name': np.array(['ab', 'cd'])})
+    log = BinlogWriter(binlog)
+    log.append('users', INSERT, '2015-01-02 10:00:00', {'user_id': 3, 'name': 'a_much_longer_name'})
+    log.append('users', UPDATE, '2015-01-02 11:00:00', {'user_id': 1, 'name': 'also_longer'})
+    log.close()
+    ingest.run('2015-01-02')
+    snapshot = ingest.snapshot('2015-01-02')
+    assert snapshot.get(3)['name'] == 'a_much_longer_name'
+    assert snapshot.get(1)['name'] == 'also_longer'
+    assert snapshot.get(2)['name'] == 'cd'
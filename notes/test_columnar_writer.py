@@ -0,0 +1,57 @@
+import numpy as np
+
+from columnar_writer import ColumnarFile, decode_node, encode_column, write_table
+
+
+def _round_trip(values):
+    node, parts = encode_column(values)
+    return node['enc'], decode_node(node, parts).astype(values.dtype, copy=False)
+
+
+def test_encodings_round_trip():
+    rng = np.random.default_rng(0)
+    cases = {
+        'for': rng.integers(1000, 1200, 5000),
+        'delta': np.cumsum(rng.integers(0, 3, 5000)) + 10 ** 12,
+        'rle': np.repeat(rng.integers(-10 ** 15, 10 ** 15, 20), 250),
+        'bits': rng.random(5000) < 0.5,
+        'plain': rng.random(5000),
+        'dict': rng.choice(np.array(['free', 'awesome', 'pluses']), 5000),
+        }
+    for expected, values in cases.items():
+        enc, decoded = _round_trip(values)
+        assert enc == expected
+        assert np.array_equal(decoded, values)
+    extremes = np.array([np.iinfo(np.int64).min, 0, np.iinfo(np.int64).max])
+    assert np.array_equal(_round_trip(extremes)[1], extremes)
+    assert _round_trip(np.empty(0, dtype=np.int64))[1].tolist() == []
+
+
+def test_write_read_with_filters(tmp_path):
+    path = str(tmp_path / 'part.ncol')
+    columns = {'market': np.array(['b', 'a', 'b', 'c'] * 3000),
+               'value': np.arange(12000, dtype=np.int64)}
+    write_table(path, columns, row_group_rows=1000)
+    table = ColumnarFile(path)
+    got = table.read()
+    assert sorted(got['value'].tolist()) == list(range(12000))
+    b = table.read(['value'], where={'market': 'b'})['value']
+    assert sorted(b.tolist()) == [v for v in range(12000) if v % 4 in (0, 2)]
+    assert table.read(where={'market': 'z'})['value'].tolist() == []
+
+
+def test_nan_chunks_keep_their_rows(tmp_path):
+    path = str(tmp_path / 'part.ncol')
+    write_table(path, {'a': np.array([1.0, np.nan, 2.0, 3.0])}, sort=[])
+    assert ColumnarFile(path).read(where={'a': 2.0})['a'].tolist() == [2.0]
+    write_table(path, {'a': np.array([np.nan, np.nan])}, sort=[])
+    assert len(ColumnarFile(path).read()['a']) == 2
+
+
+def test_bytes_columns(tmp_path):
+    path = str(tmp_path / 'part.ncol')
+    values = np.array([b'x', b'yy', b'x', b'zzz'])
+    write_table(path, {'b': values, 'n': np.arange(4)}, sort=[])
+    table = ColumnarFile(path)
+    assert table.read()['b'].tolist() == values.tolist()
+    assert table.read(['n'], where={'b': b'x'})['n'].tolist() == [0, 2]
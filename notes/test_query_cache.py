@@ -0,0 +1,64 @@
+import numpy as np
+
+from local_engine import LocalEngine
+from query_cache import Aggregate, QueryCache, normalize
+
+LIKES = "SELECT * FROM (VALUES ('free', 1), ('awesome', 2), ('free', 3)) t(subscription_type, n)"
+BY_TYPE = ("SELECT subscription_type, COUNT(*) AS likes, SUM(n) AS n FROM likes "
+           "WHERE ds BETWEEN '{0}' AND '{1}' GROUP BY subscription_type "
+           "ORDER BY subscription_type")
+
+
+def _engine(tmp_path, days):
+    engine = LocalEngine(str(tmp_path))
+    for ds in days:
+        engine.insert_overwrite('likes', ds, LIKES)
+    return engine
+
+
+def test_normalize_ignores_spacing_case_and_comments():
+    a = "SELECT  a ,COUNT(1)\nFROM t -- today\nWHERE ds = '2018-01-01' AND b = 'X Y';"
+    b = "select a, count(*) from t where ds='2018-01-01' and b='X Y'"
+    assert normalize(a) == normalize(b)
+    assert normalize("select 'A'") != normalize("select 'a'")
+
+
+def test_combine_daily_partials():
+    aggregate = Aggregate.parse(normalize(
+        "SELECT g, SUM(x) AS s, AVG(x) AS a, MAX(x) AS m FROM t "
+        "WHERE ds BETWEEN '2018-01-01' AND '2018-01-02' GROUP BY g ORDER BY s DESC"))
+    partials = [{'g': np.array(['a', 'b']), '_p0': np.array([1, 10]), '_p1': np.array([1, 10]),
+                 '_p2': np.array([1, 2]), '_p3': np.array([1, 9])},
+                {'g': np.array(['a']), '_p0': np.array([20]), '_p1': np.array([20]),
+                 '_p2': np.array([2]), '_p3': np.array([15])}]
+    out = aggregate.combine(partials)
+    assert out['g'].tolist() == ['a', 'b']
+    assert out['s'].tolist() == [21, 10]
+    assert out['a'].tolist() == [7.0, 5.0]
+    assert out['m'].tolist() == [15, 9]
+
+
+def test_invalidate_drops_only_results_covering_the_partition(tmp_path):
+    engine = _engine(tmp_path, ['2018-01-01', '2018-01-02'])
+    cache = QueryCache(engine)
+    cache.query(BY_TYPE.format('2018-01-01', '2018-01-01'))
+    cache.query(BY_TYPE.format('2018-01-02', '2018-01-02'))
+    entries = len(cache.entries)
+    assert cache.invalidate('likes', '2018-01-02') == 2
+    assert len(cache.entries) == entries - 2
+    cache.execute("INSERT OVERWRITE TABLE likes PARTITION (ds = '2018-01-01') "
+                  "SELECT 'free' AS subscription_type, 5 AS n")
+    got = cache.query(BY_TYPE.format('2018-01-01', '2018-01-01'))
+    assert got['n'].tolist() == [5]
+    engine.close()
+
+
+def test_wide_and_empty_ranges(tmp_path):
+    engine = _engine(tmp_path, ['2018-01-01', '2018-01-02'])
+    cache = QueryCache(engine)
+    got = cache.query(BY_TYPE.format('2010-01-01', '2019-12-31'))
+    assert got['likes'].tolist() == [2, 4]
+    assert len(cache.entries) == 3
+    empty = "SELECT COUNT(*) AS n FROM likes WHERE ds BETWEEN '2018-01-02' AND '2018-01-01'"
+    assert cache.query(empty)['n'].tolist() == engine.query(empty)['n'].tolist() == [0]
+    engine.close()
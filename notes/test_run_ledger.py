@@ -0,0 +1,32 @@
+from run_ledger import hql_io
+
+WRITE = "INSERT OVERWRITE TABLE dim PARTITION (ds = '2018-02-09') "
+
+
+def test_partition_reads():
+    inputs, outputs = hql_io(WRITE + "SELECT * FROM fct WHERE ds = '2018-02-09'")
+    assert inputs == {('fct', '2018-02-09')}
+    assert outputs == {('dim', '2018-02-09')}
+    inputs, _ = hql_io(WRITE + "SELECT * FROM dim d WHERE d.ds = DATE_SUB('2018-02-09', 1) "
+                       "UNION ALL SELECT * FROM fct AS f WHERE f.ds = DATE_ADD('2018-02-08', 1)")
+    assert inputs == {('dim', '2018-02-08'), ('fct', '2018-02-09')}
+
+
+def test_read_without_ds_predicate_is_whole_table():
+    inputs, _ = hql_io(WRITE + "SELECT * FROM fct WHERE ds = '2018-02-09' "
+                       "UNION ALL SELECT * FROM fct WHERE ds < '2018-02-09'")
+    assert inputs == {('fct', None)}
+    inputs, _ = hql_io(WRITE + "SELECT * FROM fct f JOIN users u ON f.id = u.id "
+                       "WHERE f.ds = '2018-02-09'")
+    assert ('users', None) in inputs
+
+
+def test_or_and_extra_ds_terms_are_whole_table():
+    for where in ("ds = '2018-02-08' OR ds = '2018-02-09'",
+                  "ds = '2018-02-08' AND (m > 0 OR ds = '2018-02-09')",
+                  "ds = '2018-02-08' AND ds <= '2018-02-09'"):
+        inputs, _ = hql_io(WRITE + 'SELECT * FROM fct WHERE ' + where)
+        assert inputs == {('fct', None)}, where
+    inputs, _ = hql_io(WRITE + "SELECT * FROM fct WHERE ds = '2018-02-09' AND m > 0 "
+                       "GROUP BY id ORDER BY id")
+    assert inputs == {('fct', '2018-02-09')}
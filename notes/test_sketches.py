@@ -0,0 +1,17 @@
+import numpy as np
+
+from metrics_layer import hll_registers
+from sketches import HyperLogLog, hash64, hash_keys
+
+
+def test_scalar_and_column_hashes_agree():
+    values = [42, 42.0, True, -7, 2 ** 63 - 1, 1.5, float('nan'), 'market_3', b'x']
+    assert [hash64(v) for v in values] == hash_keys(np.array(values, dtype=object)).tolist()
+    assert hash64(42) == hash64(42.0) == int(hash_keys(np.array([42]))[0])
+
+
+def test_metrics_layer_registers_merge_with_hyperloglog():
+    ids = np.arange(50000)
+    by_value = HyperLogLog(12).update(ids.tolist())
+    vectorized = hll_registers(hash_keys(ids), np.zeros(len(ids), dtype=np.int64), 1, 12)[0]
+    assert by_value.registers == bytearray(vectorized.tobytes())
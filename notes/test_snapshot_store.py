@@ -0,0 +1,13 @@
+import numpy as np
+
+from snapshot_store import diff
+
+
+def test_nan_rows_are_not_changes():
+    previous = {'user_id': np.array([1, 2, 3]), 'score': np.array([1.0, np.nan, 3.0]),
+                'city': np.array(['a', np.nan, None], dtype=object)}
+    current = {'user_id': np.array([1, 2, 4]), 'score': np.array([1.0, np.nan, np.nan]),
+               'city': np.array(['a', np.nan, None], dtype=object)}
+    changed, gone = diff('user_id', previous, current)
+    assert changed['user_id'].tolist() == [4]
+    assert gone.tolist() == [3]
@@ -0,0 +1,24 @@
+import os
+
+import numpy as np
+
+from stage_check_exchange import ColumnScan, StageCheckExchange, UnseenCategoryCheck, write_partition
+
+
+def test_unseen_category_longer_than_staged_width(tmp_path):
+    path = str(tmp_path / 'staged')
+    write_partition(path, {'dim_market': np.array(['market_10', 'market_2'])})
+    result = UnseenCategoryCheck('dim_market', {'market_100', 'market_2'})(ColumnScan(path))
+    assert not result.passed
+    assert result.detail == '1 unseen: market_10'
+
+
+def test_exchange_over_legacy_directory(tmp_path):
+    stage = StageCheckExchange(str(tmp_path), 'dim_total_bookings')
+    legacy = stage.partition_path('2018-02-09')
+    write_partition(legacy, {'m_bookings': np.array([1.0])})
+    stage.run('2018-02-09', {'m_bookings': np.array([2.0, 3.0])})
+    assert os.path.islink(legacy)
+    assert stage.read('2018-02-09', 'm_bookings').tolist() == [2.0, 3.0]
+    assert os.listdir(os.path.join(str(tmp_path), 'dim_total_bookings', '_versions')) == [
+        os.path.basename(os.path.realpath(legacy))]